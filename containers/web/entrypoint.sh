@@ -1,5 +1,8 @@
 #!/bin/bash
 
+### Uploads are streamed into this directory on the media volume before being moved into place
+mkdir -p /ywangvaster_media/.uploads
+
 ### Make migrations (incase of changes) and apply 
 python3 manage.py makemigrations --noinput
 python3 manage.py makemigrations candidate_app --noinput
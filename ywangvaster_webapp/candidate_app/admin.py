@@ -1,18 +1,78 @@
 from django.contrib import admin
+from django.db import transaction
 
 from . import models
 
 
+class ParentAdmin(admin.ModelAdmin):
+    """Admin for the models the beams and candidates cascade from, which deletes them through delete_beams and
+    delete_candidates so their files are cleaned up. The bulk delete and the cascade skip the model delete()s."""
+
+    # Name of the foreign key from the beams and candidates to the model
+    child_field = None
+
+    def delete_children(self, queryset):
+        models.delete_candidates(models.Candidate.objects.filter(**{f"{self.child_field}__in": queryset}))
+        models.delete_beams(models.Beam.objects.filter(**{f"{self.child_field}__in": queryset}))
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            self.delete_children(self.model.objects.filter(pk=obj.pk))
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            self.delete_children(queryset)
+            super().delete_queryset(request, queryset)
+
+
+class ProjectAdmin(ParentAdmin):
+    model = models.Project
+    child_field = "project"
+
+
+class ObservationAdmin(ParentAdmin):
+    model = models.Observation
+    child_field = "observation"
+
+
+class UploadAdmin(ParentAdmin):
+    model = models.Upload
+    child_field = "upload"
+
+
+class BeamAdmin(admin.ModelAdmin):
+    model = models.Beam
+
+    def delete_queryset(self, request, queryset):
+        models.delete_beams(queryset)
+
+
 class CandidateAdmin(admin.ModelAdmin):
     search_fields = ["obs_id", "hash_id", "name"]
     list_display = ("name", "hash_id")
     model = models.Candidate
 
+    def delete_queryset(self, request, queryset):
+        models.delete_candidates(queryset)
+
+
+class RatingAdmin(admin.ModelAdmin):
+    model = models.Rating
+
+    def delete_queryset(self, request, queryset):
+        # The bulk delete skips Rating.delete(), so the rating summaries of the candidates are updated here.
+        with transaction.atomic():
+            candidates = list(models.Candidate.objects.filter(rating__in=queryset).distinct())
+            super().delete_queryset(request, queryset)
+            for candidate in candidates:
+                candidate.update_rating_summary()
+
 
 admin.site.register(models.Tag)
-admin.site.register(models.Project)
-admin.site.register(models.Observation)
-admin.site.register(models.Beam)
+admin.site.register(models.Project, ProjectAdmin)
+admin.site.register(models.Observation, ObservationAdmin)
+admin.site.register(models.Beam, BeamAdmin)
 admin.site.register(models.Candidate, CandidateAdmin)
-admin.site.register(models.Rating)
-admin.site.register(models.Upload)
+admin.site.register(models.Rating, RatingAdmin)
+admin.site.register(models.Upload, UploadAdmin)
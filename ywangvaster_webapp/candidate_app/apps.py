@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CandidateAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "candidate_app"
+
+    def ready(self):
+        # Connect the signals keeping the projects cached for the page header up to date.
+        from . import context_processors  # noqa: F401
@@ -1,13 +1,73 @@
 """This is loaded into the context for every page and needs to be added to settings.py for each addition to the page context dictionary."""
 
+import os
+import tempfile
+
 from . import models, forms
 
 from django.contrib.auth.forms import PasswordChangeForm as DjangoPasswordChangeForm
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
 
+# Touched whenever a project is created, changed or deleted, so every process serving pages (e.g. each gunicorn
+# worker) knows to reload its cached projects.
+PROJECTS_CHANGED_FILE = os.path.join(tempfile.gettempdir(), "ywangvaster_projects_changed")
+
+# (time PROJECTS_CHANGED_FILE was last touched, {hash_id: id} of every project) cached by this process
+_project_cache = (None, {})
+
+
+def projects_changed_stamp() -> int:
+    try:
+        return os.stat(PROJECTS_CHANGED_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def get_project_ids() -> dict:
+    """Get the ids of all the projects by their hash_id, from the DB only if a project has changed since last time."""
+
+    global _project_cache
+
+    # Read before the projects, so a change made while they are read is picked up by the next request.
+    stamp = projects_changed_stamp()
+    if stamp != _project_cache[0]:
+        project_ids = {
+            str(hash_id): id for hash_id, id in models.Project.objects.order_by("id").values_list("hash_id", "id")
+        }
+        _project_cache = (stamp, project_ids)
+
+    return _project_cache[1]
 
-def header_forms(request):
+
+@receiver(post_save, sender=models.Project)
+@receiver(post_delete, sender=models.Project)
+def projects_changed(**kwargs):
+    """Tell every process to reload the cached projects once the change is committed."""
+
+    def touch():
+        with open(PROJECTS_CHANGED_FILE, "a"):
+            os.utime(PROJECTS_CHANGED_FILE)
+
+    transaction.on_commit(touch)
+
+
+def make_project_form():
+    """Project select form for the header, with the choices filled in from the cached projects."""
 
     project_form = forms.ProjectSelectForm()
+    field = project_form.fields["selected_project_hash_id"]
+    field.widget.choices = [("", field.empty_label)] + list(get_project_ids().items())
+
+    return project_form
+
+
+def header_forms(request):
+
+    # The forms are only built if the rendered template uses them.
+    project_form = SimpleLazyObject(make_project_form)
 
     # Get current selected project and put it on the header of each rendered page.
     selected_project_hash_id = request.session.get("selected_project_hash_id")
@@ -16,11 +76,13 @@ def header_forms(request):
         selected_project_id = "All projects"
         selected_projects = models.Project.objects.all()
     else:
-        selected_projects = [models.Project.objects.get(hash_id=selected_project_hash_id)]
-        selected_project_id = selected_projects[0].id
+        selected_projects = models.Project.objects.filter(hash_id=selected_project_hash_id)
+        selected_project_id = get_project_ids().get(selected_project_hash_id)
+        if selected_project_id is None:
+            selected_project_id = models.Project.objects.get(hash_id=selected_project_hash_id).id
 
     # Empty pw reset form for header
-    pw_reset_form = DjangoPasswordChangeForm(request.user)
+    pw_reset_form = SimpleLazyObject(lambda: DjangoPasswordChangeForm(request.user))
 
     return {
         "project_form": project_form,
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from candidate_app.models import Beam, MediaBlob, Observation, Project, QueuedFileDeletion, referenced_paths
+
+
+def remove_file(path: str) -> bool:
+    """Remove a file from the media storage, return False if it couldn't be removed. Missing files count as removed."""
+
+    try:
+        os.remove(default_storage.path(path))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Could not delete {path}: {e}")
+        return False
+
+    return True
+
+
+def record_is_gone(path: str) -> bool:
+    """Check if a project_id/obs_id/beam_index directory is for a project, observation or beam that has been deleted.
+
+    Any other directory, like the blobs/ab/cd directories of the content addressed store that uploads write into at
+    any time, is never counted as gone."""
+
+    parts = path.split(os.sep)
+    if parts[0] == "blobs":
+        return False
+    if len(parts) == 1:
+        return not Project.objects.filter(id=parts[0]).exists()
+    if len(parts) == 2:
+        return not Observation.objects.filter(project__id=parts[0], id=parts[1]).exists()
+    if len(parts) == 3 and parts[2].isdigit():
+        return not Beam.objects.filter(project__id=parts[0], observation__id=parts[1], index=int(parts[2])).exists()
+
+    return False
+
+
+def remove_empty_dirs(dirs: set):
+    """Remove the directories (project/obs/beam) left empty by the deleted files, and their empty parents.
+
+    Only the directories of deleted records are removed, so a directory is never removed from under an upload that is
+    about to save a file into it."""
+
+    for path in sorted(dirs, key=lambda d: d.count(os.sep), reverse=True):
+        while path and record_is_gone(path):
+            try:
+                os.rmdir(default_storage.path(path))
+            except OSError:
+                # Not empty (or already gone)
+                break
+            path = os.path.dirname(path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the media files queued for deletion when their projects, observations, beams or candidates were deleted"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of files to delete in parallel.",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            default=1000,
+            help="Number of queued files to take at a time.",
+        )
+
+    def handle(self, *args, **kwargs):
+        total = QueuedFileDeletion.objects.count()
+        if not total:
+            print("No files queued for deletion, nothing to do.")
+            return
+
+        print(f"Deleting {total} queued files with {kwargs['workers']} workers.")
+
+        start = time.time()
+        deleted = failed = in_use = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=kwargs["workers"]) as executor:
+            while True:
+                # The queued rows are locked while their files are deleted so another run of the command skips them,
+                # and are only removed once the files are gone. Files that couldn't be deleted stay queued for the
+                # next run.
+                with transaction.atomic():
+                    batch = list(
+                        QueuedFileDeletion.objects.select_for_update(skip_locked=True)
+                        .filter(id__gt=last_id)
+                        .order_by("id")
+                        .values_list("id", "path")[: kwargs["batch_size"]]
+                    )
+                    if not batch:
+                        break
+
+                    last_id = batch[-1][0]
+
+                    # A queued path can be in use again, e.g. if a run died after removing the file but before taking
+                    # it off the queue and a new upload then saved a file with the same name. Those are only taken
+                    # off the queue.
+                    paths = [path for _, path in batch]
+                    used = referenced_paths(paths) | set(
+                        MediaBlob.objects.filter(name__in=paths).values_list("name", flat=True)
+                    )
+                    QueuedFileDeletion.objects.filter(id__in=[i for i, path in batch if path in used]).delete()
+
+                    batch = [(i, path) for i, path in batch if path not in used]
+                    removed = list(executor.map(remove_file, [path for _, path in batch]))
+
+                    QueuedFileDeletion.objects.filter(id__in=[i for (i, _), ok in zip(batch, removed) if ok]).delete()
+
+                remove_empty_dirs({os.path.dirname(path) for (_, path), ok in zip(batch, removed) if ok})
+
+                in_use += len(used)
+                deleted += sum(removed)
+                failed += len(removed) - sum(removed)
+
+                elapsed = time.time() - start
+                print(
+                    f"Deleted {deleted}/{total} files ({failed} failed, {in_use} in use again so kept) - "
+                    f"{deleted / max(elapsed, 1e-3):.0f} files/s."
+                )
+
+        print(f"Finished deleting queued files in {time.time() - start:.1f}s, {failed} left queued.")
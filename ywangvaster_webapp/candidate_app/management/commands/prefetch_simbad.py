@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from candidate_app.models import Candidate, Observation
+from candidate_app.utils import SIMBAD_MAX_REGION_ARCMIN, cache_simbad_region, simbad_region_is_cached
+from ywangvaster_webapp.settings import SIMBAD_CACHE_TTL_DAYS
+
+# Extra radius around the furthest candidate of a beam, so the nearby objects of every candidate are cached.
+FOOTPRINT_MARGIN_ARCMIN = 2.0
+
+
+class Command(BaseCommand):
+    help = "Cache the Simbad objects in the footprint of an observation, one region around each beam centre"
+
+    def add_arguments(self, parser):
+        parser.add_argument("obs_id", type=str, help="ID of the observation, e.g. SB50230.")
+        parser.add_argument("--proj_id", type=str, default=None, help="ID of the project the observation is in.")
+        parser.add_argument(
+            "--radius",
+            type=float,
+            default=None,
+            help=(
+                "Radius in arcmin around each beam centre. Defaults to the separation of the furthest candidate in the "
+                f"beam plus {FOOTPRINT_MARGIN_ARCMIN} arcmin (at most {SIMBAD_MAX_REGION_ARCMIN} arcmin)."
+            ),
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Query Simbad again even if the regions are already cached.",
+        )
+
+    def handle(self, *args, **kwargs):
+        observations = Observation.objects.filter(id=kwargs["obs_id"])
+        if kwargs["proj_id"]:
+            observations = observations.filter(project__id=kwargs["proj_id"])
+
+        if not observations.exists():
+            raise CommandError(f"Observation {kwargs['obs_id']} does not exist.")
+
+        # The footprint is made of the beam centres of the candidates.
+        beams = (
+            Candidate.objects.filter(observation__in=observations)
+            .values("beam_ra", "beam_dec")
+            .annotate(max_sep_deg=Max("beam_sep_deg"))
+            .order_by("beam_ra", "beam_dec")
+        )
+
+        max_age = timedelta(days=SIMBAD_CACHE_TTL_DAYS)
+
+        for beam in beams:
+            radius_arcmin = kwargs["radius"] or beam["max_sep_deg"] * 60 + FOOTPRINT_MARGIN_ARCMIN
+            radius_arcmin = min(radius_arcmin, SIMBAD_MAX_REGION_ARCMIN)
+
+            position = f"{beam['beam_ra']:.4f} {beam['beam_dec']:.4f}"
+
+            if not kwargs["force"] and simbad_region_is_cached(
+                beam["beam_ra"], beam["beam_dec"], radius_arcmin, max_age
+            ):
+                print(f"Simbad objects within {radius_arcmin:.1f} arcmin of {position} are already cached.")
+                continue
+
+            count = cache_simbad_region(beam["beam_ra"], beam["beam_dec"], radius_arcmin)
+            print(f"Cached {count} Simbad objects within {radius_arcmin:.1f} arcmin of {position}.")
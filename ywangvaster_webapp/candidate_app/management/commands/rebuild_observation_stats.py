@@ -0,0 +1,12 @@
+#! /usr/bin/env python
+
+from django.core.management.base import BaseCommand
+from candidate_app.models import ObservationStats
+
+
+class Command(BaseCommand):
+    help = "Recompute the counts and file totals of every observation shown on the site admin page"
+
+    def handle(self, *args, **kwargs):
+        ObservationStats.rebuild()
+        print(f"Rebuilt the stats of {ObservationStats.objects.count()} observations.")
@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from candidate_app.models import (
+    Beam,
+    Candidate,
+    MediaBlob,
+    Project,
+    ProjectDiskUsage,
+    QueuedFileDeletion,
+    count_references,
+)
+
+# Rows read at a time when collecting the files of the beams and candidates
+CHUNK_SIZE = 2000
+
+
+def scan_dir(path: str):
+    """List a directory of the media storage, relative to MEDIA_ROOT.
+
+    :return: The (path, size, modified time) of each file and the paths of the subdirectories."""
+
+    files, dirs = [], []
+    try:
+        with os.scandir(os.path.join(settings.MEDIA_ROOT, path)) as entries:
+            for entry in entries:
+                name = os.path.join(path, entry.name) if path else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(name)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((name, stat.st_size, stat.st_mtime))
+    except FileNotFoundError:
+        # Removed since it was listed
+        pass
+
+    return files, dirs
+
+
+def scan_media(workers: int) -> dict:
+    """Find every file under MEDIA_ROOT, listing each level of the project/obs/beam tree with parallel workers.
+
+    :return: Size and modified time of each file, by its path relative to MEDIA_ROOT."""
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Skip the uploads still being received
+        files, level = scan_dir("")
+        found.update((name, (size, mtime)) for name, size, mtime in files)
+        upload_dir = os.path.relpath(settings.FILE_UPLOAD_TEMP_DIR, settings.MEDIA_ROOT)
+        level = [name for name in level if name != upload_dir]
+
+        while level:
+            next_level = []
+            for files, dirs in executor.map(scan_dir, level):
+                found.update((name, (size, mtime)) for name, size, mtime in files)
+                next_level += dirs
+            level = next_level
+
+    return found
+
+
+def reclaim_orphans(paths: list) -> tuple:
+    """Queue orphaned files for deletion, after checking again that nothing has started using them.
+
+    The orphans were found from a snapshot of the beams and candidates that may be minutes old, and an upload can add
+    a reference to an old stored file since then. Within the transaction the stored files are locked, so a reference
+    can't be added to one until it is committed, and only the paths a record holds are kept. The reference counts of
+    the stored files aren't trusted, as a delete that skipped the model delete paths leaves them too high, so they are
+    set from the records instead.
+
+    :return: The number of files queued and the number kept as they are in use."""
+
+    queued = kept = 0
+    for start in range(0, len(paths), CHUNK_SIZE):
+        chunk = paths[start : start + CHUNK_SIZE]
+        with transaction.atomic():
+            # Locked in a fixed order like MediaBlob.release, so they can't deadlock
+            blobs = list(MediaBlob.objects.select_for_update().filter(name__in=chunk).order_by("sha256"))
+            counts = count_references(chunk)
+            in_use = set(counts)
+
+            # Stored files that no record uses can't be referred to by later uploads once they are gone.
+            MediaBlob.objects.filter(sha256__in=[blob.sha256 for blob in blobs if blob.name not in in_use]).delete()
+
+            stale = [blob for blob in blobs if blob.name in in_use and blob.ref_count != counts[blob.name]]
+            for blob in stale:
+                blob.ref_count = counts[blob.name]
+            MediaBlob.objects.bulk_update(stale, ["ref_count"])
+
+            QueuedFileDeletion.objects.bulk_create(
+                [QueuedFileDeletion(path=path) for path in chunk if path not in in_use]
+            )
+
+        chunk_kept = sum(1 for path in chunk if path in in_use)
+        kept += chunk_kept
+        queued += len(chunk) - chunk_kept
+
+    return queued, kept
+
+
+def expected_files(model):
+    """Yield the files of every record of a model that has FILE_FIELDS.
+
+    :return: Iterator of (record hash_id, project hash_id, total_file_size_bytes, paths)."""
+
+    rows = model.objects.values_list("hash_id", "project_id", "total_file_size_bytes", *model.FILE_FIELDS)
+    for hash_id, project_id, total_file_size_bytes, *paths in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield hash_id, project_id, total_file_size_bytes, [path for path in paths if path]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the files in the media directory with the files of the beams and candidates in the DB, report "
+        "orphaned and missing files and store the disk usage of each project for the site admin page"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of directories to list in parallel.",
+        )
+        parser.add_argument(
+            "--reclaim",
+            action="store_true",
+            help="Queue the orphaned files to be deleted by the delete_queued_files command.",
+        )
+        parser.add_argument(
+            "--min_age",
+            type=float,
+            default=24,
+            help="Only reclaim orphaned files last modified more than this many hours ago, so files of uploads still "
+            "in progress are left alone.",
+        )
+
+    def handle(self, *args, **kwargs):
+        verbose = kwargs["verbosity"] > 1
+
+        start = time.time()
+        on_disk = scan_media(kwargs["workers"])
+        print(f"Found {len(on_disk)} files in {settings.MEDIA_ROOT} in {time.time() - start:.1f}s.")
+
+        # Project directories are named by the project id
+        project_dirs = dict(Project.objects.values_list("id", "hash_id"))
+        usage = defaultdict(lambda: defaultdict(int))
+
+        # Projects using each file, files in the content addressed store can be shared between projects.
+        referenced = defaultdict(set)
+        missing_count = mismatch_count = 0
+        for model in (Beam, Candidate):
+            for hash_id, project_id, total_file_size_bytes, paths in expected_files(model):
+                for path in paths:
+                    referenced[path].add(project_id)
+
+                missing = [path for path in paths if path not in on_disk]
+                for path in missing:
+                    if verbose:
+                        print(f"Missing: {path} ({model.__name__} {hash_id})")
+                usage[project_id]["missing_count"] += len(missing)
+                missing_count += len(missing)
+
+                size = sum(on_disk[path][0] for path in paths if path in on_disk)
+                if not missing and total_file_size_bytes is not None and size != total_file_size_bytes:
+                    if verbose:
+                        print(
+                            f"Size mismatch: {model.__name__} {hash_id} has {size} bytes on disk, "
+                            f"{total_file_size_bytes} expected"
+                        )
+                    usage[project_id]["size_mismatch_count"] += 1
+                    mismatch_count += 1
+
+        orphans = []
+        for path, (size, mtime) in on_disk.items():
+            if path in referenced:
+                # Files shared by several projects count towards each of them.
+                for project_id in referenced[path]:
+                    usage[project_id]["file_count"] += 1
+                    usage[project_id]["size_bytes"] += size
+                continue
+
+            if verbose:
+                print(f"Orphan: {path} ({size} bytes)")
+            orphans.append((path, size, mtime))
+
+            # Orphans in the directory of a project (from before the content addressed store) count towards it.
+            project_id = project_dirs.get(path.split(os.sep, 1)[0])
+            if project_id is not None:
+                usage[project_id]["file_count"] += 1
+                usage[project_id]["size_bytes"] += size
+                usage[project_id]["orphan_count"] += 1
+                usage[project_id]["orphan_size_bytes"] += size
+
+        orphan_size_gb = sum(size for _, size, _ in orphans) / (1024.0**3)
+        print(f"{len(orphans)} orphaned files ({orphan_size_gb:.2f} Gb), {missing_count} missing files.")
+        print(f"{mismatch_count} beams and candidates with files on disk not matching their total_file_size_bytes.")
+
+        scanned_at = timezone.now()
+        with transaction.atomic():
+            ProjectDiskUsage.objects.all().delete()
+            ProjectDiskUsage.objects.bulk_create(
+                [
+                    ProjectDiskUsage(project_id=project_id, scanned_at=scanned_at, **usage[project_id])
+                    for project_id in project_dirs.values()
+                ]
+            )
+        print(f"Stored the disk usage of {len(project_dirs)} projects.")
+
+        if kwargs["reclaim"]:
+            cutoff = time.time() - kwargs["min_age"] * 3600
+            # Skip anything already queued from a deleted record
+            queued = set(QueuedFileDeletion.objects.values_list("path", flat=True))
+            reclaim = [path for path, _, mtime in orphans if mtime < cutoff and path not in queued]
+
+            queued_count, kept_count = reclaim_orphans(reclaim)
+            print(
+                f"Queued {queued_count} orphaned files for deletion, they are removed by the delete_queued_files "
+                f"command. {kept_count} were left alone as they are in use since the scan."
+            )
@@ -0,0 +1,21 @@
+#! /usr/bin/env python
+
+from django.core.management.base import BaseCommand
+from candidate_app.models import CandidateMinMaxStats
+
+
+class Command(BaseCommand):
+    help = "Recompute the min/max stats used by the candidate table filters if candidates have been deleted or updated"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Recompute the stats even if they have not been marked as dirty.",
+        )
+
+    def handle(self, *args, **kwargs):
+        if CandidateMinMaxStats.refresh(force=kwargs["force"]):
+            print("Recomputed the candidate min/max stats.")
+        else:
+            print("Candidate min/max stats are up to date, nothing to do.")
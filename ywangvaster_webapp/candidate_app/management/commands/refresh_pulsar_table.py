@@ -1,82 +1,234 @@
 #! /usr/bin/env python
 
 from urllib import request
+import math
+import time
 import tarfile
 from io import BytesIO
+import numpy as np
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection, transaction
 from candidate_app.models import ATNFPulsar
 
 ATNF_LINK = "https://www.atnf.csiro.au/research/pulsar/psrcat/downloads/psrcat_pkg.tar.gz"
+ATNF_DB_MEMBER = "psrcat_tar/psrcat.db"
+
+# Catalogue parameters stored for each pulsar, by the model field they go in.
+FLOAT_PARAMS = {"DM": "DM", "P0": "p0", "S400": "s400"}
+POSITION_PARAMS = ["RAJ", "DECJ", "ELONG", "ELAT"]
+
+# Fields compared with the current rows to find the pulsars that changed
+PULSAR_FIELDS = ["raj", "decj", "ra_str", "dec_str", "DM", "p0", "s400"]
+
+
+def open_psrcat(path: str = None):
+    """Open the psrcat.db catalogue file, from a local psrcat.db or psrcat_pkg.tar.gz if given or else downloaded."""
+
+    if path is None:
+        with request.urlopen(request.Request(ATNF_LINK), timeout=15.0) as response:
+            if response.status != 200:
+                raise Exception("unable to download .tar file")
+            tar = tarfile.open(name=None, fileobj=BytesIO(response.read()))
+    elif tarfile.is_tarfile(path):
+        tar = tarfile.open(path)
+    else:
+        return open(path, "rb")
+
+    return tar.extractfile(ATNF_DB_MEMBER)
+
+
+def parse_psrcat(psrdb) -> dict:
+    """Parse the records of the catalogue into a column of values for each parameter, in the order of the pulsars.
+
+    Each record is a list of "<parameter> <value> [<error>] [<reference>]" lines ending with a "@-" line. Missing
+    values are None."""
+
+    params = ["PSRJ"] + POSITION_PARAMS + list(FLOAT_PARAMS)
+    columns = {param: [] for param in params}
+
+    record = {}
+    for ln in psrdb:
+        line = ln.decode()
+
+        if line.startswith("@-"):
+            if "PSRJ" in record:
+                for param in params:
+                    columns[param].append(record.get(param))
+            record = {}
+        elif line.startswith("#"):
+            continue
+        else:
+            fields = line.split()
+            if len(fields) > 1 and fields[0] in columns:
+                record[fields[0]] = fields[1]
+
+    return columns
+
+
+def parse_floats(values: list) -> list:
+    """Convert the catalogue values to floats, with None for missing or unreadable values."""
+
+    floats = []
+    for value in values:
+        try:
+            floats.append(float(value))
+        except (TypeError, ValueError):
+            floats.append(None)
+
+    return floats
+
+
+def get_positions(columns: dict):
+    """Get the J2000 positions of the pulsars, with one coordinate conversion for each frame.
+
+    Pulsars with both an equatorial (RAJ/DECJ) and ecliptic (ELONG/ELAT) position use the equatorial one.
+
+    :return: Arrays of ra and dec in degrees and sexagesimal strings, NaN / None if a pulsar has no position."""
+
+    n = len(columns["PSRJ"])
+    ra, dec = np.full(n, np.nan), np.full(n, np.nan)
+
+    equatorial = np.array(
+        [r is not None and d is not None for r, d in zip(columns["RAJ"], columns["DECJ"])], dtype=bool
+    )
+    ecliptic = ~equatorial & np.array(
+        [elong is not None and elat is not None for elong, elat in zip(columns["ELONG"], columns["ELAT"])], dtype=bool
+    )
+
+    if equatorial.any():
+        pos = SkyCoord(
+            [columns["RAJ"][i] for i in np.flatnonzero(equatorial)],
+            [columns["DECJ"][i] for i in np.flatnonzero(equatorial)],
+            unit=(u.hourangle, u.degree),
+            frame="fk5",
+        )
+        ra[equatorial], dec[equatorial] = pos.ra.degree, pos.dec.degree
+
+    if ecliptic.any():
+        pos = SkyCoord(
+            np.array(parse_floats([columns["ELONG"][i] for i in np.flatnonzero(ecliptic)]), dtype=float),
+            np.array(parse_floats([columns["ELAT"][i] for i in np.flatnonzero(ecliptic)]), dtype=float),
+            unit=(u.degree, u.degree),
+            frame="barycentricmeanecliptic",
+        ).transform_to("fk5")
+        ra[ecliptic], dec[ecliptic] = pos.ra.degree, pos.dec.degree
+
+    has_pos = np.isfinite(ra) & np.isfinite(dec)
+    ra_str = np.full(n, None, dtype=object)
+    dec_str = np.full(n, None, dtype=object)
+    if has_pos.any():
+        pos = SkyCoord(ra[has_pos], dec[has_pos], unit=(u.degree, u.degree), frame="fk5")
+        ra_str[has_pos] = pos.ra.to_string(unit=u.hourangle, sep=":", precision=2, pad=True)
+        dec_str[has_pos] = pos.dec.to_string(unit=u.deg, sep=":", precision=2, pad=True)
+
+    return ra, dec, ra_str, dec_str
+
+
+def read_pulsars(psrdb) -> list:
+    """Read the pulsars with a position from the catalogue, as unsaved ATNFPulsar records."""
+
+    columns = parse_psrcat(psrdb)
+    ra, dec, ra_str, dec_str = get_positions(columns)
+    floats = {field: parse_floats(columns[param]) for param, field in FLOAT_PARAMS.items()}
+
+    pulsars = []
+    for i, name in enumerate(columns["PSRJ"]):
+        if ra_str[i] is None:
+            print(f"Skipping {name}, it has no position.")
+            continue
+
+        pulsars.append(
+            ATNFPulsar(
+                name=name,
+                raj=ra[i],
+                decj=dec[i],
+                ra_str=ra_str[i],
+                dec_str=dec_str[i],
+                **{field: values[i] for field, values in floats.items()},
+            )
+        )
+
+    return pulsars
+
+
+def pulsar_changed(pulsar: ATNFPulsar, current: dict) -> bool:
+    """Check if a pulsar read from the catalogue differs from the values of its current row."""
+
+    for field in PULSAR_FIELDS:
+        new, old = getattr(pulsar, field), current[field]
+        if isinstance(new, float) and isinstance(old, float):
+            if not math.isclose(new, old, rel_tol=1e-12, abs_tol=1e-12):
+                return True
+        elif new != old:
+            return True
+
+    return False
+
+
+def sync_pulsars(pulsars: list) -> tuple:
+    """Bring the pulsar table in line with the catalogue, only writing the pulsars that were added, changed or removed.
+
+    New and changed pulsars are written with one upsert on the name, so unchanged rows (and concurrent searches of
+    them) are left alone.
+
+    :return: The names of the added, changed and removed pulsars."""
+
+    with transaction.atomic():
+        current = {row["name"]: row for row in ATNFPulsar.objects.values("name", *PULSAR_FIELDS)}
+
+        added = [pulsar for pulsar in pulsars if pulsar.name not in current]
+        changed = [
+            pulsar for pulsar in pulsars if pulsar.name in current and pulsar_changed(pulsar, current[pulsar.name])
+        ]
+        removed = current.keys() - {pulsar.name for pulsar in pulsars}
+
+        ATNFPulsar.objects.bulk_create(
+            added + changed,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=["name"],
+            update_fields=PULSAR_FIELDS,
+        )
+        ATNFPulsar.objects.filter(name__in=removed).delete()
+
+    return [pulsar.name for pulsar in added], [pulsar.name for pulsar in changed], sorted(removed)
 
 
 class Command(BaseCommand):
     help = "Update the pulsar table based on the ATNF pulsar database"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file",
+            type=str,
+            default=None,
+            help="Local psrcat.db or psrcat_pkg.tar.gz to read the catalogue from instead of downloading it.",
+        )
+
     def handle(self, *args, **kwargs):
-        with request.urlopen(request.Request(ATNF_LINK), timeout=15.0) as response:
-            if response.status == 200:
-                tar = tarfile.open(name=None, fileobj=BytesIO(response.read()))
-                psrdb = tar.extractfile("psrcat_tar/psrcat.db")
-                # unzip
-            else:
-                raise Exception("unable to download .tar file")
+        start = time.time()
+        psrdb = open_psrcat(kwargs["file"])
+        print(f"Opened the ATNF catalogue in {time.time() - start:.1f}s.")
+
+        start = time.time()
+        with psrdb:
+            pulsars = read_pulsars(psrdb)
+        print(f"Read {len(pulsars)} pulsars in {time.time() - start:.1f}s.")
+
+        start = time.time()
+        added, changed, removed = sync_pulsars(pulsars)
+        print(
+            f"Updated the pulsar table in {time.time() - start:.1f}s: {len(added)} added, {len(changed)} changed, "
+            f"{len(removed)} removed, {len(pulsars) - len(added) - len(changed)} unchanged."
+        )
+        if kwargs["verbosity"] > 1:
+            for label, names in (("Added", added), ("Changed", changed), ("Removed", removed)):
+                if names:
+                    print(f"{label}: {', '.join(names)}")
 
-        dec, ra, lat, long, pos = None, None, None, None, None
-        name = None
-        db_dict = {}
-        for ln in psrdb:
-            line = ln.decode()
-
-            if line.startswith("@-"):
-                print(db_dict[name])
-                dec, ra, lat, long, pos = None, None, None, None, None
-                name = None
-            elif line.startswith("# "):
-                print(f"This line is commented out - '{line}' ")
-            elif "PSRJ" in line:
-                name = line.split()[1]
-                db_dict[name] = {}
-            elif "DECJ" in line:
-                dec = line.split()[1]
-            elif "RAJ" in line:
-                ra = line.split()[1]
-            elif "ELAT" in line:
-                lat = line.split()[1]
-            elif "ELONG" in line:
-                long = line.split()[1]
-            elif "DM" in line:
-                db_dict[name]["dm"] = float(line.split()[1])
-            elif "P0" in line:
-                db_dict[name]["p0"] = float(line.split()[1])
-            elif "S400" in line:
-                db_dict[name]["s400"] = float(line.split()[1])
-
-            if (dec is not None) and (ra is not None):
-                pos = SkyCoord(ra, dec, unit=(u.hour, u.degree), frame="fk5")
-            if (lat is not None) and (long is not None):
-                pos = SkyCoord(l=long, b=lat, unit=(u.degree, u.degree), frame="galactic").transform_to("fk5")
-
-            if pos is not None:
-                db_dict[name]["raj"] = pos.ra.degree
-                db_dict[name]["decj"] = pos.dec.degree
-
-                db_dict[name]["ra_str"] = pos.ra.to_string(unit=u.hourangle, sep=":", precision=2, pad=True)
-                db_dict[name]["dec_str"] = pos.dec.to_string(unit=u.deg, sep=":", precision=2, pad=True)
-
-        with transaction.atomic():
-            ATNFPulsar.objects.all().delete()
-            for rec in db_dict.keys():
-                psr = ATNFPulsar()
-                psr.name = rec
-                psr.raj = db_dict[rec]["raj"]
-                psr.ra_str = db_dict[rec]["ra_str"]
-                psr.decj = db_dict[rec]["decj"]
-                psr.dec_str = db_dict[rec]["dec_str"]
-                psr.DM = db_dict[rec].get("dm", None)
-                psr.p0 = db_dict[rec].get("p0", None)
-                psr.s400 = db_dict[rec].get("s400", None)
-                psr.save()
+        # Keep the planner statistics used by the q3c searches of the table up to date.
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE candidate_app_atnfpulsar;")
@@ -0,0 +1,166 @@
+# Replace the candidate_min_max_stats materialised view, which was fully refreshed after every statement on the
+# candidate table, with a plain table that is maintained incrementally.
+
+# - Inserts widen the min/max bounds using only the newly inserted rows (a statement level trigger with a transition
+#   table), so the cost of an insert no longer depends on the size of the candidate table.
+# - Deletes, and updates of the statistic columns, can shrink the bounds so they only mark the stats as dirty. The
+#   full recompute is deferred to the "refresh_candidate_stats" management command, run by cron.
+
+# Only possible when using a Postgres 16 backend.
+
+from django.db import migrations, models
+
+STATS_COLUMNS = [
+    "chi_square",
+    "chi_square_sigma",
+    "chi_square_log_sigma",
+    "peak_map",
+    "peak_map_sigma",
+    "peak_map_log_sigma",
+    "gaussian_map",
+    "gaussian_map_sigma",
+    "std_map",
+    "bright_sep_arcmin",
+    "beam_sep_deg",
+    "deep_int_flux",
+    "deep_peak_flux",
+    "deep_sep_arcsec",
+    "md_deep",
+]
+
+
+def rounded_aggregate(aggregate: str, column: str) -> str:
+    """Rounded MIN or MAX of a column, ignoring NaNs and infinities (same as the old materialised view)."""
+
+    finite = f"CASE WHEN {column} IS NOT NULL AND {column} NOT IN ('NaN', 'Infinity', '-Infinity') THEN {column} END"
+    return f"ROUND(CAST({aggregate}({finite}) AS numeric), 2)"
+
+
+STATS_TRIGGER_COLUMNS = ", ".join(STATS_COLUMNS)
+STATS_FIELD_NAMES = ", ".join(f"min_{c}, max_{c}" for c in STATS_COLUMNS)
+STATS_FIELD_TYPES = ", ".join(f"min_{c} double precision, max_{c} double precision" for c in STATS_COLUMNS)
+STATS_AGGREGATES = ", ".join(f"{rounded_aggregate('MIN', c)}, {rounded_aggregate('MAX', c)}" for c in STATS_COLUMNS)
+STATS_AGGREGATES_AS = ", ".join(
+    f"{rounded_aggregate('MIN', c)} AS min_{c}, {rounded_aggregate('MAX', c)} AS max_{c}" for c in STATS_COLUMNS
+)
+STATS_REPLACE = ", ".join(f"min_{c} = EXCLUDED.min_{c}, max_{c} = EXCLUDED.max_{c}" for c in STATS_COLUMNS)
+STATS_WIDEN = ", ".join(
+    f"min_{c} = LEAST(stats.min_{c}, EXCLUDED.min_{c}), max_{c} = GREATEST(stats.max_{c}, EXCLUDED.max_{c})"
+    for c in STATS_COLUMNS
+)
+
+CREATE_STATS_TABLE = f"""
+DROP TRIGGER IF EXISTS refresh_candidate_min_max_stats_trigger ON candidate_app_candidate;
+DROP FUNCTION IF EXISTS refresh_candidate_min_max_stats();
+DROP MATERIALIZED VIEW IF EXISTS candidate_min_max_stats;
+
+CREATE TABLE candidate_min_max_stats (
+    id bigint PRIMARY KEY,
+    {STATS_FIELD_TYPES},
+    dirty boolean NOT NULL DEFAULT false
+);
+"""
+
+# Full recompute of the bounds over the whole candidate table, this also clears the dirty flag.
+CREATE_RECOMPUTE_FUNCTION = f"""
+CREATE FUNCTION recompute_candidate_min_max_stats() RETURNS void
+AS $$
+BEGIN
+    INSERT INTO candidate_min_max_stats (id, {STATS_FIELD_NAMES}, dirty)
+    SELECT 1, {STATS_AGGREGATES}, false
+    FROM candidate_app_candidate
+    ON CONFLICT (id) DO UPDATE SET
+        {STATS_REPLACE},
+        dirty = false;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT recompute_candidate_min_max_stats();
+"""
+
+# Widen the bounds using only the rows inserted by the statement. LEAST/GREATEST ignore NULLs.
+CREATE_WIDEN_FUNCTION = f"""
+CREATE FUNCTION widen_candidate_min_max_stats() RETURNS trigger
+AS $$
+BEGIN
+    INSERT INTO candidate_min_max_stats AS stats (id, {STATS_FIELD_NAMES}, dirty)
+    SELECT 1, {STATS_AGGREGATES}, false
+    FROM new_candidates
+    ON CONFLICT (id) DO UPDATE SET
+        {STATS_WIDEN};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER widen_candidate_min_max_stats_trigger
+AFTER INSERT ON candidate_app_candidate
+REFERENCING NEW TABLE AS new_candidates
+FOR EACH STATEMENT EXECUTE FUNCTION widen_candidate_min_max_stats();
+"""
+
+CREATE_MARK_DIRTY_FUNCTION = f"""
+CREATE FUNCTION mark_candidate_min_max_stats_dirty() RETURNS trigger
+AS $$
+BEGIN
+    UPDATE candidate_min_max_stats SET dirty = true WHERE NOT dirty;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mark_candidate_min_max_stats_dirty_on_delete_trigger
+AFTER DELETE ON candidate_app_candidate
+FOR EACH STATEMENT EXECUTE FUNCTION mark_candidate_min_max_stats_dirty();
+
+CREATE TRIGGER mark_candidate_min_max_stats_dirty_on_update_trigger
+AFTER UPDATE OF {STATS_TRIGGER_COLUMNS} ON candidate_app_candidate
+FOR EACH STATEMENT EXECUTE FUNCTION mark_candidate_min_max_stats_dirty();
+"""
+
+# Put back the materialised view and the refresh trigger from 0004_candidate_material_views.
+RESTORE_MATERIALIZED_VIEW = f"""
+DROP TRIGGER IF EXISTS mark_candidate_min_max_stats_dirty_on_update_trigger ON candidate_app_candidate;
+DROP TRIGGER IF EXISTS mark_candidate_min_max_stats_dirty_on_delete_trigger ON candidate_app_candidate;
+DROP TRIGGER IF EXISTS widen_candidate_min_max_stats_trigger ON candidate_app_candidate;
+DROP FUNCTION IF EXISTS mark_candidate_min_max_stats_dirty();
+DROP FUNCTION IF EXISTS widen_candidate_min_max_stats();
+DROP FUNCTION IF EXISTS recompute_candidate_min_max_stats();
+DROP TABLE IF EXISTS candidate_min_max_stats;
+
+CREATE MATERIALIZED VIEW candidate_min_max_stats AS
+SELECT ROW_NUMBER() OVER () AS id, {STATS_AGGREGATES_AS}
+FROM candidate_app_candidate;
+
+CREATE FUNCTION refresh_candidate_min_max_stats() RETURNS trigger
+AS $$
+BEGIN
+    REFRESH MATERIALIZED VIEW candidate_min_max_stats;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER refresh_candidate_min_max_stats_trigger
+AFTER INSERT OR UPDATE OR DELETE ON candidate_app_candidate
+FOR EACH STATEMENT EXECUTE FUNCTION refresh_candidate_min_max_stats();
+"""
+
+
+class Migration(migrations.Migration):
+
+    initial = False
+
+    dependencies = [("candidate_app", "0006_alter_rating_tag")]
+
+    operations = [
+        # Swap the materialised view for a table holding a single row of stats.
+        migrations.RunSQL(CREATE_STATS_TABLE, RESTORE_MATERIALIZED_VIEW),
+        migrations.RunSQL(CREATE_RECOMPUTE_FUNCTION, []),
+        # Widen the bounds on insert.
+        migrations.RunSQL(CREATE_WIDEN_FUNCTION, []),
+        # Mark the stats as dirty on delete and update, to be recomputed later.
+        migrations.RunSQL(CREATE_MARK_DIRTY_FUNCTION, []),
+        migrations.AddField(
+            model_name="candidateminmaxstats",
+            name="dirty",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,190 @@
+# Keep the candidate min/max stats per project and per observation as well as over all candidates, so the filter
+# sliders on the candidate table page only span the candidates of the selected project.
+
+# Rows in candidate_min_max_stats are keyed by (project_id, observation_id):
+# - (NULL, NULL) holds the stats over all candidates (the single row from 0007).
+# - (project, NULL) holds the stats for a project.
+# - (project, observation) holds the stats for an observation.
+
+# Only possible when using a Postgres 16 backend (UNIQUE NULLS NOT DISTINCT).
+
+import importlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+incremental_stats = importlib.import_module("candidate_app.migrations.0007_incremental_candidate_min_max_stats")
+
+STATS_FIELD_NAMES = incremental_stats.STATS_FIELD_NAMES
+STATS_AGGREGATES = incremental_stats.STATS_AGGREGATES
+STATS_REPLACE = incremental_stats.STATS_REPLACE
+STATS_WIDEN = incremental_stats.STATS_WIDEN
+STATS_TRIGGER_COLUMNS = incremental_stats.STATS_TRIGGER_COLUMNS
+
+# All three scopes are aggregated in a single pass over the candidates.
+SCOPES = "GROUPING SETS ((), (project_id), (project_id, observation_id))"
+
+DROP_UNSCOPED_FUNCTIONS = """
+DROP TRIGGER IF EXISTS mark_candidate_min_max_stats_dirty_on_update_trigger ON candidate_app_candidate;
+DROP TRIGGER IF EXISTS mark_candidate_min_max_stats_dirty_on_delete_trigger ON candidate_app_candidate;
+DROP TRIGGER IF EXISTS widen_candidate_min_max_stats_trigger ON candidate_app_candidate;
+DROP FUNCTION IF EXISTS mark_candidate_min_max_stats_dirty();
+DROP FUNCTION IF EXISTS widen_candidate_min_max_stats();
+DROP FUNCTION IF EXISTS recompute_candidate_min_max_stats();
+"""
+
+ADD_SCOPE_COLUMNS = """
+ALTER TABLE candidate_min_max_stats ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (START WITH 2);
+
+ALTER TABLE candidate_min_max_stats
+    ADD COLUMN project_id uuid NULL REFERENCES candidate_app_project (hash_id) ON DELETE CASCADE,
+    ADD COLUMN observation_id uuid NULL REFERENCES candidate_app_observation (hash_id) ON DELETE CASCADE;
+
+-- Also the index used to look up the stats for a project or observation.
+ALTER TABLE candidate_min_max_stats
+    ADD CONSTRAINT candidate_min_max_stats_scope_key UNIQUE NULLS NOT DISTINCT (project_id, observation_id);
+"""
+
+REMOVE_SCOPE_COLUMNS = """
+DELETE FROM candidate_min_max_stats WHERE project_id IS NOT NULL;
+
+ALTER TABLE candidate_min_max_stats DROP CONSTRAINT candidate_min_max_stats_scope_key;
+ALTER TABLE candidate_min_max_stats DROP COLUMN observation_id, DROP COLUMN project_id;
+ALTER TABLE candidate_min_max_stats ALTER COLUMN id DROP IDENTITY;
+"""
+
+# Full recompute of every scope, removing the stats of projects and observations that no longer have candidates.
+CREATE_RECOMPUTE_FUNCTION = f"""
+CREATE FUNCTION recompute_candidate_min_max_stats() RETURNS void
+AS $$
+BEGIN
+    DELETE FROM candidate_min_max_stats AS stats
+    WHERE stats.project_id IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM candidate_app_candidate AS cand
+        WHERE cand.project_id = stats.project_id
+        AND (stats.observation_id IS NULL OR cand.observation_id = stats.observation_id)
+    );
+
+    INSERT INTO candidate_min_max_stats (project_id, observation_id, {STATS_FIELD_NAMES}, dirty)
+    SELECT project_id, observation_id, {STATS_AGGREGATES}, false
+    FROM candidate_app_candidate
+    GROUP BY {SCOPES}
+    ON CONFLICT ON CONSTRAINT candidate_min_max_stats_scope_key DO UPDATE SET
+        {STATS_REPLACE},
+        dirty = false;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT recompute_candidate_min_max_stats();
+"""
+
+# Widen the bounds of every scope touched by the inserted rows.
+CREATE_WIDEN_FUNCTION = f"""
+CREATE FUNCTION widen_candidate_min_max_stats() RETURNS trigger
+AS $$
+BEGIN
+    INSERT INTO candidate_min_max_stats AS stats (project_id, observation_id, {STATS_FIELD_NAMES}, dirty)
+    SELECT project_id, observation_id, {STATS_AGGREGATES}, false
+    FROM new_candidates
+    GROUP BY {SCOPES}
+    ON CONFLICT ON CONSTRAINT candidate_min_max_stats_scope_key DO UPDATE SET
+        {STATS_WIDEN};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER widen_candidate_min_max_stats_trigger
+AFTER INSERT ON candidate_app_candidate
+REFERENCING NEW TABLE AS new_candidates
+FOR EACH STATEMENT EXECUTE FUNCTION widen_candidate_min_max_stats();
+"""
+
+# Deletes only mark the scopes of the deleted rows as dirty. Transition tables can't be used with a column list so
+# updates of the statistic columns mark every scope.
+CREATE_MARK_DIRTY_FUNCTIONS = f"""
+CREATE FUNCTION mark_deleted_candidate_min_max_stats_dirty() RETURNS trigger
+AS $$
+BEGIN
+    UPDATE candidate_min_max_stats AS stats SET dirty = true
+    WHERE NOT stats.dirty AND (
+        stats.project_id IS NULL
+        OR (stats.observation_id IS NULL AND stats.project_id IN (SELECT project_id FROM old_candidates))
+        OR stats.observation_id IN (SELECT observation_id FROM old_candidates)
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mark_candidate_min_max_stats_dirty_on_delete_trigger
+AFTER DELETE ON candidate_app_candidate
+REFERENCING OLD TABLE AS old_candidates
+FOR EACH STATEMENT EXECUTE FUNCTION mark_deleted_candidate_min_max_stats_dirty();
+
+CREATE FUNCTION mark_candidate_min_max_stats_dirty() RETURNS trigger
+AS $$
+BEGIN
+    UPDATE candidate_min_max_stats SET dirty = true WHERE NOT dirty;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mark_candidate_min_max_stats_dirty_on_update_trigger
+AFTER UPDATE OF {STATS_TRIGGER_COLUMNS} ON candidate_app_candidate
+FOR EACH STATEMENT EXECUTE FUNCTION mark_candidate_min_max_stats_dirty();
+"""
+
+DROP_SCOPED_FUNCTIONS = """
+DROP TRIGGER IF EXISTS mark_candidate_min_max_stats_dirty_on_update_trigger ON candidate_app_candidate;
+DROP TRIGGER IF EXISTS mark_candidate_min_max_stats_dirty_on_delete_trigger ON candidate_app_candidate;
+DROP TRIGGER IF EXISTS widen_candidate_min_max_stats_trigger ON candidate_app_candidate;
+DROP FUNCTION IF EXISTS mark_candidate_min_max_stats_dirty();
+DROP FUNCTION IF EXISTS mark_deleted_candidate_min_max_stats_dirty();
+DROP FUNCTION IF EXISTS widen_candidate_min_max_stats();
+DROP FUNCTION IF EXISTS recompute_candidate_min_max_stats();
+"""
+
+
+class Migration(migrations.Migration):
+
+    initial = False
+
+    dependencies = [("candidate_app", "0007_incremental_candidate_min_max_stats")]
+
+    operations = [
+        # Drop the single row functions and triggers, and put them back when reversing.
+        migrations.RunSQL(
+            DROP_UNSCOPED_FUNCTIONS,
+            [
+                incremental_stats.CREATE_RECOMPUTE_FUNCTION,
+                incremental_stats.CREATE_WIDEN_FUNCTION,
+                incremental_stats.CREATE_MARK_DIRTY_FUNCTION,
+            ],
+        ),
+        migrations.RunSQL(ADD_SCOPE_COLUMNS, REMOVE_SCOPE_COLUMNS),
+        migrations.RunSQL(
+            [CREATE_RECOMPUTE_FUNCTION, CREATE_WIDEN_FUNCTION, CREATE_MARK_DIRTY_FUNCTIONS],
+            DROP_SCOPED_FUNCTIONS,
+        ),
+        migrations.AddField(
+            model_name="candidateminmaxstats",
+            name="project",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="min_max_stats",
+                to="candidate_app.project",
+            ),
+        ),
+        migrations.AddField(
+            model_name="candidateminmaxstats",
+            name="observation",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="min_max_stats",
+                to="candidate_app.observation",
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0008_scoped_candidate_min_max_stats"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="candidate",
+            index=models.Index(
+                fields=["name", "hash_id"], name="candidate_name_keyset_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="rating",
+            index=models.Index(
+                fields=["date", "hash_id"], name="rating_date_keyset_idx"
+            ),
+        ),
+    ]
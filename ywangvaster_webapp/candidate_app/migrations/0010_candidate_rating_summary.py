@@ -0,0 +1,81 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Fill in the rating summary of the candidates that already have ratings, from their latest rating.
+BACKFILL_RATING_SUMMARY = """
+UPDATE candidate_app_candidate AS cand
+SET rating_count = latest.rating_count,
+    last_rating = latest.rating,
+    last_tag_id = latest.tag_id,
+    last_rated_at = latest.date
+FROM (
+    SELECT DISTINCT ON (candidate_id)
+        candidate_id, rating, tag_id, date, COUNT(*) OVER (PARTITION BY candidate_id) AS rating_count
+    FROM candidate_app_rating
+    ORDER BY candidate_id, date DESC
+) AS latest
+WHERE cand.hash_id = latest.candidate_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0009_keyset_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="candidate",
+            name="last_rated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="candidate",
+            name="last_rating",
+            field=models.CharField(
+                blank=True,
+                choices=[("T", "true"), ("F", "false"), ("U", "unsure")],
+                max_length=1,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="candidate",
+            name="last_tag",
+            field=models.ForeignKey(
+                blank=True,
+                default=None,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="cand_last_tag",
+                to="candidate_app.tag",
+            ),
+        ),
+        migrations.AddField(
+            model_name="candidate",
+            name="rating_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(BACKFILL_RATING_SUMMARY, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name="candidate",
+            index=models.Index(
+                fields=["project", "rating_count"], name="candidate_proj_rating_cnt_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="candidate",
+            index=models.Index(
+                fields=["project", "last_rating"], name="candidate_proj_last_rating_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="candidate",
+            index=models.Index(
+                fields=["project", "last_tag"], name="candidate_proj_last_tag_idx"
+            ),
+        ),
+    ]
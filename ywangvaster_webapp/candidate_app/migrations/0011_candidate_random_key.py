@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:11
+
+import candidate_app.models
+from django.db import migrations, models
+
+# The default is only evaluated once for the existing rows, give each of them its own key.
+RANDOMISE_KEYS = "UPDATE candidate_app_candidate SET random_key = random();"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0010_candidate_rating_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="candidate",
+            name="claimed_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="candidate",
+            name="random_key",
+            field=models.FloatField(default=candidate_app.models.random_key),
+        ),
+        migrations.RunSQL(RANDOMISE_KEYS, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name="candidate",
+            index=models.Index(
+                condition=models.Q(("rating_count", 0)),
+                fields=["project", "random_key"],
+                name="candidate_unrated_proj_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="candidate",
+            index=models.Index(
+                condition=models.Q(("rating_count", 0)),
+                fields=["random_key"],
+                name="candidate_unrated_idx",
+            ),
+        ),
+    ]
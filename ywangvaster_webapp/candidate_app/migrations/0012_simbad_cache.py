@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0011_candidate_random_key"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SimbadObject",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "main_id",
+                    models.CharField(
+                        max_length=256,
+                        unique=True,
+                        verbose_name="Simbad main identifier",
+                    ),
+                ),
+                ("ra_str", models.CharField(max_length=32)),
+                ("dec_str", models.CharField(max_length=32)),
+                ("ra", models.FloatField(verbose_name="Right Ascension (ICRS, deg)")),
+                ("dec", models.FloatField(verbose_name="Declination (ICRS, deg)")),
+                ("fetched_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="SimbadRegion",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "ra",
+                    models.FloatField(
+                        verbose_name="Right Ascension of the centre (ICRS, deg)"
+                    ),
+                ),
+                (
+                    "dec",
+                    models.FloatField(
+                        verbose_name="Declination of the centre (ICRS, deg)"
+                    ),
+                ),
+                ("radius_arcmin", models.FloatField()),
+                ("fetched_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        # q3c indexes for the cone searches on the cached objects and the queried regions.
+        migrations.RunSQL(
+            ["CREATE INDEX ON candidate_app_simbadobject (q3c_ang2ipix(ra, dec));"],
+            ["DROP INDEX candidate_app_simbadobject_q3c_ang2ipix_idx;"],
+        ),
+        migrations.RunSQL(
+            ["CREATE INDEX ON candidate_app_simbadregion (q3c_ang2ipix(ra, dec));"],
+            ["DROP INDEX candidate_app_simbadregion_q3c_ang2ipix_idx;"],
+        ),
+    ]
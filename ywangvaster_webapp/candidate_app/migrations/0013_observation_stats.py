@@ -0,0 +1,229 @@
+# Keep the counts and file totals shown on the site admin page in a table with a row per observation, so the page
+# doesn't need to count the beams, candidates and ratings of every observation on each load.
+
+# - Inserts and deletes of beams and candidates add to or subtract from the stats of their observations, using
+#   statement level triggers with transition tables so bulk creates and cascading deletes are a single update.
+# - Updates of the rating summary or file totals of a candidate (one row at a time) move the old values out of the
+#   stats and the new values in.
+# - rebuild_observation_stats() recomputes every row, run by the "rebuild_observation_stats" management command.
+
+# Only possible when using a Postgres backend.
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+STATS_TABLE = "candidate_app_observationstats"
+STATS_COLUMNS = [
+    "beam_count",
+    "candidate_count",
+    "rated_candidate_count",
+    "ratings_count",
+    "total_file_count",
+    "total_file_size_bytes",
+]
+
+
+def stats_values(table: str, beams: bool) -> str:
+    """Aggregates of the beams or candidates in a table, in the order of STATS_COLUMNS, grouped by observation."""
+
+    if beams:
+        counts = "COUNT(*), 0, 0, 0"
+    else:
+        counts = "0, COUNT(*), COUNT(*) FILTER (WHERE rating_count > 0), COALESCE(SUM(rating_count), 0)"
+
+    return f"""
+    SELECT observation_id, {counts},
+        COALESCE(SUM(total_file_count), 0), COALESCE(SUM(total_file_size_bytes), 0)
+    FROM {table}
+    GROUP BY observation_id"""
+
+
+def row_values(row: str, beams: bool) -> str:
+    """Values of a single beam or candidate row (OLD or NEW), in the order of STATS_COLUMNS."""
+
+    if beams:
+        counts = "1, 0, 0, 0"
+    else:
+        counts = f"0, 1, CASE WHEN {row}.rating_count > 0 THEN 1 ELSE 0 END, {row}.rating_count"
+
+    return f"{counts}, COALESCE({row}.total_file_count, 0), COALESCE({row}.total_file_size_bytes, 0)"
+
+
+STATS_COLUMN_NAMES = ", ".join(STATS_COLUMNS)
+STATS_ADD = ", ".join(f"{c} = stats.{c} + EXCLUDED.{c}" for c in STATS_COLUMNS)
+STATS_SUBTRACT = ", ".join(f"{c} = stats.{c} - removed.{c}" for c in STATS_COLUMNS)
+
+
+def create_trigger_functions(name: str, table: str, beams: bool, update_columns: str) -> str:
+    """Functions and triggers adding the inserted rows of a table to the stats, and subtracting deleted and updated rows."""
+
+    return f"""
+CREATE FUNCTION add_{name}_to_observation_stats() RETURNS trigger
+AS $$
+BEGIN
+    INSERT INTO {STATS_TABLE} AS stats (observation_id, {STATS_COLUMN_NAMES})
+    {stats_values(f"new_{name}", beams)}
+    ON CONFLICT (observation_id) DO UPDATE SET
+        {STATS_ADD};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER add_{name}_to_observation_stats_trigger
+AFTER INSERT ON {table}
+REFERENCING NEW TABLE AS new_{name}
+FOR EACH STATEMENT EXECUTE FUNCTION add_{name}_to_observation_stats();
+
+-- Only updates the existing stats, the stats of an observation being deleted may already be gone.
+CREATE FUNCTION subtract_{name}_from_observation_stats() RETURNS trigger
+AS $$
+BEGIN
+    UPDATE {STATS_TABLE} AS stats SET
+        {STATS_SUBTRACT}
+    FROM ({stats_values(f"old_{name}", beams)}
+    ) AS removed (observation_id, {STATS_COLUMN_NAMES})
+    WHERE stats.observation_id = removed.observation_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER subtract_{name}_from_observation_stats_trigger
+AFTER DELETE ON {table}
+REFERENCING OLD TABLE AS old_{name}
+FOR EACH STATEMENT EXECUTE FUNCTION subtract_{name}_from_observation_stats();
+
+CREATE FUNCTION update_{name}_in_observation_stats() RETURNS trigger
+AS $$
+BEGIN
+    UPDATE {STATS_TABLE} AS stats SET
+        {STATS_SUBTRACT}
+    FROM (SELECT OLD.observation_id, {row_values("OLD", beams)}) AS removed (observation_id, {STATS_COLUMN_NAMES})
+    WHERE stats.observation_id = removed.observation_id;
+
+    INSERT INTO {STATS_TABLE} AS stats (observation_id, {STATS_COLUMN_NAMES})
+    SELECT NEW.observation_id, {row_values("NEW", beams)}
+    ON CONFLICT (observation_id) DO UPDATE SET
+        {STATS_ADD};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_{name}_in_observation_stats_trigger
+AFTER UPDATE OF {update_columns} ON {table}
+FOR EACH ROW EXECUTE FUNCTION update_{name}_in_observation_stats();
+"""
+
+
+def drop_trigger_functions(name: str, table: str) -> str:
+    return f"""
+DROP TRIGGER IF EXISTS add_{name}_to_observation_stats_trigger ON {table};
+DROP TRIGGER IF EXISTS subtract_{name}_from_observation_stats_trigger ON {table};
+DROP TRIGGER IF EXISTS update_{name}_in_observation_stats_trigger ON {table};
+DROP FUNCTION IF EXISTS add_{name}_to_observation_stats();
+DROP FUNCTION IF EXISTS subtract_{name}_from_observation_stats();
+DROP FUNCTION IF EXISTS update_{name}_in_observation_stats();
+"""
+
+
+# Every new observation starts with a row of zeros.
+CREATE_OBSERVATION_TRIGGER = f"""
+CREATE FUNCTION add_observation_stats() RETURNS trigger
+AS $$
+BEGIN
+    INSERT INTO {STATS_TABLE} (observation_id)
+    SELECT hash_id FROM new_observations
+    ON CONFLICT (observation_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER add_observation_stats_trigger
+AFTER INSERT ON candidate_app_observation
+REFERENCING NEW TABLE AS new_observations
+FOR EACH STATEMENT EXECUTE FUNCTION add_observation_stats();
+"""
+
+DROP_OBSERVATION_TRIGGER = """
+DROP TRIGGER IF EXISTS add_observation_stats_trigger ON candidate_app_observation;
+DROP FUNCTION IF EXISTS add_observation_stats();
+"""
+
+# The lock waits for any transactions that have already changed the stats, and holds off new changes until the
+# rebuild is done.
+CREATE_REBUILD_FUNCTION = f"""
+CREATE FUNCTION rebuild_observation_stats() RETURNS void
+AS $$
+BEGIN
+    LOCK TABLE {STATS_TABLE} IN EXCLUSIVE MODE;
+
+    DELETE FROM {STATS_TABLE};
+
+    INSERT INTO {STATS_TABLE} (observation_id, {STATS_COLUMN_NAMES})
+    SELECT obs.hash_id,
+        COALESCE(beam.beam_count, 0),
+        COALESCE(cand.candidate_count, 0),
+        COALESCE(cand.rated_candidate_count, 0),
+        COALESCE(cand.ratings_count, 0),
+        COALESCE(beam.total_file_count, 0) + COALESCE(cand.total_file_count, 0),
+        COALESCE(beam.total_file_size_bytes, 0) + COALESCE(cand.total_file_size_bytes, 0)
+    FROM candidate_app_observation AS obs
+    LEFT JOIN ({stats_values("candidate_app_beam", True)}
+    ) AS beam (observation_id, {STATS_COLUMN_NAMES}) ON beam.observation_id = obs.hash_id
+    LEFT JOIN ({stats_values("candidate_app_candidate", False)}
+    ) AS cand (observation_id, {STATS_COLUMN_NAMES}) ON cand.observation_id = obs.hash_id;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_observation_stats();
+"""
+
+DROP_REBUILD_FUNCTION = "DROP FUNCTION IF EXISTS rebuild_observation_stats();"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0012_simbad_cache"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ObservationStats",
+            fields=[
+                (
+                    "observation",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to="candidate_app.observation",
+                    ),
+                ),
+                ("beam_count", models.IntegerField(db_default=0)),
+                ("candidate_count", models.IntegerField(db_default=0)),
+                ("rated_candidate_count", models.IntegerField(db_default=0)),
+                ("ratings_count", models.IntegerField(db_default=0)),
+                ("total_file_count", models.BigIntegerField(db_default=0)),
+                ("total_file_size_bytes", models.BigIntegerField(db_default=0)),
+            ],
+        ),
+        migrations.RunSQL(CREATE_OBSERVATION_TRIGGER, DROP_OBSERVATION_TRIGGER),
+        migrations.RunSQL(
+            create_trigger_functions(
+                "beams", "candidate_app_beam", True, "observation_id, total_file_count, total_file_size_bytes"
+            ),
+            drop_trigger_functions("beams", "candidate_app_beam"),
+        ),
+        migrations.RunSQL(
+            create_trigger_functions(
+                "candidates",
+                "candidate_app_candidate",
+                False,
+                "observation_id, rating_count, total_file_count, total_file_size_bytes",
+            ),
+            drop_trigger_functions("candidates", "candidate_app_candidate"),
+        ),
+        # Fill in the stats of the existing observations.
+        migrations.RunSQL(CREATE_REBUILD_FUNCTION, DROP_REBUILD_FUNCTION),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:22
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0013_observation_stats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QueuedFileDeletion",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("path", models.CharField(max_length=1024)),
+                ("queued_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0014_queued_file_deletion"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProjectDiskUsage",
+            fields=[
+                (
+                    "project",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="disk_usage",
+                        serialize=False,
+                        to="candidate_app.project",
+                    ),
+                ),
+                ("file_count", models.BigIntegerField(default=0)),
+                ("size_bytes", models.BigIntegerField(default=0)),
+                ("orphan_count", models.BigIntegerField(default=0)),
+                ("orphan_size_bytes", models.BigIntegerField(default=0)),
+                ("missing_count", models.BigIntegerField(default=0)),
+                ("size_mismatch_count", models.BigIntegerField(default=0)),
+                ("scanned_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
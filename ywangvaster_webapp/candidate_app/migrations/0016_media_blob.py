@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0015_project_disk_usage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MediaBlob",
+            fields=[
+                (
+                    "sha256",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("name", models.CharField(max_length=1024, unique=True)),
+                ("size", models.BigIntegerField()),
+                ("ref_count", models.IntegerField(default=0)),
+            ],
+        ),
+    ]
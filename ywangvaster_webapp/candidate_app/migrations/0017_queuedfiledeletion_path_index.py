@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("candidate_app", "0016_media_blob"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="queuedfiledeletion",
+            name="path",
+            field=models.CharField(db_index=True, max_length=1024),
+        ),
+    ]
@@ -1,9 +1,15 @@
 import os
 import uuid
+import random
+import hashlib
+import itertools
+import threading
+from collections import Counter
 from django.utils import timezone
 
-from django.db import models
+from django.db import connection, models, transaction
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.utils.functional import cached_property
 
 
@@ -27,6 +33,78 @@ def cand_upload_path(instance, filename):
     return os.path.join(f"{instance.project.id}", f"{instance.obs_id}", f"{instance.beam.index}", filename)
 
 
+def random_key():
+    """Random sort key in [0, 1) for picking records at random."""
+
+    return random.random()
+
+
+def sum_file_totals(beams: models.QuerySet, candidates: models.QuerySet) -> dict:
+    """Add up the file counts and sizes of beams and candidates in the DB, with one aggregate query for each."""
+
+    totals = {"total_file_count": 0, "total_file_size_bytes": 0}
+    for records in (beams, candidates):
+        record_totals = records.aggregate(
+            total_file_count=models.Sum("total_file_count", default=0),
+            total_file_size_bytes=models.Sum("total_file_size_bytes", default=0),
+        )
+        for key, value in record_totals.items():
+            totals[key] += value
+
+    return totals
+
+
+def count_references(paths: list) -> Counter:
+    """Count how many file fields of the beams and candidates hold each of the paths, as of now."""
+
+    wanted = set(paths)
+    counts = Counter()
+    for model in (Beam, Candidate):
+        query = models.Q()
+        for field in model.FILE_FIELDS:
+            query |= models.Q(**{f"{field}__in": paths})
+        for row in model.objects.filter(query).values_list(*model.FILE_FIELDS):
+            counts.update(path for path in row if path in wanted)
+
+    return counts
+
+
+def referenced_paths(paths: list) -> set:
+    """Find which of the paths are held by the file fields of any beam or candidate, as of now."""
+
+    return set(count_references(paths))
+
+
+def delete_candidates(candidates: models.QuerySet) -> int:
+    """Delete candidates and their ratings in bulk, queueing their files for the delete_queued_files command.
+
+    Each table is deleted with a statement per batch of primary keys instead of loading and deleting the records one
+    at a time. The files are queued in the same transaction as the delete, so they are only removed once the records
+    are gone.
+
+    :return: The number of files queued."""
+
+    with transaction.atomic():
+        queued = QueuedFileDeletion.queue(candidates, Candidate.FILE_FIELDS)
+        Rating.objects.filter(candidate__in=candidates).delete()
+        candidates.only("pk").delete()
+
+    return queued
+
+
+def delete_beams(beams: models.QuerySet) -> int:
+    """Delete beams and their candidates in bulk, queueing their files for the delete_queued_files command.
+
+    :return: The number of files queued."""
+
+    with transaction.atomic():
+        queued = delete_candidates(Candidate.objects.filter(beam__in=beams))
+        queued += QueuedFileDeletion.queue(beams, Beam.FILE_FIELDS)
+        beams.only("pk").delete()
+
+    return queued
+
+
 class Upload(models.Model):
 
     hash_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -54,34 +132,26 @@ class Project(models.Model):
         return f"{self.id}"
 
     @cached_property
+    def file_totals(self) -> dict:
+        """Return the total number and size in bytes of all the files associated with this record."""
+        return sum_file_totals(Beam.objects.filter(project=self), Candidate.objects.filter(project=self))
+
+    @property
     def total_file_size_gb(self):
         """Return the total size of all the files in gigabytes associated this record."""
-        total_size = 0
-        beams = Beam.objects.filter(project=self)
-        candidates = Candidate.objects.filter(project=self)
-
-        for beam in beams:
-            total_size += beam.total_file_size_bytes
+        return self.file_totals["total_file_size_bytes"] / (1024.0**3)
 
-        for candidate in candidates:
-            total_size += candidate.total_file_size_bytes
-
-        return total_size / (1024.0**3)
-
-    @cached_property
+    @property
     def total_file_count(self):
         """Return the total number of files that are for this record."""
-        total_file_count = 0
-        beams = Beam.objects.filter(observation=self)
-        candidates = Candidate.objects.filter(observation=self)
-
-        for beam in beams:
-            total_file_count += beam.total_file_count
+        return self.file_totals["total_file_count"]
 
-        for candidate in candidates:
-            total_file_count += candidate.total_file_count
-
-        return total_file_count
+    def delete(self, *args, **kwargs):
+        # The cascade would skip the file cleanup of the beams and candidates, so they are deleted first.
+        with transaction.atomic():
+            delete_candidates(Candidate.objects.filter(project=self))
+            delete_beams(Beam.objects.filter(project=self))
+            return super(Project, self).delete(*args, **kwargs)
 
 
 class Observation(models.Model):
@@ -99,34 +169,26 @@ class Observation(models.Model):
     upload = models.ForeignKey(Upload, on_delete=models.CASCADE, related_name="obs_upload", default=None)
 
     @cached_property
+    def file_totals(self) -> dict:
+        """Return the total number and size in bytes of all the files associated with this record."""
+        return sum_file_totals(Beam.objects.filter(observation=self), Candidate.objects.filter(observation=self))
+
+    @property
     def total_file_size_gb(self):
         """Return the total size of all the files in gigabytes associated with this record."""
-        total_size = 0
-        beams = Beam.objects.filter(observation=self)
-        candidates = Candidate.objects.filter(observation=self)
-
-        for beam in beams:
-            total_size += beam.total_file_size_bytes
+        return self.file_totals["total_file_size_bytes"] / (1024.0**3)
 
-        for candidate in candidates:
-            total_size += candidate.total_file_size_bytes
-
-        return total_size / (1024.0**3)
-
-    @cached_property
+    @property
     def total_file_count(self):
         """Return the total number of files that are for this record."""
-        total_file_count = 0
-        beams = Beam.objects.filter(observation=self)
-        candidates = Candidate.objects.filter(observation=self)
-
-        for beam in beams:
-            total_file_count += beam.total_file_count
-
-        for candidate in candidates:
-            total_file_count += candidate.total_file_count
+        return self.file_totals["total_file_count"]
 
-        return total_file_count
+    def delete(self, *args, **kwargs):
+        # The cascade would skip the file cleanup of the beams and candidates, so they are deleted first.
+        with transaction.atomic():
+            delete_candidates(Candidate.objects.filter(observation=self))
+            delete_beams(Beam.objects.filter(observation=self))
+            return super(Observation, self).delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.id} ({self.project.id})"
@@ -180,15 +242,11 @@ class Beam(models.Model):
     ]
 
     def delete(self, *args, **kwargs):
-        # Delete associated files
-        for field in self.FILE_FIELDS:
-            file_field = getattr(self, field)
-            if file_field:
-                storage, path = file_field.storage, file_field.path
-                storage.delete(path)
-
-        # Call superclass delete method
-        super(Beam, self).delete(*args, **kwargs)
+        # Queue the files of the beam and its candidates to be removed in the background.
+        with transaction.atomic():
+            delete_candidates(Candidate.objects.filter(beam=self))
+            QueuedFileDeletion.queue(Beam.objects.filter(pk=self.pk), self.FILE_FIELDS)
+            return super(Beam, self).delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.index}"
@@ -268,6 +326,19 @@ class Candidate(models.Model):
     deep_int_flux = models.FloatField()
     md_deep = models.FloatField()
 
+    # Summary of the ratings of the candidate, kept up to date by Rating.save() and Rating.delete().
+    rating_count = models.IntegerField(default=0)
+    last_rating = models.CharField(max_length=1, choices=POSSIBLE_RATINGS, blank=True, null=True)
+    last_tag = models.ForeignKey(
+        "Tag", on_delete=models.SET_NULL, related_name="cand_last_tag", blank=True, null=True, default=None
+    )
+    last_rated_at = models.DateTimeField(blank=True, null=True)
+
+    # Random sort key used to pick a random unrated candidate with an index lookup, and when the candidate was last
+    # handed out to a rater (so it isn't handed to another rater at the same time).
+    random_key = models.FloatField(default=random_key)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+
     FILE_FIELDS = [
         "lightcurve_png",
         "slices_gif",
@@ -276,16 +347,44 @@ class Candidate(models.Model):
         "deepcutout_fits",
     ]
 
-    def delete(self, *args, **kwargs):
-        # Delete associated files
-        for field in self.FILE_FIELDS:
-            file_field = getattr(self, field)
-            if file_field:
-                storage, path = file_field.storage, file_field.path
-                storage.delete(path)
+    class Meta:
+        indexes = [
+            # Default sort key for the keyset pagination of the candidate table.
+            models.Index(fields=["name", "hash_id"], name="candidate_name_keyset_idx"),
+            # Unrated (or rated) candidates of a project, and candidates by their latest rating.
+            models.Index(fields=["project", "rating_count"], name="candidate_proj_rating_cnt_idx"),
+            models.Index(fields=["project", "last_rating"], name="candidate_proj_last_rating_idx"),
+            models.Index(fields=["project", "last_tag"], name="candidate_proj_last_tag_idx"),
+            # Random unrated candidates, within a project or over all projects.
+            models.Index(
+                fields=["project", "random_key"], condition=models.Q(rating_count=0), name="candidate_unrated_proj_idx"
+            ),
+            models.Index(fields=["random_key"], condition=models.Q(rating_count=0), name="candidate_unrated_idx"),
+        ]
+
+    def update_rating_summary(self):
+        """Recompute the rating summary columns from the ratings of this candidate.
+
+        Should be called in the same transaction as the change to the ratings. The candidate row is locked first so
+        concurrent ratings of the same candidate are applied one after the other."""
+
+        with transaction.atomic():
+            Candidate.objects.select_for_update().only("pk").get(pk=self.pk)
+
+            latest = self.rating.order_by("-date").first()
+
+            self.rating_count = self.rating.count()
+            self.last_rating = latest.rating if latest else None
+            self.last_tag_id = latest.tag_id if latest else None
+            self.last_rated_at = latest.date if latest else None
+
+            self.save(update_fields=["rating_count", "last_rating", "last_tag", "last_rated_at"])
 
-        # Call superclass delete method
-        super(Candidate, self).delete(*args, **kwargs)
+    def delete(self, *args, **kwargs):
+        # Queue the files of the candidate to be removed in the background.
+        with transaction.atomic():
+            QueuedFileDeletion.queue(Candidate.objects.filter(pk=self.pk), self.FILE_FIELDS)
+            return super(Candidate, self).delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.name}"
@@ -324,6 +423,25 @@ class Rating(models.Model):
     # TO-DO
     # Link to other resource?
 
+    class Meta:
+        indexes = [
+            # Default sort key for the keyset pagination of the ratings summary.
+            models.Index(fields=["date", "hash_id"], name="rating_date_keyset_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Keep the rating summary on the candidate in step with its ratings.
+        with transaction.atomic():
+            super(Rating, self).save(*args, **kwargs)
+            self.candidate.update_rating_summary()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            deleted = super(Rating, self).delete(*args, **kwargs)
+            self.candidate.update_rating_summary()
+
+        return deleted
+
     def __str__(self):
         return f"{self.rating}"
 
@@ -343,9 +461,41 @@ class ATNFPulsar(models.Model):
         return f"{self.name}"
 
 
+class SimbadObject(models.Model):
+    """Object from Simbad, cached so nearby objects can be listed without querying Simbad for every candidate."""
+
+    id = models.BigAutoField(primary_key=True)
+    main_id = models.CharField(verbose_name="Simbad main identifier", max_length=256, unique=True)
+    ra_str = models.CharField(max_length=32)
+    dec_str = models.CharField(max_length=32)
+    ra = models.FloatField(verbose_name="Right Ascension (ICRS, deg)")
+    dec = models.FloatField(verbose_name="Declination (ICRS, deg)")
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.main_id}"
+
+
+class SimbadRegion(models.Model):
+    """Cone that has been queried from Simbad, every Simbad object inside it was cached at fetched_at."""
+
+    id = models.BigAutoField(primary_key=True)
+    ra = models.FloatField(verbose_name="Right Ascension of the centre (ICRS, deg)")
+    dec = models.FloatField(verbose_name="Declination of the centre (ICRS, deg)")
+    radius_arcmin = models.FloatField()
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.ra:.4f} {self.dec:.4f} ({self.radius_arcmin} arcmin)"
+
+
 ### For displaying the mins and maxs for the filtering the candidate table page ###
 class CandidateMinMaxStats(models.Model):
-    """This is updated on a trigger for each insert update or delete for the candidate table."""
+    """Stats maintained by triggers on the candidate table.
+
+    There is one row over all candidates (no project or observation), one per project (no observation) and one per
+    observation. Inserts widen the bounds straight away. Deletes and updates of the statistic columns only mark the row as dirty,
+    and the bounds are recomputed from the whole table later by calling refresh()."""
 
     # Statistics - floats that are done by min-max sliders
     min_chi_square = models.FloatField(null=True, blank=True)
@@ -394,6 +544,232 @@ class CandidateMinMaxStats(models.Model):
     min_md_deep = models.FloatField(null=True, blank=True)
     max_md_deep = models.FloatField(null=True, blank=True)
 
+    # Set when candidates are deleted or updated, the bounds may be wider than they need to be until refreshed.
+    dirty = models.BooleanField(default=False)
+
+    # The scope of the stats, unique together (including nulls).
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="min_max_stats", null=True, blank=True)
+    observation = models.ForeignKey(
+        Observation, on_delete=models.CASCADE, related_name="min_max_stats", null=True, blank=True
+    )
+
     class Meta:
         managed = False  # No migrations will be created for this model
         db_table = "candidate_min_max_stats"
+
+    @classmethod
+    def refresh(cls, force: bool = False) -> bool:
+        """Recompute the stats from the whole candidate table if they have been marked as dirty.
+
+        :param force: Recompute even if the stats are not dirty.
+        :return: True if the stats were recomputed."""
+
+        if not force and not cls.objects.filter(dirty=True).exists():
+            return False
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT recompute_candidate_min_max_stats();")
+
+        return True
+
+
+class ObservationStats(models.Model):
+    """Counts and file totals of an observation for the site admin page, maintained by triggers.
+
+    Inserts and deletes of beams and candidates (including bulk creates and cascades), and changes to the rating
+    summary or file totals of a candidate, are added to the stats of the observation as they happen. rebuild()
+    recomputes the stats of every observation from scratch."""
+
+    observation = models.OneToOneField(Observation, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+
+    beam_count = models.IntegerField(db_default=0)
+    candidate_count = models.IntegerField(db_default=0)
+    rated_candidate_count = models.IntegerField(db_default=0)
+    ratings_count = models.IntegerField(db_default=0)
+
+    # Totals for the files of the beams and candidates
+    total_file_count = models.BigIntegerField(db_default=0)
+    total_file_size_bytes = models.BigIntegerField(db_default=0)
+
+    @property
+    def total_file_size_gb(self):
+        """Return the total size of all the files in gigabytes associated with the observation."""
+        return self.total_file_size_bytes / (1024.0**3)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the stats of every observation from the beam and candidate tables."""
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT rebuild_observation_stats();")
+
+
+class QueuedFileDeletion(models.Model):
+    """A media file waiting to be removed by the delete_queued_files command, queued when its record was deleted.
+
+    A row is only removed once its file is gone, so the command can be stopped at any point and carries on from where
+    it left off on the next run."""
+
+    id = models.BigAutoField(primary_key=True)
+
+    # Name of the file in the media storage, relative to MEDIA_ROOT. Indexed for MediaBlob.store to find queued
+    # deletions of the name it is saving to.
+    path = models.CharField(max_length=1024, db_index=True)
+    queued_at = models.DateTimeField(default=timezone.now)
+
+    QUEUE_BATCH_SIZE = 2000
+
+    @classmethod
+    def queue(cls, records: models.QuerySet, file_fields: list) -> int:
+        """Queue the files held in the file fields of the records for deletion, if no other record uses them.
+
+        :return: The number of files queued."""
+
+        queued = 0
+        paths = records.values_list(*file_fields).iterator(chunk_size=cls.QUEUE_BATCH_SIZE)
+        while rows := list(itertools.islice(paths, cls.QUEUE_BATCH_SIZE)):
+            # Files in the content addressed store are only deleted once no record refers to them.
+            unused = MediaBlob.release([path for row in rows for path in row if path])
+            batch = cls.objects.bulk_create([cls(path=path) for path in unused])
+            queued += len(batch)
+
+        return queued
+
+
+class ProjectDiskUsage(models.Model):
+    """Files found on disk for a project by the reconcile_media command, for the site admin page.
+
+    The files are those the beams and candidates of the project refer to, and the orphans in the project directory
+    that no beam or candidate refers to. Missing files are files that a beam or candidate refers to but which aren't
+    on disk."""
+
+    project = models.OneToOneField(Project, on_delete=models.CASCADE, primary_key=True, related_name="disk_usage")
+
+    file_count = models.BigIntegerField(default=0)
+    size_bytes = models.BigIntegerField(default=0)
+    orphan_count = models.BigIntegerField(default=0)
+    orphan_size_bytes = models.BigIntegerField(default=0)
+    missing_count = models.BigIntegerField(default=0)
+    # Beams and candidates whose files on disk don't add up to their total_file_size_bytes
+    size_mismatch_count = models.BigIntegerField(default=0)
+
+    scanned_at = models.DateTimeField(default=timezone.now)
+
+    @property
+    def size_gb(self):
+        """Return the size of the files on disk in gigabytes."""
+        return self.size_bytes / (1024.0**3)
+
+    @property
+    def orphan_size_gb(self):
+        """Return the size of the orphaned files on disk in gigabytes."""
+        return self.orphan_size_bytes / (1024.0**3)
+
+
+def blob_path(sha256: str, extension: str) -> str:
+    """Define a file path for a file in the content addressed store blobs/ab/cd/abcd...<extension>."""
+
+    return os.path.join("blobs", sha256[:2], sha256[2:4], f"{sha256}{extension}")
+
+
+# Names of the files each thread has saved to the content addressed store for a transaction not yet committed.
+_uncommitted_blob_files = threading.local()
+
+
+class MediaBlob(models.Model):
+    """A file in the content addressed store, shared by every beam and candidate file with the same contents.
+
+    ref_count is the number of file fields holding the file. It goes up when an upload stores or refers to the file
+    and down when a record holding it is deleted, and the file is queued for deletion once nothing refers to it."""
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+
+    # Name of the file in the media storage, relative to MEDIA_ROOT
+    name = models.CharField(max_length=1024, unique=True)
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+
+    @classmethod
+    def add_reference(cls, sha256: str) -> "MediaBlob":
+        """Add a reference to a file already in the store."""
+
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().get(sha256=sha256)
+            blob.ref_count += 1
+            blob.save(update_fields=["ref_count"])
+
+        return blob
+
+    @classmethod
+    def store(cls, uploaded_file) -> "MediaBlob":
+        """Add an uploaded file to the store, or a reference to it if a file with the same contents is already stored.
+
+        Uses the SHA-256 worked out by the upload handler as the file was received if there is one."""
+
+        sha256 = getattr(uploaded_file, "sha256", None)
+        if sha256 is None:
+            hash = hashlib.sha256()
+            for chunk in uploaded_file.chunks():
+                hash.update(chunk)
+            sha256 = hash.hexdigest()
+
+        if not cls.objects.filter(sha256=sha256).exists():
+            name = blob_path(sha256, os.path.splitext(uploaded_file.name)[1])
+
+            # An earlier copy of the file at the same name may still be queued for deletion, which would remove this
+            # one. Waits for a run of delete_queued_files that is removing the earlier copy right now to finish.
+            QueuedFileDeletion.objects.filter(path=name).delete()
+
+            name = default_storage.save(name, uploaded_file)
+            cls.track_uncommitted_file(name)
+
+            # Another upload of the same file may have got in first, in which case its copy is used.
+            cls.objects.bulk_create(
+                [cls(sha256=sha256, name=name, size=uploaded_file.size, ref_count=0)], ignore_conflicts=True
+            )
+            if cls.objects.get(sha256=sha256).name != name:
+                default_storage.delete(name)
+
+        return cls.add_reference(sha256)
+
+    @staticmethod
+    def track_uncommitted_file(name: str):
+        """Keep track of a file saved to the store until the transaction it was saved for is committed."""
+
+        names = _uncommitted_blob_files.__dict__.setdefault("names", set())
+        names.add(name)
+        transaction.on_commit(lambda: names.discard(name))
+
+    @staticmethod
+    def delete_uncommitted_files():
+        """Delete the files this thread saved to the store for transactions that were rolled back.
+
+        Call once the transaction has ended, the commit callbacks of a rolled back transaction never run so its files
+        are still tracked. Nothing refers to them, as the rows naming them were rolled back too."""
+
+        names = _uncommitted_blob_files.__dict__.get("names", set())
+        for name in names:
+            default_storage.delete(name)
+        names.clear()
+
+    @classmethod
+    def release(cls, paths: list) -> list:
+        """Drop a reference to the files at the paths, for records being deleted.
+
+        :return: The paths of the files that are no longer used, files in the store with no references left and files
+            from before the store was added."""
+
+        counts = Counter(paths)
+
+        with transaction.atomic():
+            # Locked in a fixed order so concurrent deletes can't deadlock
+            blobs = list(cls.objects.select_for_update().filter(name__in=counts).order_by("sha256"))
+            for blob in blobs:
+                blob.ref_count -= counts[blob.name]
+
+            unused = [blob for blob in blobs if blob.ref_count <= 0]
+            cls.objects.filter(sha256__in=[blob.sha256 for blob in unused]).delete()
+            cls.objects.bulk_update([blob for blob in blobs if blob.ref_count > 0], ["ref_count"])
+
+        stored = {blob.name for blob in blobs}
+        return [path for path in counts if path not in stored] + [blob.name for blob in unused]
@@ -1,8 +1,10 @@
 import uuid
+from typing import List
+
 from rest_framework import serializers
 
 from django.utils import timezone
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadedfile import UploadedFile
 
 from . import models
 
@@ -54,10 +56,55 @@ BEAM_FILE_FIELDS = [
 ]
 
 
+def store_uploaded_files(validated_data: dict, file_fields: List[str]) -> dict:
+    """Put the uploaded files, and the files referred to by their SHA-256 in "file_sha256", in the content addressed
+    store and make counts for the files and file sizes.
+
+    The file fields are set to the names of the stored files. The sizes are the number of bytes counted by the upload
+    handler as each file was received."""
+
+    references = validated_data.pop("file_sha256", {})
+
+    total_file_count = 0
+    total_file_size_bytes = 0
+    for file in file_fields:
+        uploaded_file: UploadedFile = validated_data.get(file)
+        if uploaded_file is not None:
+            blob = models.MediaBlob.store(uploaded_file)
+        elif file in references:
+            blob = models.MediaBlob.add_reference(references[file])
+        else:
+            continue
+
+        validated_data[file] = blob.name
+        total_file_count += 1
+        total_file_size_bytes += blob.size
+
+    return {"total_file_count": total_file_count, "total_file_size_bytes": total_file_size_bytes}
+
+
+def validate_file_references(references: dict, file_fields: List[str]) -> dict:
+    """Check that files sent by their SHA-256, rather than uploaded, are for file fields and are already stored."""
+
+    unknown_fields = set(references) - set(file_fields)
+    if unknown_fields:
+        raise serializers.ValidationError(f"Not file fields: {', '.join(sorted(unknown_fields))}")
+
+    stored = set(models.MediaBlob.objects.filter(sha256__in=references.values()).values_list("sha256", flat=True))
+    missing = [field for field, sha256 in references.items() if sha256 not in stored]
+    if missing:
+        raise serializers.ValidationError(f"Files not stored on the webapp: {', '.join(sorted(missing))}")
+
+    return references
+
+
 class BeamSerializer(serializers.ModelSerializer):
     hash_id = serializers.UUIDField(required=False)
     obs_id = serializers.CharField(write_only=True)
 
+    # SHA-256 of files already stored on the webapp, by file field, sent instead of uploading the files again.
+    file_sha256 = serializers.DictField(child=serializers.CharField(), required=False, write_only=True)
+
     # total_file_count = serializers.IntegerField(write_only=True)
     # total_file_size_bytes = serializers.IntegerField(write_only=True)
 
@@ -71,6 +118,9 @@ class BeamSerializer(serializers.ModelSerializer):
     #     data["dec_str"] = remove_leading_zero(data.get("dec_str", ""))
     #     return data
 
+    def validate_file_sha256(self, value):
+        return validate_file_references(value, BEAM_FILE_FIELDS)
+
     def create(self, validated_data):
         # Check if 'hash_id' is present; if not, generate a new UUID
         if "hash_id" not in validated_data:
@@ -85,19 +135,11 @@ class BeamSerializer(serializers.ModelSerializer):
 
         assert observation is not None, f"Failed to find observation {obs_id} in DB."
 
-        # Make counts for uploaded files and file sizes.
-        total_file_count = 0
-        total_file_size_bytes = 0
-        for file in BEAM_FILE_FIELDS:
-            uploaded_file: InMemoryUploadedFile = validated_data.get(file)
-            if uploaded_file is not None:
-                total_file_count += 1
-                total_file_size_bytes += uploaded_file.size
-        validated_data["total_file_count"] = total_file_count
-        validated_data["total_file_size_bytes"] = total_file_size_bytes
+        # Store the uploaded files and make counts for the files and file sizes.
+        validated_data.update(store_uploaded_files(validated_data, BEAM_FILE_FIELDS))
 
         print(
-            f" ---- Number of files in beam: {total_file_count}. Number of bytes for beam files: {total_file_size_bytes} ---- "
+            f" ---- Number of files in beam: {validated_data['total_file_count']}. Number of bytes for beam files: {validated_data['total_file_size_bytes']} ---- "
         )
 
         # Create the Upload metadata
@@ -118,13 +160,62 @@ CANDIDATE_FILE_FIELDS = [
 ]
 
 
+# Number of rows per INSERT statement when bulk creating candidates.
+CANDIDATE_BULK_BATCH_SIZE = 500
+
+
+class CandidateListSerializer(serializers.ListSerializer):
+    """Create a whole beam's worth of candidates at once.
+
+    The project, observation and beam are resolved once by the caller and passed in through the context, all of the
+    candidates share a single Upload record and are inserted with bulk_create."""
+
+    def create(self, validated_data):
+
+        proj = self.context["project"]
+        obs = self.context["observation"]
+        beam = self.context["beam"]
+
+        # Create the Upload metadata, shared by every candidate in this request.
+        upload = models.Upload.objects.create(
+            user=self.context["user"],
+            date=timezone.now(),
+        )
+
+        candidates = []
+        for attrs in validated_data:
+            if "hash_id" not in attrs:
+                attrs["hash_id"] = uuid.uuid4()
+
+            attrs.update(store_uploaded_files(attrs, CANDIDATE_FILE_FIELDS))
+
+            candidates.append(
+                models.Candidate(
+                    project=proj,
+                    observation=obs,
+                    beam=beam,
+                    upload=upload,
+                    **attrs,
+                )
+            )
+
+        # The files are already in the content addressed store, the FileFields only hold their names.
+        return models.Candidate.objects.bulk_create(candidates, batch_size=CANDIDATE_BULK_BATCH_SIZE)
+
+
 class CandidateSerializer(serializers.ModelSerializer):
 
     hash_id = serializers.UUIDField(required=False)
 
+    # SHA-256 of files already stored on the webapp, by file field, sent instead of uploading the files again.
+    file_sha256 = serializers.DictField(child=serializers.CharField(), required=False, write_only=True)
+
     class Meta:
         model = models.Candidate
         fields = "__all__"
+        # Maintained by the webapp from the ratings of the candidate.
+        read_only_fields = ["rating_count", "last_rating", "last_tag", "last_rated_at", "random_key", "claimed_until"]
+        list_serializer_class = CandidateListSerializer
 
     # Keep leading zero on coordinates
     # def validate(self, data):
@@ -133,6 +224,9 @@ class CandidateSerializer(serializers.ModelSerializer):
     #     data["dec_str"] = remove_leading_zero(data.get("dec_str", ""))
     #     return data
 
+    def validate_file_sha256(self, value):
+        return validate_file_references(value, CANDIDATE_FILE_FIELDS)
+
     def create(self, validated_data):
         # Check if 'hash_id' is present; if not, generate a new UUID
         if "hash_id" not in validated_data:
@@ -152,16 +246,8 @@ class CandidateSerializer(serializers.ModelSerializer):
         assert beam is not None, f"Failed to find beam {beam_index} for {obs_id} in DB."
         # validated_data["cand_obj_id"] = f"{proj.id}_{obs.id}_{beam.index}_{validated_data['name']}"
 
-        # Make counts for uploaded files and file sizes.
-        total_file_count = 0
-        total_file_size_bytes = 0
-        for file in CANDIDATE_FILE_FIELDS:
-            uploaded_file: InMemoryUploadedFile = validated_data.get(file)
-            if uploaded_file is not None:
-                total_file_count += 1
-                total_file_size_bytes += uploaded_file.size
-        validated_data["total_file_count"] = total_file_count
-        validated_data["total_file_size_bytes"] = total_file_size_bytes
+        # Store the uploaded files and make counts for the files and file sizes.
+        validated_data.update(store_uploaded_files(validated_data, CANDIDATE_FILE_FIELDS))
 
         # Create the Upload metadata
         upload = models.Upload.objects.create(
@@ -27,6 +27,20 @@ def url_replace(request, field, value, direction=""):
     return urlencode(OrderedDict(sorted(dict_.items())))
 
 
+@register.simple_tag
+def cursor_url(request, field, cursor=""):
+    """Make the query string for a page of a keyset paginated table, keeping the other parameters (eg. filters)."""
+    dict_ = request.GET.copy()
+
+    for key in ["after", "before", "page"]:
+        dict_.pop(key, None)
+
+    if field:
+        dict_[field] = cursor
+
+    return urlencode(OrderedDict(sorted(dict_.items())))
+
+
 @register.simple_tag
 def get_type_count(dictionary, key):
     # Taken from
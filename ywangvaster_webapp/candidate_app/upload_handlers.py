@@ -0,0 +1,73 @@
+"""Upload handler used for every upload to the webapp (set in FILE_UPLOAD_HANDLERS in settings.py)."""
+
+import os
+import zlib
+import hashlib
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashedUploadedFile(TemporaryUploadedFile):
+    """An uploaded file written to disk as it was received, with the SHA-256 of its contents."""
+
+    sha256 = None
+
+
+class HashingFileUploadHandler(FileUploadHandler):
+    """Stream each file of a multipart upload to disk a chunk at a time, working out its size and SHA-256 as it goes.
+
+    The files are written to FILE_UPLOAD_TEMP_DIR, which is inside MEDIA_ROOT, so saving them to their FileField
+    (beam_upload_path / cand_upload_path) is a rename rather than another copy of the data. Only a single chunk of a
+    request is held in memory at a time, however large the files are."""
+
+    chunk_size = 256 * 2**10
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+
+        # Files gzipped by the upload client on the way out (e.g. "<name>.fits.gz") are stored uncompressed.
+        self.decompressor = None
+        if self.content_type == "application/gzip" and self.file_name.endswith(".gz"):
+            self.file_name = self.file_name[: -len(".gz")]
+            self.decompressor = zlib.decompressobj(wbits=31)
+
+        os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
+        self.file = HashedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.decompressor is None:
+            self.write(raw_data)
+            return
+
+        # Decompress a chunk at a time, so a highly compressed part can't fill up memory
+        data = raw_data
+        while data:
+            self.write(self.decompressor.decompress(data, self.chunk_size))
+            data = self.decompressor.unconsumed_tail
+
+    def file_complete(self, file_size):
+        if self.decompressor is not None:
+            self.write(self.decompressor.flush())
+
+        self.file.seek(0)
+        self.file.size = self.size
+        self.file.sha256 = self.hash.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, "file"):
+            temp_location = self.file.temporary_file_path()
+            try:
+                self.file.close()
+                os.remove(temp_location)
+            except FileNotFoundError:
+                pass
@@ -1,56 +1,300 @@
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from astropy import units
 from astropy.io import fits
+from astropy.coordinates import SkyCoord
+from astroquery.simbad import Simbad, SimbadClass
+import requests.adapters
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from django import template
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Func, IntegerField, Max, Q, QuerySet, TextField
+from django.db.models.functions import Cast
+from django.core.serializers.json import DjangoJSONEncoder
 
+from django_q3c.expressions import Q3CDist, Q3CRadialQuery
+
+import io
 import os
+import csv
+import json
+import uuid
+import itertools
+import base64
 import shutil
+from datetime import timedelta
+from typing import List, Optional
 
+from . import models
 
-def FITSTableType(val):
-    """
-    Return the FITSTable type corresponding to each named parameter in obj
+# Rows fetched from the server-side cursor at a time when streaming exports.
+EXPORT_CHUNK_SIZE = 2000
+
+# Largest cone that is queried from Simbad, also used to find the cached regions around a position with the q3c index.
+SIMBAD_MAX_REGION_ARCMIN = 120.0
+
+
+# FITS formats of the model fields with a fixed size, other fields are written as strings.
+FITS_FIELD_FORMATS = {
+    "BooleanField": "L",
+    "SmallIntegerField": "K",
+    "IntegerField": "K",
+    "BigIntegerField": "K",
+    "PositiveIntegerField": "K",
+    "AutoField": "K",
+    "BigAutoField": "K",
+    "FloatField": "D",
+    "UUIDField": "36A",
+    "DateField": "10A",
+    "DateTimeField": "32A",
+}
+
+# Numpy dtypes of the FITS formats, in the big endian layout of a FITS binary table.
+FITS_DTYPES = {
+    # Logicals are stored as the characters T or F, or 0 for null
+    "L": "i1",
+    "K": ">i8",
+    "D": ">f8",
+}
+
+# Written for the null values of integer columns (TNULL).
+FITS_INT_NULL = np.iinfo(np.int64).min
+
+FITS_BLOCK_SIZE = 2880
+
+
+def get_export_field(queryset: QuerySet, name: str):
+    """Get the model field (or output field of an annotation) of a value exported from a queryset.
+
+    :param name: Field name, annotation or lookup across relations (e.g. "last_tag__name")."""
+
+    if name in queryset.query.annotations:
+        return queryset.query.annotations[name].output_field
+
+    model = queryset.model
+    *relations, name = name.split("__")
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+
+    field = model._meta.get_field(name)
+    # Foreign keys are exported as the primary key of the related record.
+    while field.is_relation:
+        field = field.target_field
+
+    return field
+
+
+def export_string(value) -> Optional[str]:
+    """Convert a value that isn't a number to the string it is exported as."""
+
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        # Non-ASCII characters are kept as they are, like the JSON text the DB sizes FITS columns by.
+        return json.dumps(value, ensure_ascii=False)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+class OctetLength(Func):
+    """Length of a string in bytes rather than characters."""
+
+    function = "OCTET_LENGTH"
+    output_field = IntegerField()
+
+
+def get_fits_formats(queryset: QuerySet, field_names: List[str]) -> List[str]:
+    """Get the FITS column formats of model fields from the types of the fields.
+
+    Strings (and JSON) are sized to the longest value in the queryset in UTF-8 bytes, as that is how they are written,
+    found with one query for all of them. A max_length counts characters so can't be used, it would cut short any
+    value with non-ASCII characters."""
+
+    formats = {}
+    unsized = {}
+    for name in field_names:
+        field = get_export_field(queryset, name)
+
+        internal_type = field.get_internal_type()
+        if internal_type in FITS_FIELD_FORMATS:
+            formats[name] = FITS_FIELD_FORMATS[internal_type]
+        else:
+            unsized[name] = Max(OctetLength(Cast(name, output_field=TextField())))
+
+    if unsized:
+        # Aliases by position, as field names can be lookups across relations.
+        names = list(unsized)
+        lengths = queryset.order_by().aggregate(**{f"length_{i}": unsized[name] for i, name in enumerate(names)})
+        for i, name in enumerate(names):
+            formats[name] = f"{max(lengths[f'length_{i}'] or 0, 1)}A"
+
+    return [formats[name] for name in field_names]
+
+
+def fits_column_values(values: list, fmt: str) -> list:
+    """Convert the values of a column to what is stored in a FITS binary table column of the format."""
+
+    if fmt == "L":
+        return [0 if v is None else ord("T") if v else ord("F") for v in values]
+    if fmt == "K":
+        return [FITS_INT_NULL if v is None else v for v in values]
+    if fmt == "D":
+        return [np.nan if v is None else v for v in values]
+
+    # Values too long for the column (e.g. from rows added since it was sized) are cut short on a whole character.
+    width = int(fmt[:-1])
+    encoded = [(export_string(v) or "").encode("utf-8") for v in values]
+    return [e if len(e) <= width else e[:width].decode("utf-8", "ignore").encode("utf-8") for e in encoded]
+
+
+def fits_table_chunks(field_names: List[str], formats: List[str], rows, nrows: int, chunk_size: int = 2000):
+    """Yield a FITS file holding a binary table of nrows rows, a chunk of rows at a time.
+
+    Each chunk is filled column by column into a preallocated record array laid out as the FITS table, so memory use
+    depends on the number of columns and not on the number of rows. The header is written before the rows are read, so
+    any rows past nrows are dropped and missing rows are written as nulls.
+
+    :param rows: Iterable of tuples of values in the order of field_names, e.g. from values_list().
     """
-    if isinstance(val, bool):
-        types = "L"
-    elif isinstance(val, (int, np.int64, np.int32)):
-        types = "J"
-    elif isinstance(val, (float, np.float64, np.float32)):
-        types = "E"
-    elif isinstance(val, str):
-        types = "{0}A".format(len(val))
-    else:
-        types = "5A"
-    return types
 
+    columns = [
+        fits.Column(name=name, format=fmt, null=FITS_INT_NULL if fmt == "K" else None)
+        for name, fmt in zip(field_names, formats)
+    ]
+    hdu = fits.BinTableHDU.from_columns(fits.ColDefs(columns), nrows=0)
+    hdu.header["NAXIS2"] = nrows
 
-def download_fits(request, queryset, table):
+    chunk = np.zeros(
+        chunk_size, dtype=[(name, FITS_DTYPES.get(fmt, f"S{fmt[:-1]}")) for name, fmt in zip(field_names, formats)]
+    )
+    null_row = np.zeros(1, dtype=chunk.dtype)
+    for name, fmt in zip(field_names, formats):
+        if fmt == "K":
+            null_row[name] = FITS_INT_NULL
+        elif fmt == "D":
+            null_row[name] = np.nan
 
-    opts = queryset.model._meta
+    yield fits.PrimaryHDU().header.tostring().encode("ascii")
+    yield hdu.header.tostring().encode("ascii")
 
-    response = HttpResponse(content_type="application/octet-stream")
+    rows = iter(rows)
+    written = 0
+    while written < nrows:
+        size = min(chunk_size, nrows - written)
+        batch = list(itertools.islice(rows, size))
+
+        chunk[:size] = null_row
+        if batch:
+            for i, (name, fmt) in enumerate(zip(field_names, formats)):
+                chunk[name][: len(batch)] = fits_column_values([row[i] for row in batch], fmt)
+
+        yield chunk[:size].tobytes()
+        written += size
+
+    # Pad the data to a whole FITS block
+    yield bytes(-(nrows * chunk.dtype.itemsize) % FITS_BLOCK_SIZE)
+
+
+def download_fits(request, queryset: QuerySet, table: str, field_names: Optional[List[str]] = None):
+    """Stream the queryset as a FITS binary table, with a column for each field (all the fields by default).
+
+    The rows are read in a single pass through a server-side cursor."""
+
+    if field_names is None:
+        field_names = [field.name for field in queryset.model._meta.concrete_fields]
+
+    formats = get_fits_formats(queryset, field_names)
+    nrows = queryset.count()
+    rows = queryset.values_list(*field_names).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    response = StreamingHttpResponse(
+        fits_table_chunks(field_names, formats, rows, nrows, chunk_size=EXPORT_CHUNK_SIZE),
+        content_type="application/octet-stream",
+    )
     # force download.
     response["Content-Disposition"] = f'attachment; filename="{table}.fits"'
 
-    cols = []
-    for name in [field.name for field in opts.fields]:
-        # Cause error columns to always be floats even when they are set to -1
-        if name.startswith("err_"):
-            fmt = "E"
-        else:
-            fmt = FITSTableType(getattr(queryset.first(), name))
-        cols.append(
-            fits.Column(
-                name=name,
-                format=fmt,
-                array=[a[0] for a in queryset.all().values_list(name)],
-            )
-        )
+    return response
+
+
+class Echo:
+    """File-like object that returns what is written to it, to stream a csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def download_csv(queryset: QuerySet, table: str, field_names: List[str]) -> StreamingHttpResponse:
+    """Stream the fields of the queryset as a CSV file, reading the rows through a server-side cursor."""
+
+    writer = csv.writer(Echo())
 
-    cols = fits.ColDefs(cols)
-    tbhdu = fits.BinTableHDU.from_columns(cols)
-    tbhdu.writeto(response)
+    def csv_lines():
+        yield writer.writerow(field_names)
+
+        for row in queryset.values_list(*field_names).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield writer.writerow([v if isinstance(v, (int, float)) else export_string(v) for v in row])
+
+    response = StreamingHttpResponse(csv_lines(), content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{table}.csv"'
+
+    return response
+
+
+# Arrow types of the model fields, other fields are written as strings.
+ARROW_FIELD_TYPES = {
+    "BooleanField": pa.bool_(),
+    "SmallIntegerField": pa.int64(),
+    "IntegerField": pa.int64(),
+    "BigIntegerField": pa.int64(),
+    "PositiveIntegerField": pa.int64(),
+    "AutoField": pa.int64(),
+    "BigAutoField": pa.int64(),
+    "FloatField": pa.float64(),
+    "DateField": pa.date32(),
+    "DateTimeField": pa.timestamp("us", tz="UTC"),
+}
+
+
+def download_parquet(queryset: QuerySet, table: str, field_names: List[str]) -> StreamingHttpResponse:
+    """Stream the fields of the queryset as a Parquet file.
+
+    The rows are read through a server-side cursor and each chunk is written as an Arrow record batch (a row group of
+    the Parquet file), so the response starts straight away and memory use doesn't depend on the number of rows."""
+
+    schema = pa.schema(
+        [
+            (name, ARROW_FIELD_TYPES.get(get_export_field(queryset, name).get_internal_type(), pa.string()))
+            for name in field_names
+        ]
+    )
+
+    def parquet_chunks():
+        buffer = StreamBuffer()
+        rows = queryset.values_list(*field_names).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+        with pq.ParquetWriter(buffer, schema) as writer:
+            while batch := list(itertools.islice(rows, EXPORT_CHUNK_SIZE)):
+                arrays = []
+                for i, field in enumerate(schema):
+                    values = [row[i] for row in batch]
+                    if field.type == pa.string():
+                        values = [export_string(v) for v in values]
+                    arrays.append(pa.array(values, type=field.type))
+
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                yield buffer.pop()
+
+        # The footer of the file
+        yield buffer.pop()
+
+    response = StreamingHttpResponse(parquet_chunks(), content_type="application/vnd.apache.parquet")
+    response["Content-Disposition"] = f'attachment; filename="{table}.parquet"'
 
     return response
 
@@ -79,3 +323,283 @@ def count_files(directory):
         file_count += len(files)
 
     return file_count
+
+
+def encode_cursor(values: list) -> str:
+    """Encode the sort key of a row into an opaque string for the URL."""
+
+    return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decode a cursor made by encode_cursor back into the sort key values.
+
+    :raises ValueError: If the cursor wasn't made by encode_cursor, e.g. it was edited or cut short in the URL."""
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as error:
+        raise ValueError(f"Invalid cursor {cursor!r}: {error}") from error
+
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError(f"Invalid cursor {cursor!r}: not a [value, hash_id] sort key")
+
+    return values
+
+
+def get_cursor_filter(queryset: QuerySet, sort_field: str, cursor: str, lookup: str) -> Q:
+    """Filter for the rows past the sort key of a cursor, with the values checked against the types of the fields.
+
+    :raises ValueError: If the cursor is invalid or its values don't suit the fields."""
+
+    value, hash_id = decode_cursor(cursor)
+    try:
+        value = queryset.query.resolve_ref(sort_field).output_field.to_python(value)
+        hash_id = uuid.UUID(str(hash_id))
+    except (TypeError, ValidationError) as error:
+        raise ValueError(f"Invalid cursor {cursor!r}: {error}") from error
+
+    if value is None:
+        raise ValueError(f"Invalid cursor {cursor!r}: no sort value")
+
+    return Q(**{f"{sort_field}__{lookup}": value}) | Q(**{sort_field: value, f"hash_id__{lookup}": hash_id})
+
+
+def get_approximate_count(queryset: QuerySet) -> Optional[int]:
+    """Get the planner's estimate of the number of rows in a queryset, without running a COUNT(*) over it."""
+
+    try:
+        plan = json.loads(queryset.explain(format="json"))
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as error:
+        print(f"Unable to estimate the number of rows: {error}")
+        return None
+
+
+class KeysetPage:
+    """A page of results from keyset_paginate.
+
+    Iterates like a Django Page, with cursors for the next and previous pages instead of page numbers."""
+
+    def __init__(
+        self,
+        object_list: List,
+        sort_field: str,
+        has_next: bool,
+        has_previous: bool,
+        approximate_count: Optional[int] = None,
+    ):
+        self.object_list = object_list
+        self.sort_field = sort_field
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.approximate_count = approximate_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _cursor(self, obj) -> str:
+        return encode_cursor([getattr(obj, self.sort_field), str(obj.hash_id)])
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        return self._cursor(self.object_list[-1]) if self.has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self) -> Optional[str]:
+        return self._cursor(self.object_list[0]) if self.has_previous and self.object_list else None
+
+
+def keyset_paginate(
+    queryset: QuerySet,
+    sort_field: str,
+    per_page: int,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    descending: bool = False,
+    estimate_count: bool = False,
+) -> KeysetPage:
+    """Get a page of a queryset by seeking past the sort key of the last row seen, rather than with an OFFSET.
+
+    Rows are ordered by (sort_field, hash_id) so the order is stable for duplicate values of sort_field, and every
+    page costs the same no matter how deep it is. The sort field must not be nullable.
+
+    :param queryset: The filtered queryset to paginate.
+    :param sort_field: Field (or annotation) to order the rows by.
+    :param per_page: Number of rows on each page.
+    :param after: Cursor of the last row of the previous page, to get the next page.
+    :param before: Cursor of the first row of the next page, to get the previous page. An empty cursor gets the last
+        page.
+    :param descending: Order the rows from largest to smallest.
+    :param estimate_count: Add the planner's estimate of the total number of rows to the page.
+    """
+
+    approximate_count = get_approximate_count(queryset) if estimate_count else None
+
+    forward = before is None
+    cursor = after if forward else before
+
+    # Seeking towards larger values, either going forward on an ascending sort or back on a descending sort.
+    ascending_seek = forward != descending
+    direction = "" if ascending_seek else "-"
+
+    if cursor:
+        try:
+            cursor_filter = get_cursor_filter(queryset, sort_field, cursor, "gt" if ascending_seek else "lt")
+        except ValueError as error:
+            # A broken cursor from the URL shows the first page rather than an error.
+            print(f"Showing the first page: {error}")
+            return keyset_paginate(queryset, sort_field, per_page, descending=descending, estimate_count=estimate_count)
+        queryset = queryset.filter(cursor_filter)
+
+    # Get one extra row to see if there is another page after this one.
+    rows = list(queryset.order_by(f"{direction}{sort_field}", f"{direction}hash_id")[: per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if forward:
+        has_next, has_previous = has_more, cursor is not None
+    else:
+        rows.reverse()
+        has_next, has_previous = bool(cursor), has_more
+
+    return KeysetPage(rows, sort_field, has_next, has_previous, approximate_count)
+
+
+def simbad_region_is_cached(ra_deg: float, dec_deg: float, radius_arcmin: float, max_age: timedelta) -> bool:
+    """Check if a cone is inside a region that has been queried from Simbad within max_age."""
+
+    regions = (
+        models.SimbadRegion.objects.filter(
+            Q(
+                Q3CRadialQuery(
+                    center_ra=ra_deg,
+                    center_dec=dec_deg,
+                    ra_col="ra",
+                    dec_col="dec",
+                    radius=(SIMBAD_MAX_REGION_ARCMIN - radius_arcmin) / 60.0,
+                )
+            ),
+            fetched_at__gte=timezone.now() - max_age,
+        )
+        .annotate(sep_arcmin=Q3CDist(ra1=F("ra"), dec1=F("dec"), ra2=ra_deg, dec2=dec_deg) * 60)
+        .filter(sep_arcmin__lte=F("radius_arcmin") - radius_arcmin)
+    )
+
+    return regions.exists()
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that gives requests sent without a timeout a default one."""
+
+    def __init__(self, timeout: float, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def simbad_with_timeout(timeout: float) -> SimbadClass:
+    """Simbad client whose requests give up after timeout seconds.
+
+    The queries astroquery sends to the Simbad TAP service otherwise have no timeout at all."""
+
+    simbad = SimbadClass()
+    adapter = TimeoutHTTPAdapter(timeout)
+    simbad._session.mount("http://", adapter)
+    simbad._session.mount("https://", adapter)
+
+    return simbad
+
+
+def cache_simbad_region(ra_deg: float, dec_deg: float, radius_arcmin: float, simbad: SimbadClass = Simbad) -> int:
+    """Query a cone from Simbad and replace the cached Simbad objects inside it.
+
+    :param simbad: Simbad client to query with, e.g. one from simbad_with_timeout.
+    :return: The number of Simbad objects in the cone."""
+
+    radius_arcmin = min(float(radius_arcmin), SIMBAD_MAX_REGION_ARCMIN)
+    fetched_at = timezone.now()
+
+    coord = SkyCoord(ra_deg, dec_deg, unit=(units.deg, units.deg), frame="icrs")
+    result_table = simbad.query_region(coord, radius=radius_arcmin * units.arcmin)
+
+    simbad_objects = {}
+    if result_table:
+        # Some objects have no coordinates
+        result_table = result_table[~(np.ma.getmaskarray(result_table["ra"]) | np.ma.getmaskarray(result_table["dec"]))]
+
+        # Convert all the coordinates at once
+        coords = SkyCoord(result_table["ra"], result_table["dec"], unit=(units.deg, units.deg), frame="icrs")
+        ra_strs = coords.ra.to_string(unit=units.hour, sep=":", pad=True)
+        dec_strs = coords.dec.to_string(unit=units.deg, sep=":", pad=True)
+
+        for main_id, ra, dec, ra_str, dec_str in zip(
+            result_table["main_id"], coords.ra.deg, coords.dec.deg, ra_strs, dec_strs
+        ):
+            simbad_objects[str(main_id)] = models.SimbadObject(
+                main_id=str(main_id),
+                ra=float(ra),
+                dec=float(dec),
+                ra_str=ra_str[:11],
+                dec_str=dec_str[:11],
+                fetched_at=fetched_at,
+            )
+
+    in_region = Q(
+        Q3CRadialQuery(center_ra=ra_deg, center_dec=dec_deg, ra_col="ra", dec_col="dec", radius=radius_arcmin / 60.0)
+    )
+
+    with transaction.atomic():
+        models.SimbadObject.objects.bulk_create(
+            simbad_objects.values(),
+            update_conflicts=True,
+            unique_fields=["main_id"],
+            update_fields=["ra", "dec", "ra_str", "dec_str", "fetched_at"],
+        )
+
+        # Objects that Simbad no longer has in the region
+        models.SimbadObject.objects.filter(in_region, fetched_at__lt=fetched_at).delete()
+
+        # Regions inside this one are covered by it from now on
+        models.SimbadRegion.objects.filter(in_region).annotate(
+            sep_arcmin=Q3CDist(ra1=F("ra"), dec1=F("dec"), ra2=ra_deg, dec2=dec_deg) * 60
+        ).filter(sep_arcmin__lte=radius_arcmin - F("radius_arcmin")).delete()
+
+        models.SimbadRegion.objects.create(ra=ra_deg, dec=dec_deg, radius_arcmin=radius_arcmin, fetched_at=fetched_at)
+
+    return len(simbad_objects)
+
+
+class StreamBuffer(io.RawIOBase):
+    """Write only, unseekable file that holds what has been written until it is taken with pop().
+
+    Used to stream files (e.g. a zip file) that are written by libraries expecting a file object."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def pop(self) -> bytes:
+        """Take everything written since the last call."""
+
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
@@ -1,15 +1,19 @@
 import csv
 import json
+import functools
+import time
+import random
 import logging
 import zipfile
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from uuid import uuid4
-from io import StringIO, BytesIO
+from io import TextIOWrapper
 from typing import List, Optional
 from urllib.parse import urlencode
 
 from astropy import units
-from astroquery.simbad import Simbad
-from astropy.coordinates import Angle, SkyCoord
+from astropy.coordinates import Angle
 
 from django.contrib import messages
 from django.contrib.auth.forms import PasswordChangeForm
@@ -17,11 +21,11 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout, update_session_auth_hash
 
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 from django.core.paginator import Paginator
 from django.views.generic import TemplateView, View
 from django.db.models import Count, F, Q, Value, QuerySet
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 
 from django_q3c.expressions import Q3CDist, Q3CRadialQuery
@@ -31,9 +35,20 @@ from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework.authtoken.models import Token
 
-from ywangvaster_webapp.settings import MEDIA_ROOT
-
-from .utils import get_disk_space
+from ywangvaster_webapp.settings import CANDIDATE_CLAIM_MINUTES, MEDIA_ROOT, SIMBAD_CACHE_TTL_DAYS
+
+from .utils import (
+    EXPORT_CHUNK_SIZE,
+    StreamBuffer,
+    cache_simbad_region,
+    download_csv,
+    download_fits,
+    download_parquet,
+    get_disk_space,
+    keyset_paginate,
+    simbad_region_is_cached,
+    simbad_with_timeout,
+)
 from . import forms, models, serializers
 
 
@@ -88,6 +103,11 @@ DOWNLOAD_CANDIDATE_FIELDS = [
     "lightcurve_data",
 ]
 
+# Columns that can be exported from the candidate table, the separations of any cone searches can be exported too.
+EXPORT_CANDIDATE_FIELDS = DOWNLOAD_CANDIDATE_FIELDS + ["rating_count", "last_rating", "last_tag__name", "last_rated_at"]
+
+CANDIDATE_EXPORT_FORMATS = ["csv", "fits", "parquet"]
+
 FILTER_FORM_FLOAT_VARAIBLES = [
     "chi_square",
     "chi_square_log_sigma",
@@ -106,6 +126,19 @@ FILTER_FORM_FLOAT_VARAIBLES = [
     "deep_int_flux",
 ]
 
+# Columns the tables can be ordered by with the "order_by" URL parameter, these must not be nullable for keyset
+# pagination. The candidate table can also be ordered by the separation of any cone search applied.
+CANDIDATE_SORT_FIELDS = [
+    "name",
+    "ra",
+    "dec",
+    "beam_index",
+    "deep_num",
+    *[variable for variable in FILTER_FORM_FLOAT_VARAIBLES if not variable.startswith("gaussian_map")],
+]
+
+RATING_SORT_FIELDS = ["date", "rating"]
+
 FILTER_CAND_VAR_MAPPING = {
     "chi_square": "Chi Square",
     "chi_square_sigma": "Chi Square Sigma",
@@ -141,28 +174,35 @@ def home(request):
     return render(request, "candidate_app/home.html")
 
 
-def nearby_objects_table(request: HttpRequest):
-    """Render a table of nearby objects from the local DB (filtered by project), Simbad and ATNF pulsars."""
+# Seconds to wait for each source of nearby objects before leaving it out of the table.
+NEARBY_OBJECTS_TIMEOUTS = {"Simbad": 10.0, "ATNF": 5.0, "Local": 5.0}
 
-    dist_arcmin = 2
-    selected_project_hash_id = request.session.get("selected_project_hash_id")
+# Threads for the lookups of each source, shared between requests. Each source has its own pool so a slow source
+# can't hold up the others. A lookup that times out keeps running in the background (a slow Simbad query still fills
+# the Simbad cache for the next request) until it finishes or its own timeout is hit.
+NEARBY_OBJECTS_EXECUTORS = {
+    "Simbad": ThreadPoolExecutor(max_workers=8, thread_name_prefix="nearby_objects_simbad"),
+    "ATNF": ThreadPoolExecutor(max_workers=4, thread_name_prefix="nearby_objects_atnf"),
+    "Local": ThreadPoolExecutor(max_workers=4, thread_name_prefix="nearby_objects_local"),
+}
 
-    if request.method == "POST":
-        data = json.loads(request.body.decode())
+# Simbad queries give up after the time the page waits for them, so abandoned queries don't tie up the Simbad pool.
+NEARBY_SIMBAD = simbad_with_timeout(NEARBY_OBJECTS_TIMEOUTS["Simbad"])
 
-        ra_str = data.get("ra_str")
-        dec_str = data.get("dec_str")
-        dist_arcmin = float(data.get("dist_arcmin", 1))
-        selected_project_hash_id = data.get("selected_project_hash_id")
-        exclude_hash_id = data.get("exclude_id")
 
-    result = []
-    simbad_results = get_simbad(ra_str, dec_str, dist_arcmin)
+def run_in_thread_with_db(func, *args) -> List[dict]:
+    """Run a lookup in a worker thread, closing the DB connection the thread opened when done."""
+
+    try:
+        return list(func(*args))
+    finally:
+        connection.close()
 
-    result.extend(simbad_results)
 
-    atnf_results = get_atnf(ra_str, dec_str, dist_arcmin)
-    result.extend(atnf_results)
+def get_nearby_candidates(
+    ra_str: str, dec_str: str, dist_arcmin: float, selected_project_hash_id: str, exclude_hash_id: str
+) -> List[dict]:
+    """Get a list of candidates in the local DB (in the project if given) near coordinates."""
 
     if selected_project_hash_id or selected_project_hash_id != "":
         incoming = models.Candidate.objects.filter(project_id=selected_project_hash_id)
@@ -173,7 +213,7 @@ def nearby_objects_table(request: HttpRequest):
     if exclude_hash_id:
         incoming = incoming.exclude(hash_id=exclude_hash_id)
 
-    local_db_results = filter_candidates_by_coords(
+    return filter_candidates_by_coords(
         incoming,
         ra_str,
         dec_str,
@@ -183,7 +223,57 @@ def nearby_objects_table(request: HttpRequest):
         for_rating_table=True,
     )
 
-    result.extend(local_db_results)
+
+def nearby_objects_table(request: HttpRequest):
+    """Render a table of nearby objects from the local DB (filtered by project), Simbad and ATNF pulsars.
+
+    The three sources are looked up at the same time, each with its own timeout. The table shows whatever sources
+    answered in time, with the status of each source."""
+
+    dist_arcmin = 2
+    selected_project_hash_id = request.session.get("selected_project_hash_id")
+
+    if request.method == "POST":
+        data = json.loads(request.body.decode())
+
+        ra_str = data.get("ra_str")
+        dec_str = data.get("dec_str")
+        dist_arcmin = float(data.get("dist_arcmin", 1))
+        selected_project_hash_id = data.get("selected_project_hash_id")
+        exclude_hash_id = data.get("exclude_id")
+
+    start = time.monotonic()
+    lookups = {
+        "Simbad": NEARBY_OBJECTS_EXECUTORS["Simbad"].submit(
+            run_in_thread_with_db, get_simbad, ra_str, dec_str, dist_arcmin
+        ),
+        "ATNF": NEARBY_OBJECTS_EXECUTORS["ATNF"].submit(run_in_thread_with_db, get_atnf, ra_str, dec_str, dist_arcmin),
+        "Local": NEARBY_OBJECTS_EXECUTORS["Local"].submit(
+            run_in_thread_with_db,
+            get_nearby_candidates,
+            ra_str,
+            dec_str,
+            dist_arcmin,
+            selected_project_hash_id,
+            exclude_hash_id,
+        ),
+    }
+
+    result = []
+    source_status = {}
+    for source, lookup in lookups.items():
+        # The timeouts all count from the start, as the lookups run at the same time.
+        remaining = NEARBY_OBJECTS_TIMEOUTS[source] - (time.monotonic() - start)
+
+        try:
+            result.extend(lookup.result(timeout=max(remaining, 0)))
+            source_status[source] = "ok"
+        except FutureTimeoutError:
+            print(f"Nearby objects from {source} took longer than {NEARBY_OBJECTS_TIMEOUTS[source]} seconds")
+            source_status[source] = "timeout"
+        except Exception as e:
+            print(f"Unable to get nearby objects from {source}: {e}")
+            source_status[source] = "error"
 
     # Sort results by separation
     sorted_results = sorted(result, key=lambda x: x["sep"], reverse=False)
@@ -191,7 +281,7 @@ def nearby_objects_table(request: HttpRequest):
     return render(
         request,
         "candidate_app/nearby_objects_table.html",
-        context={"result_table": sorted_results},
+        context={"result_table": sorted_results, "source_status": source_status},
     )
 
 
@@ -232,7 +322,10 @@ def get_atnf(ra_str: str, dec_str, dist_arcmin: float = 1.0) -> List[dict]:
 
 
 def get_simbad(ra_str: str, dec_str: str, dist_arcmin: float = 1.0) -> List[dict]:
-    """Get a list of object next to candidate with ra_str and dec_str"""
+    """Get a list of Simbad objects next to candidate with ra_str and dec_str from the local Simbad cache.
+
+    Simbad is only queried if the region hasn't been cached within the last SIMBAD_CACHE_TTL_DAYS. If Simbad can't be
+    reached the objects that are already cached are used."""
 
     ra_deg = Angle(ra_str, unit=units.hour).deg
     dec_deg = Angle(dec_str, unit=units.deg).deg
@@ -241,28 +334,41 @@ def get_simbad(ra_str: str, dec_str: str, dist_arcmin: float = 1.0) -> List[dict
     # limit query distance or we get very long timeouts
     dist_arcmin = min(dist_arcmin, 60)
 
-    coord = SkyCoord(ra_deg, dec_deg, unit=(units.deg, units.deg), frame="icrs")
-    # Perform simbad query
-    raw_result_table = Simbad.query_region(coord, radius=dist_arcmin * units.arcmin)
-    simbad_result_table = []
-    # Reformat the result into the format we want
-    if raw_result_table:
-        for result in raw_result_table:
-            search_term = result["main_id"].replace("+", "%2B").replace(" ", "+")
-            simbad_coord = SkyCoord(result["ra"], result["dec"], unit=(units.hour, units.deg), frame="icrs")
-            ra = simbad_coord.ra.to_string(unit=units.hour, sep=":", pad=True)[:11]
-            dec = simbad_coord.dec.to_string(unit=units.deg, sep=":", pad=True)[:11]
-            sep = coord.separation(simbad_coord).arcsec
-            simbad_result_table.append(
-                {
-                    "name": result["main_id"],
-                    "search_term": search_term,
-                    "ra_str": ra,
-                    "dec_str": dec,
-                    "sep": sep,
-                    "from_db": "Simbad",
-                }
+    if not simbad_region_is_cached(ra_deg, dec_deg, dist_arcmin, timedelta(days=SIMBAD_CACHE_TTL_DAYS)):
+        try:
+            cache_simbad_region(ra_deg, dec_deg, dist_arcmin, NEARBY_SIMBAD)
+        except Exception as e:
+            print(f"Unable to query Simbad, using the cached objects instead: {e}")
+
+    simbad_objects = (
+        models.SimbadObject.objects.filter(
+            Q(
+                Q3CRadialQuery(
+                    center_ra=ra_deg,
+                    center_dec=dec_deg,
+                    ra_col="ra",
+                    dec_col="dec",
+                    radius=dist_arcmin / 60.0,
+                )
             )
+        )
+        .annotate(sep=Q3CDist(ra1=F("ra"), dec1=F("dec"), ra2=ra_deg, dec2=dec_deg) * 3600)  # degrees -> arcsec
+        .order_by("sep")
+    )
+
+    # Reformat the result into the format we want
+    simbad_result_table = []
+    for simbad_object in simbad_objects:
+        simbad_result_table.append(
+            {
+                "name": simbad_object.main_id,
+                "search_term": simbad_object.main_id.replace("+", "%2B").replace(" ", "+"),
+                "ra_str": simbad_object.ra_str,
+                "dec_str": simbad_object.dec_str,
+                "sep": simbad_object.sep,
+                "from_db": "Simbad",
+            }
+        )
 
     return simbad_result_table
 
@@ -285,6 +391,44 @@ def create_tag(request: HttpRequest):
             return redirect(request.META["HTTP_REFERER"])
 
 
+def pick_random_unrated_candidate(candidates: QuerySet, claim_minutes: int = 0) -> Optional[models.Candidate]:
+    """Pick a random unrated candidate, using the indexed random key of the unrated candidates.
+
+    The first candidate at or after a random point in the keys is taken, wrapping around to the start. The picked
+    candidate gets a new random key so the next pick doesn't land on it again.
+
+    :param candidates: Candidates to pick from.
+    :param claim_minutes: Hold the picked candidate for this many minutes, so it isn't handed to another rater in the
+        meantime. 0 to not hold candidates.
+    """
+
+    now = timezone.now()
+
+    unrated = candidates.filter(rating_count=0)
+    if claim_minutes:
+        unrated = unrated.filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+
+    start = random.random()
+
+    with transaction.atomic():
+        for after_start in (True, False):
+            if after_start:
+                picks = unrated.filter(random_key__gte=start)
+            else:
+                picks = unrated.filter(random_key__lt=start)
+
+            # Skip candidates that are being picked by another rater right now.
+            candidate = picks.order_by("random_key").select_for_update(skip_locked=True).first()
+
+            if candidate:
+                candidate.random_key = models.random_key()
+                candidate.claimed_until = now + timedelta(minutes=claim_minutes) if claim_minutes else None
+                candidate.save(update_fields=["random_key", "claimed_until"])
+                return candidate
+
+    return None
+
+
 @login_required(login_url="/")
 def candidate_random(request):
     """Redirect the user to an unrated candidate in the project."""
@@ -300,11 +444,8 @@ def candidate_random(request):
     else:
         candidates = models.Candidate.objects.all()
 
-    # Find candidates that are unrated in project
-    candidates = candidates.annotate(rating_count=Count("rating")).filter(rating_count=0)
-
-    # Pick a random candidate
-    random_candidate = candidates.order_by("?").first()
+    # Pick a random candidate that is unrated in project
+    random_candidate = pick_random_unrated_candidate(candidates, claim_minutes=CANDIDATE_CLAIM_MINUTES)
 
     if random_candidate:
         # Redirect to the candidate's detail page or any other appropriate URL
@@ -340,20 +481,22 @@ def candidate_rating(request, cand_hash_id, arcmin=2):
             tag_id = request.POST.get("tag")
             tag = models.Tag.objects.get(name=tag_id)
 
-            # Delete the old rating if it exists
-            if prev_rating:
-                prev_rating.delete()
-
-            # Create a new rating
-            models.Rating.objects.create(
-                hash_id=uuid4(),
-                candidate=candidate,
-                user=request.user,
-                rating=request.POST["confidence"],
-                notes=request.POST["notes"],
-                tag=tag,
-                date=timezone.now(),
-            )
+            # Replace the old rating if it exists, in one transaction so the rating summary of the candidate is
+            # never seen without a rating.
+            with transaction.atomic():
+                if prev_rating:
+                    prev_rating.delete()
+
+                # Create a new rating
+                models.Rating.objects.create(
+                    hash_id=uuid4(),
+                    candidate=candidate,
+                    user=request.user,
+                    rating=request.POST["confidence"],
+                    notes=request.POST["notes"],
+                    tag=tag,
+                    date=timezone.now(),
+                )
 
             # TODO - change this to go to a random page for a candidate that's not been rated yet in same set of candidates
             # This is done with the NEXT button??
@@ -537,6 +680,33 @@ def filter_candidates_by_coords(
         return incoming
 
 
+def filter_candidates_by_ratings(
+    incoming: QuerySet,
+    confidence: Optional[str] = None,
+    tag: Optional[str] = None,
+    rated: bool = False,
+    ratings_count: Optional[int] = None,
+) -> QuerySet:
+    """Filter candidates on the rating summary stored on each candidate, so it can be stacked with any other filter.
+
+    :param confidence: Only candidates whose latest rating has this confidence (T, F or U).
+    :param tag: Only candidates whose latest rating has this tag hash_id.
+    :param rated: Only candidates with at least one rating.
+    :param ratings_count: Only candidates with exactly this many ratings, 0 for unrated candidates.
+    """
+
+    if confidence:
+        incoming = incoming.filter(last_rating=confidence)
+    if tag:
+        incoming = incoming.filter(last_tag=tag)
+    if rated:
+        incoming = incoming.filter(rating_count__gt=0)
+    if ratings_count is not None:
+        incoming = incoming.filter(rating_count=ratings_count)
+
+    return incoming
+
+
 @login_required(login_url="/")
 def clear_candidates_filter(request: HttpRequest):
 
@@ -561,6 +731,10 @@ def project_select(request):
 
             print(f"old project selected - {selected_project_hash_id}")
 
+            # The candidate filters (sliders and observation) belong to the old project.
+            if request.POST["selected_project_hash_id"] != selected_project_hash_id:
+                request.session.pop("current_filter_data", None)
+
             request.session["selected_project_hash_id"] = request.POST["selected_project_hash_id"]
 
             print(f"setting selected_project_hash_id to {request.session['selected_project_hash_id']}")
@@ -581,20 +755,34 @@ def change_password(request):
             messages.error(request, "Please correct the error below.")
 
 
-def get_candidate_form_defaults():
+def get_candidate_form_defaults(
+    selected_project_hash_id: Optional[str] = None, observation_hash_id: Optional[str] = None
+):
     """Make a dictionary of default values for the filter form.
 
-    Pulls the min and max values from the DB and sets as the default form values."""
+    Pulls the min and max values for the selected project (or observation, or all candidates if neither is given) from
+    the DB and sets as the default form values."""
 
-    # Get the max and mins from the materialised view table
-    aggs = models.CandidateMinMaxStats.objects.values().last()
+    # Get the max and mins from the stats table, scoped to the project and observation.
+    aggs = (
+        models.CandidateMinMaxStats.objects.filter(
+            project=selected_project_hash_id or None,
+            observation=observation_hash_id or None,
+        )
+        .values()
+        .first()
+    )
+
+    # There are no stats for a project or observation without candidates.
+    if aggs is None:
+        aggs = {}
 
     # Get the default values for the float sliders.
     default_float_values = {}
     for variable in FILTER_FORM_FLOAT_VARAIBLES:
         for x, y in zip(["min", "max"], ["gte", "lte"]):
             default_float_values[f"{variable}__{y}"] = (
-                float(aggs[f"{x}_{variable}"]) if aggs[f"{x}_{variable}"] is not None else None
+                float(aggs[f"{x}_{variable}"]) if aggs.get(f"{x}_{variable}") is not None else None
             )
 
     default_inputs = {
@@ -622,94 +810,64 @@ def get_candidate_form_defaults():
     return default_inputs, default_float_values
 
 
-def get_new_values_diff(original: dict, new: dict):
-    """Get the difference between two dictionaries and return the new values."""
-
-    new_values = {}
-    for key, original_value in original.items():
+def get_sort_order(request: HttpRequest, sort_fields: List[str], default: str):
+    """Get the field to order a table by, and if it is descending, from the "order_by" URL parameter."""
 
-        if key in new:
-            if original_value != new[key] and new[key] is not None:
-                new_values[key] = new[key]
-        else:
-            new_values[key] = original_value
+    order_by = request.GET.get("order_by", default)
+    if order_by.lstrip("-") not in sort_fields:
+        order_by = default
 
-    return new_values
+    return order_by.lstrip("-"), order_by.startswith("-")
 
 
-@login_required(login_url="/")
-def candidate_table(request: HttpRequest):
+def paginate(request: HttpRequest, queryset: QuerySet, per_page: int, sort_fields: List[str], default_sort: str):
+    """Get the page of the table to show.
 
-    # Get session data to keep filters when changing page
-    # This only holds what values are used for the filtering, not all.
+    Old links with a "page" number use the Django paginator, otherwise the page is found by seeking past the
+    "after"/"before" cursor so that deep pages cost the same as the first one and no COUNT(*) is needed."""
 
-    default_inputs, default_float_values = get_candidate_form_defaults()
-    default_all_values = {**default_inputs, **default_float_values}
+    if "page" in request.GET:
+        paginator = Paginator(queryset, per_page)
+        return paginator.get_page(request.GET.get("page", 1))
 
-    candidate_table_session_data = request.session.get("current_filter_data", default_all_values)
+    sort_field, descending = get_sort_order(request, sort_fields, default_sort)
 
-    selected_project_hash_id = request.session.get("selected_project_hash_id")
+    return keyset_paginate(
+        queryset,
+        sort_field,
+        per_page,
+        after=request.GET.get("after"),
+        before=request.GET.get("before"),
+        descending=descending,
+        estimate_count=True,
+    )
 
-    if request.method == "GET" and request.GET:
-        candidate_table_session_data.update(request.GET.dict())
 
-        # Update the form values with the variables from url decode.
-        if get_new_values_diff(default_all_values, candidate_table_session_data):
-            form = forms.CandidateFilterForm(
-                selected_project_hash_id=selected_project_hash_id,
-                initial=candidate_table_session_data,
-            )
-        else:
-            form = forms.CandidateFilterForm(
-                selected_project_hash_id=selected_project_hash_id,
-                initial=default_all_values,
-            )
+def get_new_values_diff(original: dict, new: dict):
+    """Get the difference between two dictionaries and return the new values."""
 
-    # This is a filter request.
-    if request.method == "POST":
+    new_values = {}
+    for key, original_value in original.items():
 
-        if get_new_values_diff(default_all_values, candidate_table_session_data):
-            form = forms.CandidateFilterForm(
-                request.POST,
-                selected_project_hash_id=selected_project_hash_id,
-                initial=candidate_table_session_data,
-            )
+        if key in new:
+            if original_value != new[key] and new[key] is not None:
+                new_values[key] = new[key]
         else:
-            form = forms.CandidateFilterForm(
-                request.POST,
-                selected_project_hash_id=selected_project_hash_id,
-                initial=default_all_values,
-            )
-
-        if form.is_valid():
-
-            cleaned_data = {**form.cleaned_data}
-
-            # To allow the user to keep filtering and navigate back on page.
-            request.session["current_filter_data"] = cleaned_data
-            candidate_table_session_data = cleaned_data
-
-            # Filter the manual inputs, see if they are different from the default values.
-            url_dictionary = get_new_values_diff(default_all_values, cleaned_data)
+            new_values[key] = original_value
 
-            # Make the query string
-            query_string = urlencode(url_dictionary)
+    return new_values
 
-            print(f"Query url string: {query_string}")
 
-            return redirect(f"{request.path}?{query_string}")
-    else:
+def filter_candidates(
+    selected_project_hash_id: Optional[str],
+    candidate_table_session_data: dict,
+    default_inputs: dict,
+    default_float_values: dict,
+):
+    """Filter the candidates with the filters of the candidate table, used for both the table and its exports.
 
-        if get_new_values_diff(default_all_values, candidate_table_session_data):
-            form = forms.CandidateFilterForm(
-                selected_project_hash_id=selected_project_hash_id,
-                initial=candidate_table_session_data,
-            )
-        else:
-            form = forms.CandidateFilterForm(
-                selected_project_hash_id=selected_project_hash_id,
-                initial=default_all_values,
-            )
+    :return: The filtered candidates and the set of columns that were filtered on.
+    """
 
     inputs_to_filter = get_new_values_diff(default_inputs, candidate_table_session_data)
     floats_to_filter = get_new_values_diff(default_float_values, candidate_table_session_data)
@@ -723,10 +881,6 @@ def candidate_table(request: HttpRequest):
     else:
         candidates = models.Candidate.objects.all()
 
-    print("++++++++++++++++++++++++++++++++++++++")
-    print(candidates)
-    print(floats_to_filter)
-
     ### Float Filtering ###
 
     filtered_columns = set()
@@ -738,32 +892,24 @@ def candidate_table(request: HttpRequest):
 
     ### Individual input filtering ###
 
-    confidence_filter = None
-    if "confidence" in inputs_to_filter:
+    # Rating filters, on the rating summary columns of the candidates.
+    candidates = filter_candidates_by_ratings(
+        candidates,
+        confidence=inputs_to_filter.get("confidence"),
+        tag=inputs_to_filter.get("tag"),
+        rated="rated" in inputs_to_filter,
+        ratings_count=inputs_to_filter.get("ratings_count"),
+    )
 
-        # Fetch all ratings with the specified confidence
-        all_ratings = models.Rating.objects.filter(rating=inputs_to_filter["confidence"]).distinct()
-        candidate_hash_ids = all_ratings.values_list("candidate__hash_id", flat=True)
-        candidates = models.Candidate.objects.filter(hash_id__in=candidate_hash_ids)
+    if "confidence" in inputs_to_filter:
         filtered_columns.add("rating.confidence")
-        confidence_filter = inputs_to_filter["confidence"]
 
     # Classification tag filter
-    tag_filter_name = None
     if "tag" in inputs_to_filter:
-
-        # Bit of messing around here because a candidate can have multiple ratings
-        candidates_unset = candidates.filter(rating__tag=inputs_to_filter["tag"])
-        candidates_list = list(set(list(candidates_unset)))
-        candidate_hash_ids = [candidate.hash_id for candidate in candidates_list]
-        candidates = models.Candidate.objects.filter(hash_id__in=candidate_hash_ids)
-
         filtered_columns.add("rating.tag.name")
-        tag_filter_name = models.Tag.objects.get(hash_id=inputs_to_filter["tag"]).name
 
     # Ratings filter
-    if "rated" in inputs_to_filter:
-        candidates = candidates.annotate(rating_count=Count("rating")).filter(rating_count__gt=0)
+    if "rated" in inputs_to_filter or "ratings_count" in inputs_to_filter:
         filtered_columns.add("rating_count")
 
     # Obsid filter
@@ -836,10 +982,117 @@ def candidate_table(request: HttpRequest):
         )
         filtered_columns.add("deep_sep")
 
+    return candidates, filtered_columns
+
+
+@login_required(login_url="/")
+def candidate_table(request: HttpRequest):
+
+    # Get session data to keep filters when changing page
+    # This only holds what values are used for the filtering, not all.
+
+    selected_project_hash_id = request.session.get("selected_project_hash_id")
+
+    # The sliders only span the candidates in the selected project.
+    default_inputs, default_float_values = get_candidate_form_defaults(selected_project_hash_id)
+    default_all_values = {**default_inputs, **default_float_values}
+
+    candidate_table_session_data = request.session.get("current_filter_data", default_all_values)
+
+    if request.method == "GET" and request.GET:
+        candidate_table_session_data.update(request.GET.dict())
+
+        # Update the form values with the variables from url decode.
+        if get_new_values_diff(default_all_values, candidate_table_session_data):
+            form = forms.CandidateFilterForm(
+                selected_project_hash_id=selected_project_hash_id,
+                initial=candidate_table_session_data,
+            )
+        else:
+            form = forms.CandidateFilterForm(
+                selected_project_hash_id=selected_project_hash_id,
+                initial=default_all_values,
+            )
+
+    # This is a filter request.
+    if request.method == "POST":
+
+        if get_new_values_diff(default_all_values, candidate_table_session_data):
+            form = forms.CandidateFilterForm(
+                request.POST,
+                selected_project_hash_id=selected_project_hash_id,
+                initial=candidate_table_session_data,
+            )
+        else:
+            form = forms.CandidateFilterForm(
+                request.POST,
+                selected_project_hash_id=selected_project_hash_id,
+                initial=default_all_values,
+            )
+
+        if form.is_valid():
+
+            cleaned_data = {**form.cleaned_data}
+
+            # To allow the user to keep filtering and navigate back on page.
+            request.session["current_filter_data"] = cleaned_data
+            candidate_table_session_data = cleaned_data
+
+            # Filter the manual inputs, see if they are different from the default values.
+            url_dictionary = get_new_values_diff(default_all_values, cleaned_data)
+
+            # Make the query string
+            query_string = urlencode(url_dictionary)
+
+            print(f"Query url string: {query_string}")
+
+            return redirect(f"{request.path}?{query_string}")
+    else:
+
+        if get_new_values_diff(default_all_values, candidate_table_session_data):
+            form = forms.CandidateFilterForm(
+                selected_project_hash_id=selected_project_hash_id,
+                initial=candidate_table_session_data,
+            )
+        else:
+            form = forms.CandidateFilterForm(
+                selected_project_hash_id=selected_project_hash_id,
+                initial=default_all_values,
+            )
+
+    inputs_to_filter = get_new_values_diff(default_inputs, candidate_table_session_data)
+
+    candidates, filtered_columns = filter_candidates(
+        selected_project_hash_id, candidate_table_session_data, default_inputs, default_float_values
+    )
+
+    confidence_filter = inputs_to_filter.get("confidence")
+
+    tag_filter_name = None
+    if "tag" in inputs_to_filter:
+        tag_filter_name = models.Tag.objects.get(hash_id=inputs_to_filter["tag"]).name
+
+    # Order by the separation of the cone search if there is one.
+    cone_searches = [sep for sep in ["cand_sep", "beam_sep", "deep_sep"] if sep in filtered_columns]
+    default_sort = cone_searches[0] if cone_searches else "name"
+
+    # Handle exports of the filtered candidates
+    if request.method == "GET" and request.GET.get("download") in CANDIDATE_EXPORT_FORMATS:
+        return export_candidates(
+            request.GET.get("download"),
+            candidates.order_by(default_sort, "hash_id"),
+            request.GET.getlist("columns"),
+            cone_searches,
+        )
+
     # Paginate
-    paginator = Paginator(candidates, 50)
-    page_number = request.GET.get("page", 1)
-    page_obj = paginator.get_page(page_number)
+    page_obj = paginate(
+        request,
+        candidates.select_related("observation", "beam", "project"),
+        50,
+        CANDIDATE_SORT_FIELDS + cone_searches,
+        default_sort,
+    )
 
     content = {
         "page_obj": page_obj,
@@ -851,46 +1104,85 @@ def candidate_table(request: HttpRequest):
         "column_labels": FILTER_CAND_VAR_MAPPING,
         "tag_filter_name": tag_filter_name,
         "confidence_filter": confidence_filter,
+        "export_columns": EXPORT_CANDIDATE_FIELDS + cone_searches,
+        "export_formats": CANDIDATE_EXPORT_FORMATS,
+        # The filters in the url are passed on to the export, but not the page of the table.
+        "export_params": [
+            (key, value) for key, value in request.GET.items() if key not in ["after", "before", "page", "order_by"]
+        ],
     }
     return render(request, "candidate_app/candidate_table.html", content)
 
 
+def export_candidates(export_format: str, candidates: QuerySet, columns: List[str], cone_searches: List[str]):
+    """Stream the filtered candidates of the candidate table as a CSV, FITS or Parquet file.
+
+    :param columns: The columns to export, all of them if empty. Unknown columns are ignored.
+    :param cone_searches: The separations of the cone searches that were done, these can be exported too.
+    """
+
+    allowed_columns = EXPORT_CANDIDATE_FIELDS + cone_searches
+    columns = [column for column in columns if column in allowed_columns] or allowed_columns
+
+    if export_format == "fits":
+        return download_fits(None, candidates, "candidates", columns)
+    elif export_format == "parquet":
+        return download_parquet(candidates, "candidates", columns)
+    else:
+        return download_csv(candidates, "candidates", columns)
+
+
+def write_csv_rows(zip_file: zipfile.ZipFile, name: str, buffer: StreamBuffer, rows):
+    """Write rows into a CSV file in a zip file being streamed, yielding the zipped bytes as they are produced."""
+
+    with zip_file.open(name, "w", force_zip64=True) as zipped_csv:
+        csv_file = TextIOWrapper(zipped_csv, encoding="utf-8", newline="")
+        writer = csv.writer(csv_file)
+
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+
+            if count % EXPORT_CHUNK_SIZE == 0:
+                csv_file.flush()
+                yield buffer.pop()
+
+        csv_file.flush()
+        csv_file.detach()
+
+    yield buffer.pop()
+
+
 def download_rating_csv_zip(
     queryset: QuerySet,
     table: str,
     candidate_fields: List[str] = None,
-) -> HttpResponse:
-    """Write the ratingd queryset all tags into zip file to be downloaded by the user."""
-
-    # Create an in-memory output file for the zip file
-    zip_buffer = BytesIO()
-
-    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-        # Create CSV for ratings
-        ratings_csv_buffer = StringIO()
-        ratings_writer = csv.writer(ratings_csv_buffer)
-
-        # Define headers, including candidate information
-        rating_field_names = [field.name for field in queryset.model._meta.fields]
-        # Rename some column names
-        if "hash_id" in rating_field_names:
-            index = rating_field_names.index("hash_id")
-            rating_field_names[index] = "rating_hash_id"
-
-        if candidate_fields is None:
-            candidate_fields = [
-                field.name for field in models.Candidate._meta.fields
-            ]  # Default to all candidate fields
-        ratings_headers = rating_field_names + candidate_fields
-        ratings_writer.writerow(ratings_headers)
-
-        # Write data rows for ratings
-        for rating in queryset:
+) -> StreamingHttpResponse:
+    """Stream the rated queryset and all tags as CSV files in a zip file to be downloaded by the user.
+
+    The ratings are read in chunks through a server-side cursor, so memory use doesn't depend on the number of
+    ratings."""
+
+    # Define headers, including candidate information
+    rating_field_names = [field.name for field in queryset.model._meta.fields]
+    # Rename some column names
+    if "hash_id" in rating_field_names:
+        index = rating_field_names.index("hash_id")
+        rating_field_names[index] = "rating_hash_id"
+
+    if candidate_fields is None:
+        candidate_fields = [field.name for field in models.Candidate._meta.fields]  # Default to all candidate fields
+    ratings_headers = rating_field_names + candidate_fields
+
+    def rating_rows():
+        yield ratings_headers
+
+        ratings = queryset.select_related("candidate", "tag", "user").iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        for rating in ratings:
             candidate = rating.candidate
             row = []
             for field in rating_field_names:
                 if field == "tag":
-                    row.append(rating.tag.name)  # Access tag name
+                    row.append(rating.tag.name if rating.tag else None)  # Access tag name
                 elif field == "date":
                     row.append(rating.date)
                 elif field == "rating_hash_id":
@@ -902,31 +1194,26 @@ def download_rating_csv_zip(
                 row += [getattr(candidate, field) for field in candidate_fields]
             else:
                 row += ["N/A"] * len(candidate_fields)  # If no candidate, fill with N/A
-            ratings_writer.writerow(row)
+            yield row
 
-        # Write ratings CSV to the zip file
-        zip_file.writestr(f"{table}_ratings.csv", ratings_csv_buffer.getvalue())
+    def tag_rows():
+        tag_field_names = [field.name for field in models.Tag._meta.fields]
+        yield tag_field_names
 
-        # Create CSV for tags
-        tags_csv_buffer = StringIO()
-        tags_writer = csv.writer(tags_csv_buffer)
+        for tag in models.Tag.objects.all():
+            yield [getattr(tag, field) for field in tag_field_names]
 
-        # Define headers for tags
-        tag_field_names = [field.name for field in models.Tag._meta.fields]
-        tags_writer.writerow(tag_field_names)
+    def zip_chunks():
+        buffer = StreamBuffer()
 
-        # Write data rows for tags
-        tags = models.Tag.objects.all()
-        for tag in tags:
-            row = [getattr(tag, field) for field in tag_field_names]
-            tags_writer.writerow(row)
+        with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+            yield from write_csv_rows(zip_file, f"{table}_ratings.csv", buffer, rating_rows())
+            yield from write_csv_rows(zip_file, "all_tags.csv", buffer, tag_rows())
 
-        # Write tags CSV to the zip file
-        zip_file.writestr("all_tags.csv", tags_csv_buffer.getvalue())
+        # The central directory of the zip file
+        yield buffer.pop()
 
-    # Create a response with the zip file
-    zip_buffer.seek(0)
-    response = HttpResponse(zip_buffer, content_type="application/zip")
+    response = StreamingHttpResponse(zip_chunks(), content_type="application/zip")
     response["Content-Disposition"] = f'attachment; filename="{table}_data.zip"'
 
     return response
@@ -1013,10 +1300,14 @@ def ratings_summary(request: HttpRequest):
     # Convert QuerySet to list of dictionaries for ratings per tag
     ratings_per_tag = list(ratings.values("tag__name").annotate(count=Count("hash_id")))
 
-    # Paginate
-    paginator = Paginator(ratings, 25)
-    page_number = request.GET.get("page", 1)
-    page_obj = paginator.get_page(page_number)
+    # Paginate, newest ratings first
+    page_obj = paginate(
+        request,
+        ratings.select_related("candidate__observation", "candidate__project", "tag", "user"),
+        25,
+        RATING_SORT_FIELDS,
+        "-date",
+    )
 
     context = {
         "form": form,
@@ -1039,6 +1330,43 @@ def clear_ratings_filter(request: HttpRequest):
     return redirect("/ratings_summary/")
 
 
+def upload_failed(error: Exception) -> Response:
+    """Roll back an upload view's transaction after an error part way through, and report the error.
+
+    Nothing the upload did is kept, e.g. references it added to stored files before the error. Requests missing a
+    field or for a project, observation or beam that doesn't exist are bad requests, anything else is a server error."""
+
+    transaction.set_rollback(True)
+    print("An exception occurred:", error)
+
+    if isinstance(
+        error,
+        (KeyError, ValueError, models.Project.DoesNotExist, models.Observation.DoesNotExist, models.Beam.DoesNotExist),
+    ):
+        return Response(
+            {"status": "error", "message": f"Upload failed - {error!r}"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    return Response(
+        {"status": "error", "message": f"Upload failed - {error!r}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+    )
+
+
+def delete_uncommitted_files(view):
+    """Delete the files a view saved to the content addressed store if its transaction was rolled back.
+
+    Goes outside transaction.atomic, so the files are only deleted once the transaction has ended."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        finally:
+            models.MediaBlob.delete_uncommitted_files()
+
+    return wrapper
+
+
 @api_view(["POST"])
 @transaction.atomic
 def upload_observation(request):
@@ -1102,8 +1430,7 @@ def upload_observation(request):
                     return Response(obs.errors, status=status.HTTP_400_BAD_REQUEST)
 
                 except Exception as error:
-                    print("An exception occurred:", error)
-                    return Response({"error-message": error}, status=status.HTTP_400_BAD_REQUEST)
+                    return upload_failed(error)
 
             else:
                 return Response(
@@ -1111,16 +1438,20 @@ def upload_observation(request):
                     status=status.HTTP_401_UNAUTHORIZED,
                 )
 
-        except Exception as error:
+        except Token.DoesNotExist as error:
             print("An exception occurred:", error)
             return Response(
                 {"status": "error", "message": f"Invalid or expired token - {error}"}, status=status.HTTP_403_FORBIDDEN
             )
 
+        except Exception as error:
+            return upload_failed(error)
+
     return Response({"status": "error", "message": f"Not a POST request."}, status=status.HTTP_400_BAD_REQUEST)
 
 
 @api_view(["POST"])
+@delete_uncommitted_files
 @transaction.atomic
 def upload_beam(request):
 
@@ -1165,8 +1496,7 @@ def upload_beam(request):
                     return Response(beam.errors, status=status.HTTP_400_BAD_REQUEST)
 
                 except Exception as error:
-                    print("An exception occurred:", error)
-                    return Response({"error-message": error}, status=status.HTTP_400_BAD_REQUEST)
+                    return upload_failed(error)
 
             else:
                 return Response(
@@ -1174,16 +1504,20 @@ def upload_beam(request):
                     status=status.HTTP_401_UNAUTHORIZED,
                 )
 
-        except Exception as error:
+        except Token.DoesNotExist as error:
             print("An exception occurred:", error)
             return Response(
                 {"status": "error", "message": f"Invalid or expired token - {error}"}, status=status.HTTP_403_FORBIDDEN
             )
 
+        except Exception as error:
+            return upload_failed(error)
+
     return Response({"status": "error", "message": f"Not a POST request."}, status=status.HTTP_400_BAD_REQUEST)
 
 
 @api_view(["POST"])
+@delete_uncommitted_files
 @transaction.atomic
 def upload_candidate(request):
 
@@ -1237,15 +1571,265 @@ def upload_candidate(request):
                     status=status.HTTP_401_UNAUTHORIZED,
                 )
 
-        except Exception as error:
+        except Token.DoesNotExist as error:
             print("An exception occurred:", error)
             return Response(
                 {"status": "error", "message": f"Invalid or expired token - {error}"}, status=status.HTTP_403_FORBIDDEN
             )
 
+        except Exception as error:
+            return upload_failed(error)
+
     return Response({"status": "error", "message": f"Not a POST request."}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def get_bulk_candidate_files(request_files, name: str) -> dict:
+    """Pull out the files for a single candidate from a bulk upload request.
+
+    Files are sent with the key "<candidate name>__<file field>", eg. "VAST_0012-34__slices_gif". Files already stored
+    on the webapp can instead be given by their SHA-256 under "file_sha256" in the candidate row."""
+
+    cand_files = {}
+    for field in models.Candidate.FILE_FIELDS:
+        uploaded_file = request_files.get(f"{name}__{field}")
+        if uploaded_file is not None:
+            cand_files[field] = uploaded_file
+
+    return cand_files
+
+
+@api_view(["POST"])
+@delete_uncommitted_files
+@transaction.atomic
+def upload_candidates_bulk(request):
+    """Upload all of the candidates for a single beam in one request.
+
+    The request holds the "proj_id", "obs_id" and "beam_index" of the beam, a JSON list of the candidate rows under
+    "candidates" and the product files for each candidate (see get_bulk_candidate_files). Returns a report with the
+    outcome for each row, in the same order as the rows were sent."""
+
+    if request.method == "POST":
+
+        # Get user specific data
+        try:
+            token_str = request.headers["Authorization"]
+
+        except KeyError:
+            return Response(
+                {"status": "error", "message": "Unable to pull out token of the request."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            # Find token in the db
+            token = Token.objects.get(key=token_str)
+            if token is not None:
+
+                print(f" --------------- Bulk candidates uploaded by user: {token.user} --------------- ")
+
+                proj = models.Project.objects.get(id=request.data["proj_id"])
+                obs = models.Observation.objects.get(project=proj, id=request.data["obs_id"])
+                beam = models.Beam.objects.get(project=proj, observation=obs, index=request.data["beam_index"])
+
+                rows = json.loads(request.data["candidates"])
+
+                # Find all of the candidates in this beam that have already been uploaded in one query.
+                existing_names = set(
+                    models.Candidate.objects.filter(
+                        beam=beam,
+                        name__in=[row.get("name") for row in rows],
+                    ).values_list("name", flat=True)
+                )
+
+                results = []
+                valid_rows = []
+                for row in rows:
+                    name = row.get("name")
+
+                    if name in existing_names:
+                        results.append({"name": name, "status": "skipped", "message": "Already uploaded/created"})
+                        continue
+
+                    # Parents come from the request rather than each row.
+                    row.update({"proj_id": proj.id, "obs_id": obs.id, "beam_index": beam.index})
+
+                    cand = serializers.CandidateSerializer(
+                        data={**row, **get_bulk_candidate_files(request.FILES, name)}
+                    )
+                    if cand.is_valid():
+                        result = {"name": name, "status": "created"}
+                        valid_rows.append((result, cand.validated_data))
+                        existing_names.add(name)
+                    else:
+                        result = {"name": name, "status": "error", "errors": cand.errors}
+                    results.append(result)
+
+                if valid_rows:
+                    bulk = serializers.CandidateListSerializer(
+                        child=serializers.CandidateSerializer(),
+                        context={"user": token.user, "project": proj, "observation": obs, "beam": beam},
+                    )
+                    created = bulk.create([validated_data for _, validated_data in valid_rows])
+                    for (result, _), candidate in zip(valid_rows, created):
+                        result["hash_id"] = str(candidate.hash_id)
+
+                summary = {
+                    row_status: sum(1 for result in results if result["status"] == row_status)
+                    for row_status in ["created", "skipped", "error"]
+                }
+                print(f"Bulk upload for beam {beam.index} of {obs.id}: {summary}")
+
+                return Response({"status": "ok", **summary, "results": results}, status=status.HTTP_201_CREATED)
+
+            else:
+                return Response(
+                    {"status": "error", "message": "Token given does not match a user."},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+
+        except Token.DoesNotExist as error:
+            print("An exception occurred:", error)
+            return Response(
+                {"status": "error", "message": f"Invalid or expired token - {error}"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+        except Exception as error:
+            return upload_failed(error)
+
+    return Response({"status": "error", "message": "Not a POST request."}, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["POST"])
+def upload_manifest(request):
+    """Find which of the beams and candidates planned for upload to an observation aren't on the webapp yet.
+
+    The request holds the "proj_id" and "obs_id" of the observation and a list of "items", one for each beam and
+    candidate to be uploaded: {"beam_index": 0, "name": <candidate name, or null for the beam itself>, "sha256":
+    {<file field>: <SHA-256 of the file>}}. Replies with the items that are "missing", and which of their files are
+    already "stored" so they can be sent by their SHA-256 rather than uploaded."""
+
+    if request.method == "POST":
+
+        # Get user specific data
+        try:
+            token_str = request.headers["Authorization"]
+
+        except KeyError:
+            return Response(
+                {"status": "error", "message": "Unable to pull out token of the request."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            # Find token in the db
+            token = Token.objects.get(key=token_str)
+            if token is not None:
+
+                items = request.data["items"]
+
+                # Everything is missing if the observation hasn't been created yet.
+                existing_beams, existing_candidates = set(), set()
+                obs = models.Observation.objects.filter(
+                    project__id=request.data["proj_id"], id=request.data["obs_id"]
+                ).first()
+                if obs is not None:
+                    existing_beams = set(models.Beam.objects.filter(observation=obs).values_list("index", flat=True))
+                    existing_candidates = set(
+                        models.Candidate.objects.filter(observation=obs).values_list("beam_index", "name")
+                    )
+
+                missing = [
+                    item
+                    for item in items
+                    if (item["name"] is None and item["beam_index"] not in existing_beams)
+                    or (item["name"] is not None and (item["beam_index"], item["name"]) not in existing_candidates)
+                ]
+
+                checksums = {checksum for item in missing for checksum in item.get("sha256", {}).values()}
+                stored = models.MediaBlob.objects.filter(sha256__in=checksums).values_list("sha256", flat=True)
+
+                print(f"Upload manifest for {request.data['obs_id']}: {len(missing)} of {len(items)} items missing")
+
+                return Response(
+                    {
+                        "status": "ok",
+                        "missing": [{"beam_index": item["beam_index"], "name": item["name"]} for item in missing],
+                        "stored": list(stored),
+                    },
+                    status=status.HTTP_200_OK,
+                )
+
+            else:
+                return Response(
+                    {"status": "error", "message": "Token given does not match a user."},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+
+        except Token.DoesNotExist as error:
+            print("An exception occurred:", error)
+            return Response(
+                {"status": "error", "message": f"Invalid or expired token - {error}"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+        except (KeyError, TypeError, AttributeError) as error:
+            # Missing fields, or items that aren't lists or objects.
+            return Response(
+                {"status": "error", "message": f"Invalid manifest - {error!r}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+    return Response({"status": "error", "message": "Not a POST request."}, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["POST"])
+def stored_files(request):
+    """Find which of a list of files, given by their SHA-256 under "sha256", are already stored on the webapp.
+
+    Stored files can be sent to the upload endpoints by their SHA-256 (see serializers.store_uploaded_files) instead
+    of uploading them again."""
+
+    if request.method == "POST":
+
+        # Get user specific data
+        try:
+            token_str = request.headers["Authorization"]
+
+        except KeyError:
+            return Response(
+                {"status": "error", "message": "Unable to pull out token of the request."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            # Find token in the db
+            token = Token.objects.get(key=token_str)
+            if token is not None:
+
+                checksums = request.data.get("sha256", [])
+                if not isinstance(checksums, list) or not all(isinstance(checksum, str) for checksum in checksums):
+                    return Response(
+                        {"status": "error", "message": "sha256 must be a list of SHA-256 strings."},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+
+                stored = models.MediaBlob.objects.filter(sha256__in=checksums).values_list("sha256", flat=True)
+
+                return Response({"status": "ok", "stored": list(stored)}, status=status.HTTP_200_OK)
+
+            else:
+                return Response(
+                    {"status": "error", "message": "Token given does not match a user."},
+                    status=status.HTTP_401_UNAUTHORIZED,
+                )
+
+        except Token.DoesNotExist as error:
+            print("An exception occurred:", error)
+            return Response(
+                {"status": "error", "message": f"Invalid or expired token - {error}"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+    return Response({"status": "error", "message": "Not a POST request."}, status=status.HTTP_400_BAD_REQUEST)
+
+
 PROJECT_COLOURS = [
     "#5470C6",
     "#91CC75",
@@ -1268,10 +1852,13 @@ def site_admin(request):
     selected_project_hash_id = request.session.get("selected_project_hash_id")
 
     if selected_project_hash_id:
-        selected_projects = [models.Project.objects.get(hash_id=selected_project_hash_id)]
+        selected_projects = models.Project.objects.filter(hash_id=selected_project_hash_id)
     else:
         selected_projects = models.Project.objects.all()
 
+    # Disk usage found by the last run of the reconcile_media command
+    selected_projects = selected_projects.select_related("disk_usage")
+
     # Get disk space used by projects
     total_disk_space, used_disk_space, free_disk_space = get_disk_space(MEDIA_ROOT)
 
@@ -1279,18 +1866,17 @@ def site_admin(request):
     colour_count = 0
     for project in selected_projects:
 
-        project_used_of_total = (project.total_file_size_gb / total_disk_space) * 100 if used_disk_space else 0
+        # Counts and file totals are kept up to date in the observation stats table.
+        observations = project.obs_proj.select_related("stats", "upload__user")
 
-        observations = project.obs_proj.annotate(
-            candidate_count=Count("cand_obs"),
-            rated_candidate_count=Count("cand_obs__rating__candidate", distinct=True),
-            ratings_count=Count("cand_obs__rating"),
-        )
+        project_total_file_size_gb = sum(obs.stats.total_file_size_gb for obs in observations if hasattr(obs, "stats"))
+        project_used_of_total = (project_total_file_size_gb / total_disk_space) * 100 if used_disk_space else 0
 
         annotated_projects.append(
             {
                 "project": project,
                 "observations": observations,
+                "project_total_file_size_gb": project_total_file_size_gb,
                 "project_used_of_total": project_used_of_total,
                 "project_colour": PROJECT_COLOURS[(colour_count + 1) % len(PROJECT_COLOURS)],
             }
@@ -1303,6 +1889,7 @@ def site_admin(request):
         "free_disk_space": free_disk_space,
         "used_disk_space": used_disk_space,
         "total_disk_space": total_disk_space,
+        "queued_file_deletions": models.QueuedFileDeletion.objects.count(),
     }
 
     return render(request, "candidate_app/site_admin.html", context)
@@ -1321,7 +1908,7 @@ def delete(request: HttpRequest):
             print(f"Attempting to delete project: {to_delete}")
 
             try:
-                # Delete project record and cascading objects
+                # Delete project record and cascading objects, the files are queued to be removed in the background
                 project = models.Project.objects.get(hash_id=to_delete)
                 project.delete()
 
@@ -1334,7 +1921,8 @@ def delete(request: HttpRequest):
             print(f"Attempting to delete observation: {to_delete}")
 
             try:
-                # Delete observation record and cascading records obs > beams > cands
+                # Delete observation record and cascading records obs > beams > cands, the files are queued to be removed
+                # in the background
                 observation = models.Observation.objects.get(hash_id=to_delete)
                 observation.delete()
 
@@ -2,10 +2,20 @@
 
 import os
 import re
+import sys
 import csv
 import json
+import time
+import uuid
+import zlib
+import hashlib
+import sqlite3
 import argparse
+import threading
 import requests
+import requests.adapters
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from typing import Dict, List, Optional, Tuple
 
@@ -17,6 +27,29 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class LimitedSession(requests.Session):
+    """A session that can be shared between threads, with a cap on the number of requests in flight at once.
+
+    The connection pool is sized to match so every request in flight can reuse a kept-alive connection."""
+
+    def __init__(self, max_in_flight: int = 1):
+        super().__init__()
+        max_in_flight = max(max_in_flight, 1)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_in_flight,
+            pool_maxsize=max_in_flight,
+            pool_block=True,
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, *args, **kwargs):
+        with self._in_flight:
+            return super().request(*args, **kwargs)
+
+
 class TokenAuth(requests.auth.AuthBase):
     def __init__(self, token: str):
         self.token = str(token)
@@ -26,6 +59,332 @@ class TokenAuth(requests.auth.AuthBase):
         return r
 
 
+# Default directory to look for the data in, the directory this script lives in
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Bytes read from disk at a time when streaming a request body
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def gzip_chunks(file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Yield the gzip compressed contents of a file, compressing a chunk at a time."""
+
+    # wbits=31 writes a gzip header with no timestamp, so compressing the same file always gives the same bytes.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    with open(file_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+    yield compressor.flush()
+
+
+class MultipartStream:
+    """A multipart/form-data request body that is read from disk while it is being sent.
+
+    Pass it as the data of a request along with its content_type, requests then sends it with a Content-Length and
+    reads it a block at a time, so only about one chunk of the files is in memory at once however large they are.
+    With compress_fits, .fits files are gzipped on the fly and sent as "<name>.fits.gz" for the webapp to decompress.
+    Their compressed size is worked out with an extra compression pass up front, as the length of the body has to be
+    known before it is sent."""
+
+    def __init__(
+        self,
+        fields: Dict,
+        files: Dict[str, str],
+        compress_fits: bool = False,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.chunk_size = chunk_size
+
+        # Each part is the header, and then either the value bytes or the path and whether to compress it.
+        self.parts = []
+        for name, value in fields.items():
+            if value is None:
+                continue
+            header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            self.parts.append((header.encode(), str(value).encode(), None, False))
+
+        for name, file_path in files.items():
+            filename = os.path.basename(file_path)
+            compress = compress_fits and filename.endswith(".fits")
+            if compress:
+                filename, content_type = f"{filename}.gz", "application/gzip"
+            else:
+                content_type = "application/octet-stream"
+            header = (
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n"
+            )
+            self.parts.append((header.encode(), None, file_path, compress))
+
+        self.end = f"--{self.boundary}--\r\n".encode()
+
+        self.length = len(self.end)
+        for header, value, file_path, compress in self.parts:
+            if value is not None:
+                size = len(value)
+            elif compress:
+                size = sum(len(chunk) for chunk in gzip_chunks(file_path, chunk_size))
+            else:
+                size = os.path.getsize(file_path)
+            self.length += len(header) + size + 2
+
+        self._chunks = self._iter_chunks()
+        # Read from the offset onwards, the read part is only dropped when another chunk is added.
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def _iter_chunks(self):
+        for header, value, file_path, compress in self.parts:
+            yield header
+            if value is not None:
+                yield value
+            elif compress:
+                yield from gzip_chunks(file_path, self.chunk_size)
+            else:
+                with open(file_path, "rb") as file:
+                    while chunk := file.read(self.chunk_size):
+                        yield chunk
+            yield b"\r\n"
+        yield self.end
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while chunk := self.read(self.chunk_size):
+            yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) - self._offset < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            del self._buffer[: self._offset]
+            self._offset = 0
+            self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer) - self._offset
+        data = bytes(self._buffer[self._offset : self._offset + size])
+        self._offset += len(data)
+        return data
+
+
+def post_multipart(
+    session: requests.Session,
+    url: str,
+    fields: Dict,
+    files: Dict[str, str],
+    compress_fits: bool = False,
+):
+    """POST the fields and files (paths keyed by the field name) as a multipart body streamed from disk."""
+
+    body = MultipartStream(fields, files, compress_fits)
+    return session.post(url, data=body, headers={"Content-Type": body.content_type})
+
+
+def file_sha256(file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    """SHA-256 of the contents of a file, read a chunk at a time."""
+
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class StoredFiles:
+    """The SHA-256 of the local files and which of them the webapp already has stored.
+
+    Stored files are sent by their SHA-256 instead of being uploaded again. The checksums and stored files of a whole
+    observation can be filled in up front from the upload manifest. Any other files are hashed and checked with the
+    stored_files endpoint as they are sent if a stored_url is given, otherwise they are uploaded."""
+
+    def __init__(self, session: requests.Session, stored_url: Optional[str] = None):
+        self.session = session
+        self.stored_url = stored_url
+        self.checksums = {}
+        self.stored = set()
+
+    def add_checksums(self, file_paths: List[str], workers: int = 1):
+        """Work out the SHA-256 of the files not already known, hashing up to "workers" files at once."""
+
+        file_paths = sorted(set(file_paths) - self.checksums.keys())
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            self.checksums.update(zip(file_paths, executor.map(file_sha256, file_paths)))
+
+    def split(self, files: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """Split files into the ones to upload and the SHA-256 of the ones the webapp already has stored."""
+
+        unknown = [file_path for file_path in files.values() if file_path not in self.checksums]
+        if unknown and self.stored_url is not None:
+            checksums = {file_path: file_sha256(file_path) for file_path in unknown}
+            r = self.session.post(self.stored_url, json={"sha256": sorted(set(checksums.values()))})
+            r.raise_for_status()
+            self.stored.update(r.json()["stored"])
+            self.checksums.update(checksums)
+
+        to_upload, references = {}, {}
+        for key, file_path in files.items():
+            if self.checksums.get(file_path) in self.stored:
+                references[key] = self.checksums[file_path]
+            else:
+                to_upload[key] = file_path
+        return to_upload, references
+
+
+class UploadJournal:
+    """A local SQLite journal of the upload of an observation, kept in its data directory.
+
+    Every request is recorded with its endpoint, size and timing, and each beam and candidate is marked as done once
+    the webapp has acknowledged it. An interrupted upload can then be resumed from where it stopped (--resume) and its
+    progress reported (--status). Beams are stored with an empty name. Shared between the upload threads."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            project_id TEXT,
+            obs_id TEXT,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER,
+            endpoint TEXT,
+            bytes INTEGER,
+            started_at REAL,
+            seconds REAL,
+            status_code INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            beam_index INTEGER,
+            name TEXT,
+            acked_at REAL,
+            request_id INTEGER,
+            PRIMARY KEY (beam_index, name)
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.run_id = None
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Each acknowledgement is committed straight away, WAL keeps that cheap.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    @staticmethod
+    def journal_path(directory: str, obs_id: str) -> str:
+        return os.path.join(directory, f"{obs_id}_upload_journal.sqlite3")
+
+    def has_runs(self) -> bool:
+        return self.db.execute("SELECT EXISTS (SELECT 1 FROM runs)").fetchone()[0] == 1
+
+    def start_run(self, project_id: str, obs_id: str, items: List[Tuple[int, str]], resume: bool = False):
+        """Start a run uploading the items (beam_index, name), keeping what is already done if resuming."""
+
+        with self.lock, self.db:
+            if not resume:
+                self.db.execute("DELETE FROM items")
+            self.db.executemany("INSERT OR IGNORE INTO items (beam_index, name) VALUES (?, ?)", items)
+            cursor = self.db.execute(
+                "INSERT INTO runs (project_id, obs_id, started_at) VALUES (?, ?, ?)", (project_id, obs_id, time.time())
+            )
+            self.run_id = cursor.lastrowid
+
+    def finish_run(self):
+        with self.lock, self.db:
+            self.db.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (time.time(), self.run_id))
+
+    def record(self, response: requests.Response, started_at: float, acked: List[Tuple[int, str]] = ()):
+        """Record a request sent at started_at, and the beams and candidates (beam_index, name) it acknowledged."""
+
+        finished_at = time.time()
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO requests (run_id, endpoint, bytes, started_at, seconds, status_code) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.run_id,
+                    requests.utils.urlparse(response.url).path,
+                    int(response.request.headers.get("Content-Length", 0)),
+                    started_at,
+                    finished_at - started_at,
+                    response.status_code,
+                ),
+            )
+            self.db.executemany(
+                "UPDATE items SET acked_at = ?, request_id = ? WHERE beam_index = ? AND name = ?",
+                [(finished_at, cursor.lastrowid, beam_index, name) for beam_index, name in acked],
+            )
+
+    def remaining(self) -> Dict[int, Tuple[bool, set]]:
+        """For each beam with anything left to upload - (whether the beam is left, names of the candidates left)."""
+
+        remaining = {}
+        for beam_index, name in self.db.execute(
+            "SELECT beam_index, name FROM items WHERE acked_at IS NULL ORDER BY beam_index, name"
+        ):
+            send_beam, cand_names = remaining.get(beam_index, (False, set()))
+            if name:
+                cand_names.add(name)
+            else:
+                send_beam = True
+            remaining[beam_index] = (send_beam, cand_names)
+
+        return remaining
+
+    def print_status(self):
+        """Print the progress of the upload, the throughput of each run and the beams and candidates left."""
+
+        print(f"Upload journal {self.path}")
+
+        left = 0
+        for is_beam, done, total in self.db.execute(
+            "SELECT name = '', COUNT(acked_at), COUNT(*) FROM items GROUP BY name = '' ORDER BY name = '' DESC"
+        ):
+            print(f"  {'Beams' if is_beam else 'Candidates'}: {done} of {total} uploaded, {total - done} left")
+            left += total - done
+
+        runs = self.db.execute(
+            "SELECT runs.id, runs.obs_id, runs.project_id, runs.started_at, runs.finished_at, "
+            "COUNT(requests.id), SUM(requests.status_code >= 400), SUM(requests.bytes), "
+            "MAX(requests.started_at + requests.seconds), AVG(requests.seconds), "
+            "(SELECT COUNT(*) FROM items JOIN requests r ON items.request_id = r.id WHERE r.run_id = runs.id) "
+            "FROM runs LEFT JOIN requests ON requests.run_id = runs.id GROUP BY runs.id ORDER BY runs.id"
+        ).fetchall()
+
+        rate = 0
+        for run_id, obs_id, project_id, started_at, finished_at, n_requests, failed, sent, last_at, mean, acked in runs:
+            elapsed = max((finished_at or last_at or started_at) - started_at, 1e-3)
+            rate = acked / elapsed
+            sent_mb = (sent or 0) / 1024**2
+            started = datetime.fromtimestamp(started_at, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            print(
+                f"  Run {run_id} of {obs_id} to {project_id}, started {started} UTC"
+                f"{'' if finished_at else ' (not finished)'}: {acked} beams and candidates in {elapsed:.1f}s "
+                f"({rate:.2f}/s), {n_requests} requests ({failed or 0} failed, {mean or 0:.2f}s mean), "
+                f"{sent_mb:.1f} Mb sent ({sent_mb / elapsed:.2f} Mb/s)"
+            )
+
+        for beam_index, (send_beam, cand_names) in self.remaining().items():
+            print(
+                f"  Left in beam{beam_index:02d}: {'the beam and ' if send_beam else ''}{len(cand_names)} candidates"
+            )
+        if left and rate:
+            print(f"  About {left / rate:.0f}s left at the rate of the last run.")
+
+    def close(self):
+        self.db.close()
+
+
 def group_dictionaries(tuples_list):
     # Dictionary to hold the groups, using frozenset of dictionary items as keys
     grouped = {}
@@ -137,7 +496,8 @@ def send_observation_request(
     obs_url: str,
     project_id: str,
     obs_id: str,
-    directory: str = os.path.dirname(os.path.realpath(__file__)),
+    directory: str = SCRIPT_DIR,
+    journal: Optional[UploadJournal] = None,
 ):
 
     ### Get the observation date from one of the fits files ###
@@ -159,6 +519,7 @@ def send_observation_request(
         datetime_object = Time(_date_obs).to_value('isot')
 
     ### Send a request to create an observation record in the DB ###
+    start = time.time()
     r = session.post(
         obs_url,
         data={
@@ -169,18 +530,17 @@ def send_observation_request(
         },
     )
     print(r.text)
+    if journal is not None:
+        journal.record(r, start)
     # r.raise_for_status()
 
 
-def send_beam_request(
-    session: requests.Session,
-    beam_url: str,
-    project_id: str,
+def find_beam_files(
     obs_id: str,
     beam_id: str,
-    directory: str = os.path.dirname(os.path.realpath(__file__)),
-):
-    """Uploads beam specific files to the ywangvaster webapp."""
+    directory: str = SCRIPT_DIR,
+) -> Dict[str, str]:
+    """Find the paths of the csv and images for a beam, keyed by the field name on the webapp."""
 
     beam_upload_files = {}
     for series_name, fmt_list in [
@@ -198,41 +558,57 @@ def send_beam_request(
 
         for fmt in fmt_list:
             filename = os.path.join(directory, f"{obs_id}_{beam_id}_{series_name}.{fmt}")
-            beam_upload_files[f"{series_name}_{fmt}"] = open(filename, "rb")
+            beam_upload_files[f"{series_name}_{fmt}"] = filename
 
-    try:
-        beam_int = int(beam_id[4:])
-        # Send the request
-        r = session.post(
-            beam_url,
-            data={
-                "proj_id": project_id,
-                "obs_id": obs_id,
-                "index": beam_int,
-            },
-            files=beam_upload_files,
-        )
-        print(r.text)
-        r.raise_for_status()
-
-    finally:
-        # Close all of the opened files.
-        for file in beam_upload_files.values():
-            file.close()
+    return beam_upload_files
 
 
-def send_cand_request(
+def send_beam_request(
     session: requests.Session,
-    cand_url: str,
+    beam_url: str,
+    project_id: str,
     obs_id: str,
     beam_id: str,
+    directory: str = SCRIPT_DIR,
+    compress_fits: bool = False,
+    stored_files: Optional[StoredFiles] = None,
+    journal: Optional[UploadJournal] = None,
+):
+    """Uploads beam specific files to the ywangvaster webapp."""
+
+    beam_upload_files = find_beam_files(obs_id, beam_id, directory)
+    references = {}
+    if stored_files is not None:
+        beam_upload_files, references = stored_files.split(beam_upload_files)
+
+    beam_int = int(beam_id[4:])
+    # Send the request
+    start = time.time()
+    r = post_multipart(
+        session,
+        beam_url,
+        {
+            "proj_id": project_id,
+            "obs_id": obs_id,
+            "index": beam_int,
+            **{f"file_sha256.{field}": checksum for field, checksum in references.items()},
+        },
+        beam_upload_files,
+        compress_fits,
+    )
+    print(r.text)
+    if journal is not None:
+        journal.record(r, start, [(beam_int, "")] if r.ok else [])
+    r.raise_for_status()
+
+
+def get_lightcurve_data(
     cand: Dict,
     lightcurve_local_rms: Optional[Dict] = None,
     lightcurve_peak_flux: Optional[Dict] = None,
-    directory: str = os.path.dirname(os.path.realpath(__file__)),
-):
+) -> Optional[List[List[str]]]:
+    """Pull out the lightcurve for a candidate, with the error bars, from the per beam lightcurve CSVs."""
 
-    # Add the lightcurve data to the candidate, and in error bars and cast as strings for json handling.
     if (
         lightcurve_peak_flux is not None
         and lightcurve_local_rms is not None
@@ -247,10 +623,20 @@ def send_cand_request(
             ), f"Time x-value for the lightcurve data is not the same in CSVs! {cand['name']}"
 
             lightcurve.append([lc["Time"], lc[cand["name"]], lc_err[cand["name"]]])
-        cand["lightcurve_data"] = json.dumps(lightcurve)
+        return lightcurve
+
+    return None
+
+
+def find_cand_files(
+    obs_id: str,
+    beam_id: str,
+    cand_name: str,
+    directory: str = SCRIPT_DIR,
+) -> Dict[str, str]:
+    """Find the paths of the images, gifs and fits files for a candidate, keyed by the field name on the webapp."""
 
     cand_upload_files = {}
-    # Upload the images, gifs and fits files if it is from the "final" model.
     for series_name, fmt_list in [
         ("lightcurve", ["png"]),
         ("slices", ["gif", "fits"]),
@@ -258,82 +644,286 @@ def send_cand_request(
     ]:
 
         for fmt in fmt_list:
-            filename = os.path.join(directory, f"{obs_id}_{beam_id}_{series_name}_{cand['name']}.{fmt}")
+            filename = os.path.join(directory, f"{obs_id}_{beam_id}_{series_name}_{cand_name}.{fmt}")
             if os.path.exists(filename):
-                cand_upload_files[f"{series_name}_{fmt}"] = open(filename, "rb")
+                cand_upload_files[f"{series_name}_{fmt}"] = filename
 
-    try:
-        # Send the request
-        r = session.post(
-            cand_url,
-            data=cand,
-            files=cand_upload_files,
+    return cand_upload_files
+
+
+def send_cand_request(
+    session: requests.Session,
+    cand_url: str,
+    obs_id: str,
+    beam_id: str,
+    cand: Dict,
+    lightcurve_local_rms: Optional[Dict] = None,
+    lightcurve_peak_flux: Optional[Dict] = None,
+    directory: str = SCRIPT_DIR,
+    compress_fits: bool = False,
+    stored_files: Optional[StoredFiles] = None,
+    journal: Optional[UploadJournal] = None,
+):
+
+    # Add the lightcurve data to the candidate, and in error bars and cast as strings for json handling.
+    lightcurve = get_lightcurve_data(cand, lightcurve_local_rms, lightcurve_peak_flux)
+    if lightcurve is not None:
+        cand["lightcurve_data"] = json.dumps(lightcurve)
+
+    # Upload the images, gifs and fits files if it is from the "final" model.
+    cand_upload_files = find_cand_files(obs_id, beam_id, cand["name"], directory)
+    if stored_files is not None:
+        cand_upload_files, references = stored_files.split(cand_upload_files)
+        for field, checksum in references.items():
+            cand[f"file_sha256.{field}"] = checksum
+
+    # Send the request
+    start = time.time()
+    r = post_multipart(session, cand_url, cand, cand_upload_files, compress_fits)
+    print(r.text)
+    if journal is not None:
+        journal.record(r, start, [(int(beam_id[4:]), cand["name"])] if r.ok else [])
+    r.raise_for_status()
+
+
+def send_cand_bulk_request(
+    session: requests.Session,
+    bulk_url: str,
+    project_id: str,
+    obs_id: str,
+    beam_id: str,
+    cands: List[Dict],
+    lightcurve_local_rms: Optional[Dict] = None,
+    lightcurve_peak_flux: Optional[Dict] = None,
+    directory: str = SCRIPT_DIR,
+    compress_fits: bool = False,
+    stored_files: Optional[StoredFiles] = None,
+    journal: Optional[UploadJournal] = None,
+) -> Dict:
+    """Upload a batch of candidates from the same beam, and their files, in a single request."""
+
+    cand_upload_files = {}
+    for cand in cands:
+        lightcurve = get_lightcurve_data(cand, lightcurve_local_rms, lightcurve_peak_flux)
+        if lightcurve is not None:
+            cand["lightcurve_data"] = lightcurve
+
+        # Files are matched back to their candidate on the webapp by the "<name>__<field>" key.
+        cand_files = find_cand_files(obs_id, beam_id, cand["name"], directory)
+        if stored_files is not None:
+            cand_files, references = stored_files.split(cand_files)
+            if references:
+                cand["file_sha256"] = references
+        for field, file_path in cand_files.items():
+            cand_upload_files[f"{cand['name']}__{field}"] = file_path
+
+    # Send the request
+    start = time.time()
+    r = post_multipart(
+        session,
+        bulk_url,
+        {
+            "proj_id": project_id,
+            "obs_id": obs_id,
+            "beam_index": int(beam_id[4:]),
+            "candidates": json.dumps(cands),
+        },
+        cand_upload_files,
+        compress_fits,
+    )
+    if not r.ok and journal is not None:
+        journal.record(r, start)
+    r.raise_for_status()
+
+    report = r.json()
+    if journal is not None:
+        # Candidates that were already on the webapp are done too.
+        journal.record(
+            r,
+            start,
+            [
+                (int(beam_id[4:]), result["name"])
+                for result in report["results"]
+                if result["status"] in ("created", "skipped")
+            ],
         )
-        print(r.text)
-        r.raise_for_status()
+    print(
+        f"Bulk upload for {obs_id} {beam_id} - created: {report['created']}, "
+        f"skipped: {report['skipped']}, errors: {report['error']}"
+    )
+    for result in report["results"]:
+        if result["status"] == "error":
+            print(f"Failed to upload candidate {result['name']}: {result['errors']}")
 
-    finally:
-        # Close all of the opened files.
-        for file in cand_upload_files.values():
-            file.close()
+    return report
 
 
-def upload_data(base_url, token, project_id, obs_id, data_directory):
-    """Upload a obs/observation to the YWANG-VASTER webapp."""
-    # Set up session
-    session = requests.session()
-    session.auth = TokenAuth(token)
-    obs_url = f"{base_url}/upload_observation/"
-    beam_url = f"{base_url}/upload_beam/"
-    cand_url = f"{base_url}/upload_candidate/"
+def send_manifest_request(
+    session: requests.Session,
+    manifest_url: str,
+    project_id: str,
+    obs_id: str,
+    all_beam_ids: List[str],
+    directory: str,
+    stored_files: StoredFiles,
+    workers: int = 1,
+    journal: Optional[UploadJournal] = None,
+) -> Optional[Tuple[set, Dict[int, set]]]:
+    """Send the beams and candidates planned for upload, with the SHA-256 of their files, and find which are missing.
 
-    # Find all of the beam output files for this observation.
-    beam_final_candidate_files = find_files_with_pattern(rf"{obs_id}_.*_final\.csv", data_directory)
+    The stored files of the missing beams and candidates are added to stored_files, so they are sent by their SHA-256.
 
-    print(f"beam_final_candidate_files: {beam_final_candidate_files}")
+    :return: The indexes of the missing beams and the names of the missing candidates of each beam, or None if the
+    webapp has no upload manifest endpoint."""
 
-    # Get the list of beams in the directory
-    all_beam_ids = []
-    for beam_final_csv_path in beam_final_candidate_files:
-        filename = os.path.basename(beam_final_csv_path)
-        all_beam_ids.append(filename.split("_")[1])
+    items, file_paths = [], []
+    for beam_id in all_beam_ids:
+        beam_int = int(beam_id[4:])
+        beam_files = find_beam_files(obs_id, beam_id, directory)
+        items.append({"beam_index": beam_int, "name": None, "files": beam_files})
+        file_paths += beam_files.values()
 
-    # Upload information about the observation
-    send_observation_request(session, obs_url, project_id, obs_id, data_directory)
+        candidates = parse_csv_file(os.path.join(directory, f"{obs_id}_{beam_id}_final.csv"), "cand_list", project_id)
+        for cand in candidates:
+            cand_files = find_cand_files(obs_id, beam_id, cand["name"], directory)
+            items.append({"beam_index": beam_int, "name": cand["name"], "files": cand_files})
+            file_paths += cand_files.values()
+
+    stored_files.add_checksums(file_paths, workers)
+    for item in items:
+        item["sha256"] = {field: stored_files.checksums[file_path] for field, file_path in item.pop("files").items()}
+
+    start = time.time()
+    r = session.post(manifest_url, json={"proj_id": project_id, "obs_id": obs_id, "items": items})
+    if not r.ok and journal is not None:
+        journal.record(r, start)
+    if r.status_code == 404:
+        print("The webapp has no upload manifest endpoint, uploading everything.")
+        return None
+    r.raise_for_status()
 
-    # For each beam
+    manifest = r.json()
+    stored_files.stored.update(manifest["stored"])
+
+    missing_beams, missing_cands = set(), {}
+    for item in manifest["missing"]:
+        if item["name"] is None:
+            missing_beams.add(item["beam_index"])
+        else:
+            missing_cands.setdefault(item["beam_index"], set()).add(item["name"])
+
+    if journal is not None:
+        # The beams and candidates the webapp already has are done.
+        missing = {(item["beam_index"], item["name"]) for item in manifest["missing"]}
+        journal.record(
+            r,
+            start,
+            [
+                (item["beam_index"], item["name"] or "")
+                for item in items
+                if (item["beam_index"], item["name"]) not in missing
+            ],
+        )
+
+    print(
+        f"Upload manifest for {obs_id} - {len(manifest['missing'])} of {len(items)} beams and candidates to upload, "
+        f"{len(manifest['stored'])} of their files already stored."
+    )
+    return missing_beams, missing_cands
+
+
+def find_upload_items(project_id: str, obs_id: str, all_beam_ids: List[str], directory: str) -> List[Tuple[int, str]]:
+    """List the beams and candidates to upload as (beam_index, name), with an empty name for the beams themselves."""
+
+    items = []
     for beam_id in all_beam_ids:
+        beam_int = int(beam_id[4:])
+        items.append((beam_int, ""))
+        candidates = parse_csv_file(os.path.join(directory, f"{obs_id}_{beam_id}_final.csv"), "cand_list", project_id)
+        items += [(beam_int, cand["name"]) for cand in candidates]
 
-        # Upload the metadata, fits and images for each beam
-        send_beam_request(session, beam_url, project_id, obs_id, beam_id, data_directory)
+    return items
 
-        candidate_csv_path = os.path.join(data_directory, f"{obs_id}_{beam_id}_final.csv")
 
-        # List of candidates from the *_final.csv
-        candidates = parse_csv_file(candidate_csv_path, "cand_list", project_id)
+def upload_beam_data(
+    session: requests.Session,
+    beam_url: str,
+    cand_url: str,
+    bulk_url: str,
+    project_id: str,
+    obs_id: str,
+    beam_id: str,
+    data_directory: str,
+    bulk_size: int = 0,
+    cand_executor: Optional[ThreadPoolExecutor] = None,
+    compress_fits: bool = False,
+    stored_files: Optional[StoredFiles] = None,
+    send_beam: bool = True,
+    cand_names: Optional[set] = None,
+    journal: Optional[UploadJournal] = None,
+):
+    """Upload a beam and then all of its candidates.
 
-        print(f"Number of candidates for upload - {len(candidates)}")
+    If a cand_executor is given the candidate requests are run on it in parallel, but only once the beam itself has
+    been created on the webapp. send_beam is False if the beam is already on the webapp, and cand_names limits the
+    upload to those candidates (eg. the ones missing from the upload manifest or left in the journal)."""
 
-        # Read in the lightcurve data files
-        lightcurve_peak_flux = parse_csv_file(
-            os.path.join(data_directory, f"{obs_id}_{beam_id}_lightcurve_peak_flux.csv"),
-            "per_cand",
-            project_id,
+    # Upload the metadata, fits and images for each beam
+    if send_beam:
+        send_beam_request(
+            session, beam_url, project_id, obs_id, beam_id, data_directory, compress_fits, stored_files, journal
         )
 
-        lightcurve_local_rms = parse_csv_file(
-            os.path.join(data_directory, f"{obs_id}_{beam_id}_lightcurve_local_rms.csv"),
-            "per_cand",
-            project_id,
-        )
+    candidate_csv_path = os.path.join(data_directory, f"{obs_id}_{beam_id}_final.csv")
 
-        # Loop through each possible candidate
-        for cand in candidates:
+    # List of candidates from the *_final.csv
+    candidates = parse_csv_file(candidate_csv_path, "cand_list", project_id)
+    if cand_names is not None:
+        candidates = [cand for cand in candidates if cand["name"] in cand_names]
 
-            # Remove source_id
-            cand.pop("source_id")
+    print(f"Number of candidates for upload - {len(candidates)}")
 
-            send_cand_request(
+    # Read in the lightcurve data files
+    lightcurve_peak_flux = parse_csv_file(
+        os.path.join(data_directory, f"{obs_id}_{beam_id}_lightcurve_peak_flux.csv"),
+        "per_cand",
+        project_id,
+    )
+
+    lightcurve_local_rms = parse_csv_file(
+        os.path.join(data_directory, f"{obs_id}_{beam_id}_lightcurve_local_rms.csv"),
+        "per_cand",
+        project_id,
+    )
+
+    # Remove source_id
+    for cand in candidates:
+        cand.pop("source_id")
+
+    if bulk_size > 0:
+        requests_to_send = [
+            partial(
+                send_cand_bulk_request,
+                session,
+                bulk_url,
+                project_id,
+                obs_id,
+                beam_id,
+                candidates[start : start + bulk_size],
+                lightcurve_local_rms,
+                lightcurve_peak_flux,
+                data_directory,
+                compress_fits,
+                stored_files,
+                journal,
+            )
+            for start in range(0, len(candidates), bulk_size)
+        ]
+    else:
+        # One request for each possible candidate
+        requests_to_send = [
+            partial(
+                send_cand_request,
                 session,
                 cand_url,
                 obs_id,
@@ -342,7 +932,181 @@ def upload_data(base_url, token, project_id, obs_id, data_directory):
                 lightcurve_local_rms,
                 lightcurve_peak_flux,
                 data_directory,
+                compress_fits,
+                stored_files,
+                journal,
+            )
+            for cand in candidates
+        ]
+
+    if cand_executor is None:
+        for send_request in requests_to_send:
+            send_request()
+    else:
+        futures = [cand_executor.submit(send_request) for send_request in requests_to_send]
+        for future in futures:
+            # Raise any errors from the candidate requests.
+            future.result()
+
+
+def upload_data(
+    base_url,
+    token,
+    project_id,
+    obs_id,
+    data_directory,
+    bulk_size=0,
+    workers=1,
+    compress_fits=False,
+    skip_stored_files=False,
+    use_manifest=True,
+    resume=False,
+):
+    """Upload a obs/observation to the YWANG-VASTER webapp.
+
+    Each request, and each beam and candidate the webapp acknowledges, is recorded in an UploadJournal in the data
+    directory. With resume, only the beams and candidates not yet acknowledged in the journal are uploaded, without
+    checking the manifest. Otherwise the journal is started afresh.
+
+    With use_manifest, the beams and candidates to upload and the SHA-256 of their files are first sent to the webapp
+    in one request, and only the beams and candidates it doesn't have yet are uploaded. Their files the webapp already
+    has stored are sent by their SHA-256.
+
+    Files are streamed from disk as each request is sent, with the fits files gzipped on the way if compress_fits is
+    set. With skip_stored_files, files the webapp already has stored (eg. from an earlier upload of the observation)
+    are sent by their SHA-256 rather than uploaded again.
+
+    If bulk_size is greater than zero, candidates are sent in batches of that many per request to the bulk upload
+    endpoint, otherwise one request is made per candidate.
+
+    With more than one worker, beams are uploaded in parallel and so are the candidates within each beam, with at most
+    "workers" requests in flight at any one time. The observation is always created before any of its beams, and a
+    beam before any of its candidates."""
+    # Set up session
+    session = LimitedSession(max_in_flight=workers)
+    session.auth = TokenAuth(token)
+    obs_url = f"{base_url}/upload_observation/"
+    beam_url = f"{base_url}/upload_beam/"
+    cand_url = f"{base_url}/upload_candidate/"
+    bulk_url = f"{base_url}/upload_candidates_bulk/"
+    manifest_url = f"{base_url}/upload_manifest/"
+    stored_url = f"{base_url}/stored_files/" if skip_stored_files else None
+    stored_files = StoredFiles(session, stored_url)
+
+    # Find all of the beam output files for this observation.
+    beam_final_candidate_files = find_files_with_pattern(rf"{obs_id}_.*_final\.csv", data_directory)
+
+    print(f"beam_final_candidate_files: {beam_final_candidate_files}")
+
+    # Get the list of beams in the directory
+    all_beam_ids = []
+    for beam_final_csv_path in beam_final_candidate_files:
+        filename = os.path.basename(beam_final_csv_path)
+        all_beam_ids.append(filename.split("_")[1])
+
+    # Keep track of what has been uploaded, so an interrupted upload can be resumed
+    journal = UploadJournal(UploadJournal.journal_path(data_directory, obs_id))
+    resume = resume and journal.has_runs()
+    journal.start_run(
+        project_id, obs_id, find_upload_items(project_id, obs_id, all_beam_ids, data_directory), resume
+    )
+
+    try:
+        # Upload information about the observation
+        send_observation_request(session, obs_url, project_id, obs_id, data_directory, journal)
+
+        # What to send for each beam - (whether to send the beam, names of the candidates to send or None for all)
+        beam_plans = {beam_id: (True, None) for beam_id in all_beam_ids}
+        if resume:
+            remaining = journal.remaining()
+            beam_plans = {
+                beam_id: remaining[int(beam_id[4:])] for beam_id in all_beam_ids if int(beam_id[4:]) in remaining
+            }
+            print(
+                f"Resuming the upload of {obs_id} from {journal.path} - {len(beam_plans)} of {len(all_beam_ids)} "
+                "beams left."
+            )
+        elif use_manifest:
+            missing = send_manifest_request(
+                session, manifest_url, project_id, obs_id, all_beam_ids, data_directory, stored_files, workers, journal
+            )
+            if missing is not None:
+                missing_beams, missing_cands = missing
+                beam_plans = {}
+                for beam_id in all_beam_ids:
+                    send_beam = int(beam_id[4:]) in missing_beams
+                    cand_names = missing_cands.get(int(beam_id[4:]), set())
+                    # Skip the beams that are already complete
+                    if send_beam or cand_names:
+                        beam_plans[beam_id] = (send_beam, cand_names)
+
+        upload_beams(
+            (session, beam_url, cand_url, bulk_url, project_id, obs_id),
+            beam_plans,
+            data_directory,
+            bulk_size,
+            workers,
+            compress_fits,
+            stored_files,
+            journal,
+        )
+    finally:
+        journal.finish_run()
+        journal.close()
+
+
+def upload_beams(
+    beam_args: Tuple,
+    beam_plans: Dict[str, Tuple[bool, Optional[set]]],
+    data_directory: str,
+    bulk_size: int = 0,
+    workers: int = 1,
+    compress_fits: bool = False,
+    stored_files: Optional[StoredFiles] = None,
+    journal: Optional[UploadJournal] = None,
+):
+    """Upload the beams and candidates planned for each beam, in parallel if there is more than one worker."""
+
+    if workers <= 1:
+        # For each beam
+        for beam_id, (send_beam, cand_names) in beam_plans.items():
+            upload_beam_data(
+                *beam_args,
+                beam_id,
+                data_directory,
+                bulk_size,
+                compress_fits=compress_fits,
+                stored_files=stored_files,
+                send_beam=send_beam,
+                cand_names=cand_names,
+                journal=journal,
+            )
+        return
+
+    # Separate pools for the beams and candidates, so a beam waiting on its candidates never holds up a candidate
+    # request. The session caps the number of requests actually in flight.
+    with ThreadPoolExecutor(max_workers=workers) as beam_executor, ThreadPoolExecutor(
+        max_workers=workers
+    ) as cand_executor:
+        futures = [
+            beam_executor.submit(
+                upload_beam_data,
+                *beam_args,
+                beam_id,
+                data_directory,
+                bulk_size,
+                cand_executor,
+                compress_fits,
+                stored_files,
+                send_beam,
+                cand_names,
+                journal,
             )
+            for beam_id, (send_beam, cand_names) in beam_plans.items()
+        ]
+        for future in as_completed(futures):
+            # Raise any errors from the beam and candidate requests.
+            future.result()
 
 
 if __name__ == "__main__":
@@ -354,21 +1118,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "--base_url",
         type=str,
-        required=True,
         help="URL of the webapp to upload to.",
     )
 
     parser.add_argument(
         "--token",
         type=str,
-        required=True,
         help="Upload token for the webapp.",
     )
 
     parser.add_argument(
         "--project_id",
         type=str,
-        required=True,
         help="ID of the project to upload to.",
     )
 
@@ -386,6 +1147,52 @@ if __name__ == "__main__":
         help="Path to directory containing all of candidate data.",
     )
 
+    parser.add_argument(
+        "--bulk_size",
+        type=int,
+        default=0,
+        help="Number of candidates to send per request to the bulk upload endpoint. Default: 0, one request per candidate.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of requests to have in flight at once, beams and candidates are uploaded in parallel. Default: 1",
+    )
+
+    parser.add_argument(
+        "--compress_fits",
+        action="store_true",
+        help="Gzip the fits files while they are sent, they are stored uncompressed on the webapp.",
+    )
+
+    parser.add_argument(
+        "--skip_stored_files",
+        action="store_true",
+        help="Send the files the webapp already has stored by their SHA-256 instead of uploading them again.",
+    )
+
+    parser.add_argument(
+        "--no_manifest",
+        action="store_true",
+        help="Upload every beam and candidate, without first checking which ones the webapp already has.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted upload, only uploading the beams and candidates not yet acknowledged in the upload "
+        "journal in the data directory.",
+    )
+
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Report the progress and throughput of the upload from the journal in the data directory, and what is "
+        "left to upload, without uploading anything.",
+    )
+
     parser.add_argument(
         "-L",
         "--loglvl",
@@ -409,14 +1216,20 @@ if __name__ == "__main__":
     # Validate arguments before doing anything
     errors = []
 
-    if not args.base_url.startswith(("http://", "https://")):
-        errors.append(f"--base_url does not look like a valid URL: '{args.base_url}'")
+    # Only needed to upload
+    if not args.status:
+        if args.base_url is None:
+            errors.append("--base_url is required.")
+        elif not args.base_url.startswith(("http://", "https://")):
+            errors.append(f"--base_url does not look like a valid URL: '{args.base_url}'")
 
-    if not re.fullmatch(r"[0-9a-fA-F]{40}", args.token):
-        errors.append("--token must be a 40-character hexadecimal string.")
+        if args.token is None:
+            errors.append("--token is required.")
+        elif not re.fullmatch(r"[0-9a-fA-F]{40}", args.token):
+            errors.append("--token must be a 40-character hexadecimal string.")
 
-    if not args.project_id.strip():
-        errors.append("--project_id must not be empty.")
+        if args.project_id is None or not args.project_id.strip():
+            errors.append("--project_id must not be empty.")
 
     if not args.observation_id.strip():
         errors.append("--observation_id must not be empty.")
@@ -432,12 +1245,39 @@ if __name__ == "__main__":
     elif not os.path.isdir(data_path):
         errors.append(f"--data_directory is not a directory: '{data_path}'")
 
+    if args.bulk_size < 0:
+        errors.append("--bulk_size must not be negative.")
+
+    if args.workers < 1:
+        errors.append("--workers must be at least 1.")
+
+    if args.status and not errors:
+        journal_path = UploadJournal.journal_path(data_path, args.observation_id)
+        if not os.path.exists(journal_path):
+            errors.append(f"No upload journal for {args.observation_id} in --data_directory: '{journal_path}'")
+
     if errors:
         parser.error(
             "The following required arguments are invalid:\n  "
             + "\n  ".join(errors)
         )
 
+    if args.status:
+        journal = UploadJournal(journal_path)
+        journal.print_status()
+        journal.close()
+        sys.exit(0)
+
     upload_data(
-        args.base_url, args.token, args.project_id, args.observation_id, data_path
+        args.base_url,
+        args.token,
+        args.project_id,
+        args.observation_id,
+        data_path,
+        args.bulk_size,
+        args.workers,
+        args.compress_fits,
+        args.skip_stored_files,
+        not args.no_manifest,
+        args.resume,
     )
@@ -44,11 +44,21 @@ ALLOWED_HOSTS = os.environ.get("DJANGO_ALLOWED_HOSTS").split(" ")
 LOGIN_REDIRECT_URL = "/"
 LOGOUT_REDIRECT_URL = "/"
 
-# Maximum size (in bytes) that a request can be before a SuspiciousOperation (RequestDataTooBig) is raised
+# Maximum size (in bytes) of the non-file fields of a request before a SuspiciousOperation (RequestDataTooBig) is
+# raised, e.g. the candidate rows of a bulk upload
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100 MB, adjust as necessary
 
-# Maximum size (in bytes) that a single uploaded file can be
-FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100 MB, adjust as necessary
+# Uploaded files are streamed to disk as they arrive and hashed on the way, rather than held in memory
+FILE_UPLOAD_HANDLERS = ["candidate_app.upload_handlers.HashingFileUploadHandler"]
+
+# Maximum number of files in a single request, bulk candidate uploads send up to 5 files per candidate
+DATA_UPLOAD_MAX_NUMBER_FILES = 5000
+
+# Minutes a random unrated candidate is held for the rater it was handed to, 0 to allow handing it to several raters
+CANDIDATE_CLAIM_MINUTES = int(os.environ.get("CANDIDATE_CLAIM_MINUTES", 10))
+
+# Days the cached Simbad objects are used for before the region is queried from Simbad again
+SIMBAD_CACHE_TTL_DAYS = float(os.environ.get("SIMBAD_CACHE_TTL_DAYS", 30))
 
 # Application definition
 
@@ -125,6 +135,9 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 MEDIA_ROOT = "/ywangvaster_media"
 MEDIA_URL = "/media/"
 
+# Uploads are written here while they are received, on the same volume as MEDIA_ROOT so they are moved into place
+FILE_UPLOAD_TEMP_DIR = os.path.join(MEDIA_ROOT, ".uploads")
+
 STATIC_URL = "static/"
 STATIC_ROOT = "/ywangvaster_staticfiles/"
 STATICFILES_DIRS = [
@@ -46,6 +46,9 @@ urlpatterns = [
     path("upload_observation/", views.upload_observation, name="upload_observation"),
     path("upload_beam/", views.upload_beam, name="upload_beam"),
     path("upload_candidate/", views.upload_candidate, name="upload_candidate"),
+    path("upload_candidates_bulk/", views.upload_candidates_bulk, name="upload_candidates_bulk"),
+    path("upload_manifest/", views.upload_manifest, name="upload_manifest"),
+    path("stored_files/", views.stored_files, name="stored_files"),
     # Delete records from the DB
     path("delete/", views.delete, name="delete"),
 ]